@@ -0,0 +1,894 @@
+"""
+Performance benchmarks, runnable headless.
+
+usage:
+    python benchmark.py gif [--frames 200] [--width 1024] [--height 720]
+    python benchmark.py tiles [--size 8192] [--stroke 16]
+    python benchmark.py delta [--frames 300] [--keyframe-interval 30]
+    python benchmark.py strips [--size 10000] [--compression rle]
+    python benchmark.py startup [--runs 5] [--max-ms 0]
+    python benchmark.py photoshop [--calls 200] [--latency-ms 1]
+    python benchmark.py palette [--events 400] [--rate 200] [--latency-ms 2]
+    python benchmark.py brush [--strokes 300] [--paths strokes.json]
+    python benchmark.py sampler [--samples 20000] [--max-us 0]
+    python benchmark.py suite [--sizes 2048x1536] [--layers 0,4] [--depths 8,16] [--save-baseline]
+
+suite records simulated editing sessions on synthetic PSDs and compares
+startup time, capture, change detection and export numbers against a stored baseline.
+"""
+
+import os
+import io
+import sys
+import json
+import math
+import time
+import platform
+import statistics
+import subprocess
+import argparse
+import tracemalloc
+import tempfile
+import contextlib
+
+import numpy as np
+
+
+def synthetic_session(frame_count, size, seed=0, stroke_size=24):
+    """
+    Yields frames of a slowly changing canvas, a few strokes per frame
+    """
+
+    rng = np.random.RandomState(seed)
+    w, h = size
+    canvas = np.full((h, w, 3), 255, dtype=np.uint8)
+    for _ in range(frame_count):
+        for _ in range(rng.randint(1, 4)):
+            x = rng.randint(0, max(1, w - stroke_size))
+            y = rng.randint(0, max(1, h - stroke_size))
+            canvas[y:y + stroke_size, x:x + stroke_size] = rng.randint(0, 256, 3)
+        yield canvas.copy()
+
+
+def timed(func, *args, **kwargs):
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def bench_gif(args):
+    import imageio
+    import gif_encoder
+    from frame_export import HOLD_LAST_FRAMES
+
+    size = (args.width, args.height)
+    frames = list(synthetic_session(args.frames, size))
+    frames += [frames[-1]] * HOLD_LAST_FRAMES
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "imageio.gif")
+        _, elapsed = timed(imageio.mimwrite, path, frames, fps=args.framerate, loop=0)
+        results["imageio"] = (elapsed, os.path.getsize(path))
+
+        def encode_delta(path):
+            histogram = gif_encoder.ColorHistogram()
+            for frame in frames[::max(1, len(frames) // 16)]:
+                histogram.add(frame)
+            writer = gif_encoder.DeltaGifWriter(path, histogram.palette(), args.framerate)
+            for frame in frames:
+                writer.append_data(frame)
+            writer.close()
+            return writer
+
+        path = os.path.join(tmpdir, "delta.gif")
+        writer, elapsed = timed(encode_delta, path)
+        results["delta"] = (elapsed, os.path.getsize(path))
+        mismatches = check_gif_round_trip(path, frames, writer)
+
+    print(f"gif: {args.frames} frames at {size[0]}x{size[1]}")
+    for name, (elapsed, filesize) in results.items():
+        print(f"  {name:>8}: {elapsed:8.2f}s {filesize / 1024:10.1f} KiB")
+    if mismatches:
+        print(f"[ERROR] delta gif round trip: {mismatches}")
+        raise SystemExit(1)
+    print("  delta gif decodes to the quantized frames")
+
+
+def check_gif_round_trip(path, frames, writer):
+    """
+    Decodes a DeltaGifWriter output and compares it with the quantized
+    input frames; returns a description of the first mismatch, or None
+    """
+
+    from PIL import Image
+    from PIL import ImageSequence
+
+    table = np.frombuffer(writer.palette_bytes, dtype=np.uint8).reshape(-1, 3)
+
+    def distinct(sequence):
+        # repeated frames are merged into longer delays when encoding
+        previous = None
+        for frame in sequence:
+            if previous is None or not np.array_equal(frame, previous):
+                yield frame
+            previous = frame
+
+    expected = list(distinct(table[writer.quantize(np.asarray(frame)[:, :, :3])] for frame in frames))
+    with Image.open(path) as img:
+        decoded = list(distinct(np.asarray(frame.convert("RGB")) for frame in ImageSequence.Iterator(img)))
+
+    if len(decoded) != len(expected):
+        return f"{len(decoded)} distinct frames decoded, {len(expected)} encoded"
+    for index, (got, want) in enumerate(zip(decoded, expected)):
+        if not np.array_equal(got, want):
+            rows = np.flatnonzero((got != want).any(axis=(1, 2)))
+            return f"frame {index} differs in {len(rows)} rows, first {rows[0]}"
+    return None
+
+
+def bench_tiles(args):
+    import imagehash
+    from PIL import Image
+    from tile_diff import TileChangeDetector
+
+    rng = np.random.RandomState(0)
+    size = args.size
+    canvas = rng.randint(0, 256, (size, size, 4), dtype=np.uint8)
+    edited = canvas.copy()
+    y, x = rng.randint(0, size - args.stroke, 2)
+    edited[y:y + args.stroke, x:x + args.stroke] = 255 - edited[y:y + args.stroke, x:x + args.stroke]
+
+    detector = TileChangeDetector()
+    detector.update(canvas)
+    mask, tile_elapsed = timed(detector.update, edited)
+
+    canvas_img = Image.fromarray(canvas)
+    edited_img = Image.fromarray(edited)
+    before = imagehash.average_hash(canvas_img, hash_size=32)
+    after, hash_elapsed = timed(imagehash.average_hash, edited_img, hash_size=32)
+
+    stroke_share = 100.0 * args.stroke ** 2 / size ** 2
+    print(f"tiles: {size}x{size} canvas, {args.stroke}x{args.stroke} stroke ({stroke_share:.4f}% of canvas)")
+    print(f"  {'tiles':>10}: {tile_elapsed:8.3f}s  detected: {bool(mask.any())} ({int(mask.sum())} dirty tiles)")
+    print(f"  {'imagehash':>10}: {hash_elapsed:8.3f}s  detected: {before != after}")
+
+
+def bench_delta(args):
+    from PIL import Image
+    from frame_store import FrameStore
+    from delta_store import DeltaFrameWriter
+
+    size = (args.width, args.height)
+    frames = list(synthetic_session(args.frames, size))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        def write_pngs():
+            for i, frame in enumerate(frames):
+                Image.fromarray(frame).save(os.path.join(tmpdir, f"cached_{i}.png"))
+
+        def write_store(path, keyframe_interval):
+            store = FrameStore(path)
+            writer = DeltaFrameWriter(store, keyframe_interval) if keyframe_interval else store
+            for frame in frames:
+                writer.append(frame)
+            store.close()
+
+        def disk_usage(*paths):
+            return sum(os.path.getsize(path) for path in paths)
+
+        results = {}
+        _, elapsed = timed(write_pngs)
+        png_paths = [os.path.join(tmpdir, f"cached_{i}.png") for i in range(len(frames))]
+        results["png"] = (elapsed, disk_usage(*png_paths))
+
+        for name, keyframe_interval in (("raw store", 0), ("delta store", args.keyframe_interval)):
+            path = os.path.join(tmpdir, name.replace(" ", "_") + ".bin")
+            _, elapsed = timed(write_store, path, keyframe_interval)
+            results[name] = (elapsed, disk_usage(path, path + ".idx"))
+
+        print(f"delta: {args.frames} frames at {size[0]}x{size[1]}, keyframe every {args.keyframe_interval}")
+        for name, (elapsed, usage) in results.items():
+            print(f"  {name:>12}: write {elapsed:7.2f}s  disk {usage / 1024 ** 2:9.2f} MiB")
+
+        store = FrameStore(os.path.join(tmpdir, "delta_store.bin"), readonly=True)
+        _, sequential = timed(lambda: [store[i] for i in range(len(frames))])
+        order = np.random.RandomState(0).permutation(len(frames))
+        _, random_access = timed(lambda: [store[int(i)] for i in order])
+        store.close()
+
+        _, png_read = timed(lambda: [np.asarray(Image.open(path)) for path in png_paths])
+
+        print("  reconstruction throughput")
+        print(f"  {'png decode':>12}: {len(frames) / png_read:9.1f} frames/s")
+        print(f"  {'sequential':>12}: {len(frames) / sequential:9.1f} frames/s")
+        print(f"  {'random':>12}: {len(frames) / random_access:9.1f} frames/s")
+
+
+def peak_memory(func, *args, **kwargs):
+    """
+    (result, elapsed, peak bytes allocated through python and numpy)
+    """
+
+    tracemalloc.start()
+    try:
+        result, elapsed = timed(func, *args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def bench_strips(args):
+    import psd_capture
+    import synthetic_psd
+
+    size = (args.size, args.size)
+    target = psd_capture.fit_size(size, (args.width, args.height))
+    channels = 3
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "synthetic.psd")
+        _, elapsed = timed(synthetic_psd.write_psd, path, size, args.compression, channels)
+        print(f"strips: {size[0]}x{size[1]} {args.compression} psd "
+              f"({os.path.getsize(path) / 1024 ** 2:.1f} MiB, written in {elapsed:.1f}s) -> {target[0]}x{target[1]}")
+
+        def decode_strips():
+            with open(path, "rb") as fp:
+                return psd_capture.read_merged_scaled(fp, psd_capture.read_layout(fp), target)
+
+        def decode_full():
+            with open(path, "rb") as fp:
+                layout = psd_capture.read_layout(fp)
+                planes = psd_capture.read_merged_planes(fp, layout)
+            return psd_capture.planes_to_image(planes, layout.depth).resize(target)
+
+        output_bytes = target[0] * target[1] * channels
+        canvas_bytes = size[0] * size[1] * channels
+        results = [("strips", decode_strips)]
+        if not args.skip_full:
+            results.append(("full", decode_full))
+
+        # tracemalloc sees numpy and python buffers, not PIL's own allocations
+        failed = False
+        for name, func in results:
+            _, elapsed, peak = peak_memory(func)
+            print(f"  {name:>8}: {elapsed:8.2f}s  peak {peak / 1024 ** 2:9.1f} MiB  "
+                  f"({peak / output_bytes:6.1f}x output, {peak / canvas_bytes:6.3f}x canvas)")
+            if name == "strips" and peak > args.budget * output_bytes + 4 * psd_capture.STRIP_BYTES:
+                failed = True
+
+        if failed:
+            print(f"  FAIL: strip decode peak exceeds {args.budget}x output + 4 strips")
+            raise SystemExit(1)
+
+
+# stand-ins for PySide and win32com so record.py imports anywhere
+STARTUP_STUBS = {
+    "PySide/__init__.py": "",
+    "PySide/QtCore.py": (
+        "class Signal(object):\n"
+        "    def __init__(self, *args):\n"
+        "        pass\n"
+        "def __getattr__(name):\n"
+        "    return type(name, (object,), {})\n"
+    ),
+    "PySide/QtGui.py": (
+        "def __getattr__(name):\n"
+        "    return type(name, (object,), {})\n"
+    ),
+    "win32com/__init__.py": "",
+    "win32com/client.py": (
+        "def Dispatch(name):\n"
+        "    raise OSError('no COM here')\n"
+    ),
+    "pythoncom.py": (
+        "def CoInitialize():\n"
+        "    pass\n"
+        "def CoUninitialize():\n"
+        "    pass\n"
+    ),
+}
+
+# imported by the recorder at some point, none of them needed to show the window
+HEAVY_MODULES = ("numpy", "imageio", "PIL", "imagehash", "psd_tools", "win32com")
+
+
+def write_stubs(dirpath, stubs):
+    for relpath, source in stubs.items():
+        path = os.path.join(dirpath, relpath)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fp:
+            fp.write(source)
+
+
+def parse_importtime(stderr):
+    """
+    {module: (self us, cumulative us)} from python -X importtime output
+    """
+
+    result = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = [field.strip() for field in line[len("import time:"):].split("|")]
+        if not fields[0].isdigit():
+            continue
+        result[fields[2]] = (int(fields[0]), int(fields[1]))
+    return result
+
+
+def measure_startup(runs):
+    """
+    (median seconds of a cold "import record" process, bare interpreter
+    seconds, python -X importtime modules) with Qt and COM stubbed
+    """
+
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as stub_dir:
+        write_stubs(stub_dir, STARTUP_STUBS)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join((stub_dir, repo_dir)), PYTHONDONTWRITEBYTECODE="")
+        command = [sys.executable, "-c", "import record"]
+
+        # warm the bytecode cache, then time plain imports
+        subprocess.run(command, cwd=repo_dir, env=env, check=True)
+        elapsed = []
+        for _ in range(runs):
+            _, seconds = timed(subprocess.run, command, cwd=repo_dir, env=env, check=True)
+            elapsed.append(seconds)
+        _, baseline = timed(subprocess.run, [sys.executable, "-c", "pass"], env=env, check=True)
+
+        traced = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import record"],
+            cwd=repo_dir, env=env, check=True, stderr=subprocess.PIPE, universal_newlines=True
+        )
+
+    return statistics.median(elapsed), baseline, parse_importtime(traced.stderr)
+
+
+def bench_startup(args):
+    startup, baseline, modules = measure_startup(args.runs)
+    record_ms = modules.get("record", (0, 0))[1] / 1000.0
+    startup_ms = startup * 1000.0
+    eager = [name for name in HEAVY_MODULES if name in modules]
+
+    print(f"startup: {startup_ms:.1f} ms (median of {args.runs}, bare interpreter {baseline * 1000.0:.1f} ms)")
+    print(f"  import record: {record_ms:.1f} ms cumulative")
+    print(f"  heavy modules loaded eagerly: {', '.join(eager) or 'none'}")
+    print("  slowest imports:")
+    for name, (_, cumulative) in sorted(modules.items(), key=lambda item: -item[1][1])[:args.top]:
+        print(f"  {name:>40}: {cumulative / 1000.0:8.1f} ms")
+
+    if args.max_ms and record_ms > args.max_ms:
+        print(f"  FAIL: import record took more than {args.max_ms} ms")
+        raise SystemExit(1)
+
+
+def _dispatch_per_call_color(backend):
+    # what every foreground color read cost before the shared connection
+    psapp = backend.dispatch("Photoshop.Application").Application
+    return (psapp.foregroundColor.rgb.red, psapp.foregroundColor.rgb.green, psapp.foregroundColor.rgb.blue)
+
+
+def _dispatch_per_call_save(backend):
+    psapp = backend.dispatch("Photoshop.Application").Application
+    psapp.ActiveDocument.save()
+
+
+def bench_photoshop(args):
+    import photoshop
+
+    latency = args.latency_ms / 1000.0
+    scenarios = [
+        ("color read", _dispatch_per_call_color, lambda connection: connection.foreground_color(), (True, False)),
+        ("save", _dispatch_per_call_save, lambda connection: connection.save_active_document(), (True,)),
+    ]
+
+    print(f"photoshop: {args.calls} calls, fake COM round trip {args.latency_ms} ms, Dispatch {args.latency_ms * 10} ms")
+    for name, legacy, managed, javascript_modes in scenarios:
+        backend = photoshop.FakeBackend(latency, latency * 10)
+        _, legacy_elapsed = timed(lambda: [legacy(backend) for _ in range(args.calls)])
+        legacy_calls = backend.com_calls
+
+        for javascript in javascript_modes:
+            backend = photoshop.FakeBackend(latency, latency * 10, javascript=javascript)
+            connection = photoshop.PhotoshopConnection(backend)
+            _, elapsed = timed(lambda: [managed(connection) for _ in range(args.calls)])
+            connection.close()
+            label = "batched" if javascript else "no DoJavaScript"
+            print(f"  {name:>10}: per call {legacy_elapsed / args.calls * 1000:7.2f} ms -> "
+                  f"{elapsed / args.calls * 1000:7.2f} ms ({label}), "
+                  f"COM round trips {legacy_calls} -> {backend.com_calls}")
+
+    backend = photoshop.FakeBackend(latency, latency * 10)
+    connection = photoshop.PhotoshopConnection(backend)
+    connection.foreground_color()
+    backend.restart()
+    connection.foreground_color()
+    print(f"  after a Photoshop restart: {connection.stats()['reconnects']} reconnect, {backend.dispatches} dispatches")
+    connection.close()
+
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+def bench_palette(args):
+    import photoshop
+
+    latency = args.latency_ms / 1000.0
+    period = 1.0 / args.rate
+
+    def drag(on_event):
+        # right-drag: every move event reads and writes the foreground color
+        durations = []
+        started = time.perf_counter()
+        for i in range(args.events):
+            event_started = time.perf_counter()
+            on_event(i)
+            durations.append(time.perf_counter() - event_started)
+            time.sleep(max(0.0, started + (i + 1) * period - time.perf_counter()))
+        return durations
+
+    def blocking(connection):
+        def on_event(i):
+            connection.foreground_color()
+            connection.set_foreground_color((i % 256, 0, 0))
+        return on_event
+
+    def coalesced(connection):
+        sync = photoshop.ForegroundColorSync(connection)
+        sync.refresh(wait=True)
+
+        def on_event(i):
+            sync.color
+            sync.push((i % 256, 0, 0))
+        on_event.sync = sync
+        return on_event
+
+    print(f"palette: {args.events} move events at {args.rate} Hz, fake COM round trip {args.latency_ms} ms")
+    for name, make_handler in (("blocking", blocking), ("coalesced", coalesced)):
+        backend = photoshop.FakeBackend(latency, latency * 10)
+        connection = photoshop.PhotoshopConnection(backend)
+        on_event = make_handler(connection)
+        started = time.perf_counter()
+        durations = drag(on_event)
+        if hasattr(on_event, "sync"):
+            on_event.sync.flush(5.0)
+        elapsed = time.perf_counter() - started
+        connection.close()
+
+        final = backend.app.foregroundColor.rgb.red
+        print(f"  {name:>10}: event mean {1000 * sum(durations) / len(durations):7.2f} ms "
+              f"p95 {1000 * percentile(durations, 0.95):7.2f} ms max {1000 * max(durations):7.2f} ms, "
+              f"{connection.calls / elapsed:6.1f} calls/s, {backend.com_calls / elapsed:7.1f} COM round trips/s, "
+              f"final red {final}")
+
+
+def synthetic_strokes(count, size, seed=0, points=60):
+    """
+    [[(x, y, pressure), ...], ...] wobbly strokes across a size canvas
+    """
+
+    rng = np.random.RandomState(seed)
+    w, h = size
+    strokes = []
+    for _ in range(count):
+        x, y = rng.uniform(0, w), rng.uniform(0, h)
+        heading = rng.uniform(0, 2 * math.pi)
+        stroke = []
+        for i in range(points):
+            heading += rng.normal(0, 0.3)
+            x = min(max(x + math.cos(heading) * 6, 0), w - 1)
+            y = min(max(y + math.sin(heading) * 6, 0), h - 1)
+            stroke.append((x, y, 0.3 + 0.7 * math.sin(math.pi * i / points)))
+        strokes.append(stroke)
+    return strokes
+
+
+def bench_brush(args):
+    from palette_raster import PaletteRaster
+
+    if args.paths:
+        with open(args.paths) as fp:
+            recorded = json.load(fp)
+        size = tuple(recorded["size"])
+        strokes = recorded["strokes"]
+    else:
+        size = (args.width, args.height)
+        strokes = synthetic_strokes(args.strokes, size)
+
+    raster = PaletteRaster(*size)
+    radius = 10.0
+    durations = []
+    dabs = 0
+    dirty_pixels = 0
+    for stroke in strokes:
+        last = stroke[0][:2]
+        for x, y, pressure in stroke:
+            started = time.perf_counter()
+            dirty = raster.stroke(last, (x, y), (40, 90, 200), radius * (0.5 + 0.5 * pressure), pressure)
+            durations.append(time.perf_counter() - started)
+            dabs += 2 + int((abs(x - last[0]) + abs(y - last[1])) * 0.1)
+            if dirty:
+                dirty_pixels += (dirty[2] - dirty[0]) * (dirty[3] - dirty[1])
+            last = (x, y)
+
+    tenth = max(1, len(durations) // 10)
+    print(f"brush: {len(strokes)} strokes, {len(durations)} move events on {size[0]}x{size[1]}")
+    print(f"  event mean {1000 * sum(durations) / len(durations):.3f} ms, "
+          f"p95 {1000 * percentile(durations, 0.95):.3f} ms")
+    print(f"  first 10% of events {1000 * sum(durations[:tenth]) / tenth:.3f} ms, "
+          f"last 10% {1000 * sum(durations[-tenth:]) / tenth:.3f} ms")
+    print(f"  repainted {dirty_pixels / len(durations):.0f} px per event "
+          f"instead of {size[0] * size[1]}; one scene item per dab would have made {dabs} items")
+
+
+def _monte_carlo_sample(pixels, x, y, radius, count=25):
+    # the sampling get_stage_color did before, minus the view grab
+    import random
+    height, width = pixels.shape[:2]
+    r_sum = g_sum = b_sum = 128
+    for _ in range(count):
+        angle = random.random() * math.pi * 2.0
+        dist = random.random() * radius
+        px = int(x + math.cos(angle) * dist)
+        py = int(y + math.cos(angle) * dist)
+        if 0 <= px < width and 0 <= py < height:
+            r, g, b = pixels[py, px]
+            r_sum += int(r)
+            g_sum += int(g)
+            b_sum += int(b)
+    return (min(r_sum / count, 255), min(g_sum / count, 255), min(b_sum / count, 255))
+
+
+def bench_sampler(args):
+    from palette_raster import PaletteRaster
+    from palette_raster import StageSampler
+
+    size = (args.width, args.height)
+    raster = PaletteRaster(*size)
+    raster.pixels[:] = np.random.RandomState(0).randint(0, 256, raster.pixels.shape)
+    sampler = StageSampler(raster)
+    points = np.random.RandomState(1).uniform(0, 1, (args.samples, 2)) * size
+
+    print(f"sampler: {args.samples} samples on {size[0]}x{size[1]}")
+    failed = False
+    for radius in (1, 4, 16):
+        # a new point every time, like a right-drag
+        _, elapsed = timed(lambda: [sampler.sample(x, y, radius) for x, y in points])
+        per_sample = elapsed / args.samples * 1e6
+        _, legacy = timed(lambda: [_monte_carlo_sample(raster.pixels, x, y, radius) for x, y in points])
+        print(f"  radius {radius:>3}: {per_sample:8.1f} us/sample "
+              f"(25 monte carlo reads: {legacy / args.samples * 1e6:8.1f} us)")
+        if args.max_us and per_sample > args.max_us:
+            failed = True
+
+    repeat = [sampler.sample(*points[0], 4) for _ in range(3)]
+    print(f"  deterministic: {len(set(repeat)) == 1}")
+    if failed:
+        print(f"  FAIL: sampling took more than {args.max_us} us")
+        raise SystemExit(1)
+
+
+BASELINE_PATH = "benchmark_baseline.json"
+
+# suite results compared against the baseline; all of them grow when worse
+SUITE_METRICS = (
+    ("capture_tick_ms", "capture per tick, median"),
+    ("capture_tick_p95_ms", "capture per tick, p95"),
+    ("detect_changed_ms", "change detection, changed file"),
+    ("detect_idle_ms", "change detection, unchanged file"),
+    ("capture_peak_mib", "capture peak memory"),
+    ("export_decode_ms", "export decode per frame"),
+    ("export_gif_ms", "gif encode per frame"),
+    ("export_mp4_ms", "mp4 encode per frame"),
+    ("export_peak_mib", "export peak memory"),
+    ("gif_bytes", "gif file size"),
+    ("mp4_bytes", "mp4 file size"),
+    ("startup_ms", "recorder startup, median"),
+    ("record_import_ms", "import record, cumulative"),
+)
+
+# suite entry of the recorder startup numbers, next to the capture cases
+STARTUP_CASE = "startup"
+
+
+def suite_cases(args):
+    for size in args.sizes.split(","):
+        width, height = (int(value) for value in size.lower().split("x"))
+        for layers in (int(value) for value in args.layers.split(",")):
+            for depth in (int(value) for value in args.depths.split(",")):
+                for compression in args.compressions.split(","):
+                    name = f"{width}x{height}-{layers}layers-{depth}bit-{compression}"
+                    yield name, (width, height), layers, depth, compression
+
+
+def run_suite_case(session_dir, size, layers, depth, compression, args):
+    """
+    Saves an edited document args.saves times, capturing every save
+    through the pipeline stages in order, then exports the session
+    """
+
+    import frame_export
+    import synthetic_psd
+    from capture_pipeline import CapturePipeline
+    from capture_pipeline import CaptureFrame
+    from session_manifest import SessionManifest
+    from metrics import Metrics
+
+    psd_path = f"{session_dir}/document.psd"
+    session = synthetic_psd.EditSession(psd_path, size, compression, depth, layers, seed=args.seed)
+    capture_metrics = Metrics()
+    pipeline = CapturePipeline(
+        psd_path,
+        f"{session_dir}/cached_{{index}}.png",
+        (args.width, args.height),
+        manifest=SessionManifest.for_session(session_dir),
+        metrics=capture_metrics
+    )
+    stages = (("decode", pipeline.decode), ("hash", pipeline.dedupe),
+              ("resize", pipeline.resize), ("write", pipeline.write))
+
+    ticks = []
+    detect_changed = []
+    detect_idle = []
+    psd_bytes = 0
+    capture_peak = 0
+    tracemalloc.start()
+    try:
+        for i in range(args.saves):
+            if i:
+                session.edit()
+            session.save()
+            psd_bytes = os.path.getsize(psd_path)
+
+            if hasattr(tracemalloc, "reset_peak"):
+                # saving the file is not part of the tick
+                tracemalloc.reset_peak()
+            changed, elapsed = timed(pipeline.change_detector.has_changed)
+            detect_changed.append(elapsed)
+            _, elapsed = timed(pipeline.change_detector.has_changed)
+            detect_idle.append(elapsed)
+            if not changed:
+                continue
+
+            frame = CaptureFrame(psd_path)
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for stage, func in stages:
+                    with capture_metrics.timer(f"capture.{stage}"):
+                        frame = func(frame)
+                    if frame is None:
+                        break
+            ticks.append(time.perf_counter() - started)
+            capture_peak = max(capture_peak, tracemalloc.get_traced_memory()[1])
+    finally:
+        tracemalloc.stop()
+
+    export_metrics = Metrics()
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            report = frame_export.export_session(
+                session_dir, "png", args.width, args.height, args.framerate,
+                metrics=export_metrics, on_progress=lambda done, count: None
+            )
+        _, export_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    stages = export_metrics.snapshot()["stages"]
+
+    def stage_ms(stage):
+        return stages[stage]["mean"] * 1000 if stage in stages else None
+
+    def output_bytes(name):
+        if report is None or report.get(name, {}).get("error"):
+            return None
+        return os.path.getsize(f"{session_dir}/dst.{name}")
+
+    result = {
+        "psd_bytes": psd_bytes,
+        "frames": pipeline.saved_count,
+        "capture_tick_ms": statistics.median(ticks) * 1000 if ticks else None,
+        "capture_tick_p95_ms": percentile(ticks, 0.95) * 1000 if ticks else None,
+        "detect_changed_ms": statistics.median(detect_changed) * 1000,
+        "detect_idle_ms": statistics.median(detect_idle) * 1000,
+        "capture_peak_mib": capture_peak / 1024 ** 2,
+        "export_decode_ms": stage_ms("export.decode"),
+        "export_gif_ms": stage_ms("export.gif"),
+        # segment encoders decode their own frames; busy time covers both
+        "export_mp4_ms": report["mp4"]["busy"] / report["mp4"]["frames"] * 1000 if output_bytes("mp4") else None,
+        "export_peak_mib": export_peak / 1024 ** 2,
+        "gif_bytes": output_bytes("gif"),
+        "mp4_bytes": output_bytes("mp4"),
+    }
+    if report is not None and report.get("mp4", {}).get("error"):
+        result["mp4_error"] = report["mp4"]["error"].splitlines()[0]
+    return result
+
+
+def compare_to_baseline(results, baseline, tolerance, min_ms):
+    """
+    (case, metric, baseline, current) of every metric more than tolerance
+    worse than the baseline; timings within min_ms are treated as noise
+    """
+
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        for key, _ in SUITE_METRICS:
+            before = expected.get(key)
+            after = result.get(key)
+            if not before or after is None:
+                continue
+            if key.endswith("_ms") and after - before < min_ms:
+                continue
+            if after > before * (1.0 + tolerance):
+                regressions.append((name, key, before, after))
+    return regressions
+
+
+def bench_suite(args):
+    results = {}
+    startup, _, modules = measure_startup(args.startup_runs)
+    results[STARTUP_CASE] = {
+        "startup_ms": startup * 1000.0,
+        "record_import_ms": modules.get("record", (0, 0))[1] / 1000.0,
+    }
+    print(f"{STARTUP_CASE}: {results[STARTUP_CASE]['startup_ms']:.1f}ms "
+          f"(import record {results[STARTUP_CASE]['record_import_ms']:.1f}ms)")
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # first-use costs (imports, lookup tables, allocator) stay out of the first case
+        os.makedirs(f"{tmpdir}/warmup")
+        run_suite_case(f"{tmpdir}/warmup", (256, 192), 0, 8, "raw", argparse.Namespace(**dict(vars(args), saves=2)))
+
+        for name, size, layers, depth, compression in suite_cases(args):
+            session_dir = f"{tmpdir}/{name}"
+            os.makedirs(session_dir)
+            result = run_suite_case(session_dir, size, layers, depth, compression, args)
+            results[name] = result
+
+            def ms(key):
+                return "-" if result[key] is None else f"{result[key]:.1f}ms"
+
+            def mib(key):
+                return "-" if result[key] is None else f"{result[key] / 1024 ** 2:.2f}MiB"
+
+            print(f"{name}: psd {result['psd_bytes'] / 1024 ** 2:.1f}MiB, {result['frames']} frames")
+            print(f"  capture {ms('capture_tick_ms')} (p95 {ms('capture_tick_p95_ms')}), "
+                  f"detect {ms('detect_changed_ms')} / idle {ms('detect_idle_ms')}, "
+                  f"peak {result['capture_peak_mib']:.1f}MiB")
+            print(f"  export decode {ms('export_decode_ms')}, gif {ms('export_gif_ms')}, mp4 {ms('export_mp4_ms')} "
+                  f"per frame, peak {result['export_peak_mib']:.1f}MiB, "
+                  f"gif {mib('gif_bytes')}, mp4 {mib('mp4_bytes')}")
+            if result.get("mp4_error"):
+                print(f"  [WARNING] mp4 skipped: {result['mp4_error']}")
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as fp:
+            json.dump({
+                "machine": f"{platform.platform()} / {platform.processor() or platform.machine()}",
+                "python": platform.python_version(),
+                "saves": args.saves,
+                "cases": results,
+            }, fp, indent=2, sort_keys=True)
+        print(f"baseline written to {args.baseline}")
+        return
+
+    if not os.path.isfile(args.baseline):
+        # a check without numbers to check against must not pass
+        print(f"[ERROR] no baseline at {args.baseline}, run with --save-baseline to record one")
+        raise SystemExit(1)
+
+    with open(args.baseline) as fp:
+        baseline = json.load(fp)
+    if baseline.get("saves") != args.saves:
+        print(f"[WARNING] baseline was recorded with --saves {baseline.get('saves')}")
+
+    regressions = compare_to_baseline(results, baseline["cases"], args.tolerance, args.min_ms)
+    missing = [name for name in results if name not in baseline["cases"]]
+    if missing:
+        print(f"not in baseline: {', '.join(missing)}")
+    labels = dict(SUITE_METRICS)
+    for name, key, before, after in regressions:
+        print(f"  REGRESSION {name}: {labels[key]} {before:.2f} -> {after:.2f} ({after / before - 1:+.0%})")
+    if regressions:
+        raise SystemExit(1)
+    print(f"no regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command")
+
+    gif_parser = subparsers.add_parser("gif", help="delta gif encoder against imageio")
+    gif_parser.add_argument("--frames", type=int, default=200)
+    gif_parser.add_argument("--width", type=int, default=1024)
+    gif_parser.add_argument("--height", type=int, default=720)
+    gif_parser.add_argument("--framerate", type=int, default=12)
+    gif_parser.set_defaults(func=bench_gif)
+
+    tiles_parser = subparsers.add_parser("tiles", help="tile change detection against imagehash")
+    tiles_parser.add_argument("--size", type=int, default=8192)
+    tiles_parser.add_argument("--stroke", type=int, default=16)
+    tiles_parser.set_defaults(func=bench_tiles)
+
+    delta_parser = subparsers.add_parser("delta", help="delta frame store disk usage and reconstruction")
+    delta_parser.add_argument("--frames", type=int, default=300)
+    delta_parser.add_argument("--width", type=int, default=1024)
+    delta_parser.add_argument("--height", type=int, default=720)
+    delta_parser.add_argument("--keyframe-interval", type=int, default=30)
+    delta_parser.set_defaults(func=bench_delta)
+
+    strips_parser = subparsers.add_parser("strips", help="peak memory of strip-wise decode against full decode")
+    strips_parser.add_argument("--size", type=int, default=10000)
+    strips_parser.add_argument("--width", type=int, default=1024)
+    strips_parser.add_argument("--height", type=int, default=720)
+    strips_parser.add_argument("--compression", default="rle", choices=("raw", "rle", "zip", "zip-prediction"))
+    strips_parser.add_argument("--budget", type=float, default=16.0, help="allowed peak in multiples of the output")
+    strips_parser.add_argument("--skip-full", action="store_true", help="only run the strip decode")
+    strips_parser.set_defaults(func=bench_strips)
+
+    startup_parser = subparsers.add_parser("startup", help="record.py import time with stubbed Qt and COM")
+    startup_parser.add_argument("--runs", type=int, default=5)
+    startup_parser.add_argument("--top", type=int, default=10)
+    startup_parser.add_argument("--max-ms", type=float, default=0, help="fail when importing record takes longer")
+    startup_parser.set_defaults(func=bench_startup)
+
+    photoshop_parser = subparsers.add_parser("photoshop", help="shared Photoshop connection against Dispatch per call")
+    photoshop_parser.add_argument("--calls", type=int, default=200)
+    photoshop_parser.add_argument("--latency-ms", type=float, default=1.0)
+    photoshop_parser.set_defaults(func=bench_photoshop)
+
+    palette_parser = subparsers.add_parser("palette", help="palette drag against blocking color reads and writes")
+    palette_parser.add_argument("--events", type=int, default=400)
+    palette_parser.add_argument("--rate", type=float, default=200.0)
+    palette_parser.add_argument("--latency-ms", type=float, default=2.0)
+    palette_parser.set_defaults(func=bench_palette)
+
+    brush_parser = subparsers.add_parser("brush", help="palette raster brush replaying stroke paths")
+    brush_parser.add_argument("--strokes", type=int, default=300)
+    brush_parser.add_argument("--width", type=int, default=320)
+    brush_parser.add_argument("--height", type=int, default=240)
+    brush_parser.add_argument("--paths", help="strokes saved by PaletteHandler.save_strokes")
+    brush_parser.set_defaults(func=bench_brush)
+
+    sampler_parser = subparsers.add_parser("sampler", help="palette color sampling per event")
+    sampler_parser.add_argument("--samples", type=int, default=20000)
+    sampler_parser.add_argument("--width", type=int, default=320)
+    sampler_parser.add_argument("--height", type=int, default=240)
+    sampler_parser.add_argument("--max-us", type=float, default=0, help="fail when one sample takes longer")
+    sampler_parser.set_defaults(func=bench_sampler)
+
+    suite_parser = subparsers.add_parser("suite", help="simulated editing sessions against a stored baseline")
+    suite_parser.add_argument("--sizes", default="2048x1536", help="comma separated WIDTHxHEIGHT")
+    suite_parser.add_argument("--layers", default="0,4", help="comma separated layer counts")
+    suite_parser.add_argument("--depths", default="8,16", help="comma separated bit depths")
+    suite_parser.add_argument("--compressions", default="raw,rle,zip")
+    suite_parser.add_argument("--saves", type=int, default=10, help="saves per editing session")
+    suite_parser.add_argument("--width", type=int, default=1024)
+    suite_parser.add_argument("--height", type=int, default=720)
+    suite_parser.add_argument("--framerate", type=int, default=12)
+    suite_parser.add_argument("--seed", type=int, default=0)
+    suite_parser.add_argument("--startup-runs", type=int, default=5, help="recorder start ups timed")
+    suite_parser.add_argument("--baseline", default=BASELINE_PATH)
+    suite_parser.add_argument("--save-baseline", action="store_true", help="record the results as the new baseline")
+    suite_parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown or growth")
+    suite_parser.add_argument("--min-ms", type=float, default=1.0, help="ignore timing differences below this")
+    suite_parser.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    if not getattr(args, "func", None):
+        parser.print_help()
+        return
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
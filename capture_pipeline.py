@@ -0,0 +1,475 @@
+"""
+Long-lived snapshot capture pipeline.
+
+    detect -> decode -> tile diff/dedupe -> resize -> write
+
+The resize stage renders every configured output (export frame, archive,
+preview...) from the one decoded image by successive halving.
+
+Each stage runs on its own worker thread and hands frames to the next one
+through a bounded queue, so decoding frame N+1 overlaps with encoding frame N
+while a slow stage still pushes back on the ones in front of it.
+Nothing in here depends on Qt; PSDStoreThreadHolder wires the callbacks to
+its signals.
+
+Every stage reports its latency and frame/byte counters into a Metrics
+registry, see metrics.py.
+"""
+
+import os
+import time
+import queue
+import threading
+
+import numpy as np
+import imagehash
+
+import psd_capture
+import frame_pyramid
+from metrics import Metrics
+from psd_watcher import PSDChangeDetector
+from capture_scheduler import AdaptiveScheduler
+from hash_index import BKTree
+from hash_index import hash_to_int
+from tile_diff import TileChangeDetector
+from tile_diff import checksum_digest
+from delta_store import DeltaFrameWriter
+
+
+# forwarded through every queue to drain and stop the stages
+_STOP = object()
+
+
+class CaptureFrame(object):
+
+    index = None
+    psd_path = None
+    image = None
+    capture_path = None
+    hashcode = None
+    hash_key = None
+    digest = None
+    output_path = None
+    source_mtime = None
+    store_index = None
+    store_offset = None
+
+    # (tiles_y, tiles_x) tiles changed since the previous snapshot; for a
+    # new frame, since dirty_base, the frame stored before it (None when
+    # there is none to diff against). dirty_size is the decoded size.
+    dirty_mask = None
+    dirty_base = None
+    dirty_size = None
+
+    # FrameOutput name -> PIL image
+    renditions = None
+
+    # hash index record of this frame, or of the earlier frame it repeats
+    record = None
+    is_reference = False
+
+    detected_at = 0.0
+    saved_at = 0.0
+
+    def __init__(self, psd_path):
+        self.psd_path = psd_path
+        self.detected_at = time.time()
+
+
+class _StageWorker(threading.Thread):
+
+    def __init__(self, pipeline, name, func, inbox, outbox):
+        super(_StageWorker, self).__init__(name=f"capture-{name}")
+        self.daemon = True
+        self.pipeline = pipeline
+        self.stage = f"capture.{name}"
+        self.func = func
+        self.inbox = inbox
+        self.outbox = outbox
+
+    def run(self):
+        if self.pipeline.profiler is not None:
+            with self.pipeline.profiler.thread(self.name):
+                self.process()
+        else:
+            self.process()
+
+    def process(self):
+        metrics = self.pipeline.metrics
+        while True:
+            item = self.inbox.get()
+            if item is _STOP:
+                break
+
+            try:
+                with metrics.timer(self.stage):
+                    result = self.func(item)
+            except Exception as e:
+                print(f"[ERROR] {self.name}: {e}")
+                metrics.count(f"{self.stage}_errors")
+                result = None
+
+            if result is not None and self.outbox is not None:
+                self.outbox.put(result)
+
+        if self.outbox is not None:
+            self.outbox.put(_STOP)
+
+
+class CapturePipeline(object):
+
+    psd_path = None
+    output_path_format = None
+    override_size = (0, 0)
+    scheduler = None
+
+    # callbacks, all optional
+    on_tick = None
+    on_saved = None
+
+    index = 0
+    saved_count = 0
+    tile_detector = None
+    change_detector = None
+    capture_path_counts = None
+    frame_store = None
+    manifest = None
+    hash_index = None
+    # record of the last new frame, the base of the next one's dirty_mask
+    stored_record = None
+    dedupe_distance = 4
+    outputs = ()
+    decode_size = (0, 0)
+    decode_pool = None
+    reference_count = 0
+    bytes_saved = 0
+    metrics = None
+    profiler = None
+
+    def __init__(self, psd_path, output_path_format, override_size=(0, 0),
+                 scheduler=None, queue_size=2, start_index=0,
+                 on_tick=None, on_saved=None, frame_store=None, manifest=None,
+                 dedupe_distance=4, outputs=(), decode_pool=None, metrics=None, profiler=None):
+        """
+        output_path_format is formatted with the frame index,
+        e.g. "recorder/cached_{index}.png".
+        With a frame_store, frames are appended to it instead of written
+        as image files. Every saved frame is recorded in the manifest if given.
+        Earlier frames within dedupe_distance bits of a frame's hash are
+        candidates it may repeat; it is recorded as a reference only to one
+        with equal tile checksums, i.e. the same pixels.
+        A negative distance turns that off.
+        outputs are extra FrameOutput renditions of every frame; the ones
+        without a path_format are handed to on_saved in frame.renditions,
+        for repeated frames as well.
+        decode_pool is an optional concurrent.futures executor the PSD
+        decode runs on, shared between pipelines watching different files;
+        its size then bounds decode CPU instead of the scheduler budget.
+        Stage timings and counters go to metrics (a fresh Metrics if None);
+        a SessionProfiler given as profiler profiles every stage thread.
+        """
+
+        self.psd_path = psd_path
+        self.output_path_format = output_path_format
+        self.override_size = override_size
+        self.scheduler = scheduler or AdaptiveScheduler()
+        self.index = start_index
+        self.on_tick = on_tick
+        self.on_saved = on_saved
+        self.frame_store = frame_store
+        self.manifest = manifest
+        self.dedupe_distance = dedupe_distance
+        self.outputs = list(outputs)
+        self.decode_pool = decode_pool
+        self.metrics = metrics or Metrics()
+        self.profiler = profiler
+        self.decode_size = frame_pyramid.bounding_size([override_size] + [output.size for output in self.outputs])
+        self.tile_detector = TileChangeDetector()
+        self.hash_index = BKTree()
+        # looked up by the hash stage, added to by the write stage
+        self.hash_index_lock = threading.Lock()
+        if manifest is not None:
+            self.seed_hash_index(manifest)
+
+        self.cancel_event = threading.Event()
+        self.change_detector = PSDChangeDetector(psd_path, stop_event=self.cancel_event)
+        self.capture_path_counts = {path: 0 for path in psd_capture.CAPTURE_PATHS}
+
+        self.decode_queue = queue.Queue(queue_size)
+        self.hash_queue = queue.Queue(queue_size)
+        self.resize_queue = queue.Queue(queue_size)
+        self.write_queue = queue.Queue(queue_size)
+
+        self.detect_worker = threading.Thread(target=self.detect_loop, name="capture-detect")
+        self.detect_worker.daemon = True
+        self.workers = [
+            self.detect_worker,
+            _StageWorker(self, "decode", self.decode, self.decode_queue, self.hash_queue),
+            _StageWorker(self, "hash", self.dedupe, self.hash_queue, self.resize_queue),
+            _StageWorker(self, "resize", self.resize, self.resize_queue, self.write_queue),
+            _StageWorker(self, "write", self.write, self.write_queue, None),
+        ]
+
+    @property
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
+
+    def start(self):
+        self.change_detector.start()
+        for worker in self.workers:
+            worker.start()
+
+    def cancel(self, e=None):
+        # stops detection right away; frames already in flight are still written
+        self.change_detector.interrupt()
+
+    def join(self, timeout=None):
+        for worker in self.workers:
+            worker.join(timeout)
+        self.change_detector.stop()
+
+    def detect_loop(self):
+        try:
+            while not self.is_cancelled:
+                if self.on_tick:
+                    self.on_tick()
+
+                interval = self.scheduler.next_interval()
+                self.metrics.gauge("poll_interval_seconds", interval)
+                self.metrics.gauge("decode_duty_cycle", self.scheduler.duty_cycle)
+                self.change_detector.wait(interval)
+                if self.is_cancelled:
+                    break
+
+                # skip the stat entirely while the decoder is still busy
+                if self.decode_queue.full():
+                    self.metrics.count("frames_skipped_busy")
+                    continue
+
+                self.metrics.count("change_checks")
+                if not self.change_detector.has_changed():
+                    # fingerprint unchanged, decode skipped
+                    self.metrics.count("change_checks_unchanged")
+                    self.scheduler.on_idle()
+                    continue
+
+                self.scheduler.on_change()
+                frame = CaptureFrame(self.psd_path)
+                # a failed decode may invalidate the fingerprint meanwhile
+                fingerprint = self.change_detector.last_fingerprint
+                if fingerprint is not None:
+                    frame.source_mtime = fingerprint.mtime_ns / 1e9
+                self.decode_queue.put(frame)
+        finally:
+            # the other stages drain and stop on it, whatever happened here
+            self.decode_queue.put(_STOP)
+
+    def decode(self, frame):
+        try:
+            with self.scheduler.measure_decode():
+                if self.decode_pool is not None:
+                    future = self.decode_pool.submit(psd_capture.capture, frame.psd_path, self.decode_size)
+                    frame.image, frame.capture_path = future.result()
+                else:
+                    frame.image, frame.capture_path = psd_capture.capture(frame.psd_path, self.decode_size)
+        except Exception as e:
+            print(f"[ERROR] {e}")
+
+        if not frame.image:
+            print("[ERROR] Can't load psd image")
+
+            # hard reset, file was probably caught mid-save
+            self.tile_detector.reset()
+            self.change_detector.invalidate()
+            self.metrics.count("frames_decode_failed")
+            return None
+
+        self.capture_path_counts[frame.capture_path] += 1
+        try:
+            # upper bound: the thumbnail and strip paths read less
+            self.metrics.count("bytes_read", os.path.getsize(frame.psd_path))
+        except OSError:
+            pass
+        return frame
+
+    def seed_hash_index(self, manifest):
+        # earlier recordings of this session can be referenced as well
+        for entry in manifest.entries:
+            # frames recorded without a digest can't be confirmed
+            if entry.get("hash") and entry.get("digest") and entry.get("ref") is None:
+                record = {
+                    "index": entry["index"],
+                    "digest": entry["digest"],
+                    "output_path": manifest.abspath(entry),
+                    "store_index": entry.get("store_index"),
+                    "store_offset": entry.get("offset"),
+                    "width": entry["width"],
+                    "height": entry["height"],
+                    "nbytes": None,
+                }
+                self.hash_index.add(hash_to_int(entry["hash"]), record)
+
+    def dedupe(self, frame):
+        frame.dirty_mask = self.tile_detector.update(np.asarray(frame.image))
+        if not frame.dirty_mask.any():
+            self.metrics.count("frames_skipped_unchanged")
+            return None
+
+        checksums = self.tile_detector.latest
+        frame.hashcode = imagehash.average_hash(frame.image, hash_size=32)
+        frame.digest = checksum_digest(checksums)
+        frame.index = self.index
+        self.index += 1
+
+        key = hash_to_int(frame.hashcode)
+        if self.dedupe_distance >= 0:
+            with self.hash_index_lock:
+                candidates = self.hash_index.within(key, self.dedupe_distance)
+            for _, record in candidates:
+                if record["digest"] != frame.digest:
+                    continue
+                # frames of this recording keep their checksums: any tile
+                # dirty against the record vetoes the reference
+                tiles = record.get("tiles")
+                if tiles is not None and (tiles.shape != checksums.shape or (tiles != checksums).any()):
+                    continue
+
+                # reverted to an earlier canvas state
+                frame.record = record
+                frame.is_reference = True
+                return frame
+
+        if self.frame_store is None:
+            frame.output_path = self.output_path_format.format(index=frame.index)
+        frame.record = {
+            "index": frame.index,
+            "output_path": frame.output_path,
+            "digest": frame.digest,
+            "tiles": checksums,
+        }
+        # indexed by write() once the frame is actually stored
+        frame.hash_key = key
+
+        # references in between don't reach the store: diff against the
+        # last new frame, which is what a delta store holds last
+        previous = self.stored_record
+        if previous is not None and previous["tiles"].shape == checksums.shape:
+            frame.dirty_mask = previous["tiles"] != checksums
+            frame.dirty_base = previous["index"]
+        else:
+            frame.dirty_mask = np.ones(checksums.shape, dtype=bool)
+        frame.dirty_size = frame.image.size
+        self.stored_record = frame.record
+        return frame
+
+    def resize(self, frame):
+        outputs = self.outputs
+        sizes = [output.size for output in outputs]
+        if frame.is_reference:
+            # already stored, only the in-memory renditions are needed
+            outputs = [output for output in outputs if output.path_format is None]
+            sizes = [output.size for output in outputs]
+        else:
+            sizes.append(self.override_size)
+
+        renditions = frame_pyramid.render(frame.image, sizes)
+        frame.renditions = {output.name: renditions[output.size] for output in outputs}
+        frame.image = None if frame.is_reference else renditions[self.override_size]
+        return frame
+
+    def write(self, frame):
+        record = frame.record
+        if frame.is_reference:
+            frame.output_path = record["output_path"]
+            frame.store_index = record.get("store_index")
+            frame.store_offset = record.get("store_offset")
+            width, height = record["width"], record["height"]
+
+            if record.get("nbytes") is None and frame.store_index is None and os.path.isfile(frame.output_path):
+                record["nbytes"] = os.path.getsize(frame.output_path)
+            self.reference_count += 1
+            self.bytes_saved += record.get("nbytes") or 0
+            self.metrics.count("bytes_saved", record.get("nbytes") or 0)
+            self.metrics.count("frames_repeated")
+        else:
+            width, height = frame.image.size
+            if self.frame_store is not None:
+                frame.store_index = self.append_to_store(frame)
+                frame.store_offset = self.frame_store.last_offset
+                frame.output_path = self.frame_store.path
+                record["nbytes"] = self.frame_store.last_length
+            else:
+                frame.image.save(frame.output_path)
+                record["nbytes"] = os.path.getsize(frame.output_path)
+            self.metrics.count("bytes_written", record["nbytes"])
+            self.metrics.count("frames_saved")
+            self.write_renditions(frame)
+            record.update({
+                "output_path": frame.output_path,
+                "store_index": frame.store_index,
+                "store_offset": frame.store_offset,
+                "width": width,
+                "height": height,
+            })
+            with self.hash_index_lock:
+                self.hash_index.add(frame.hash_key, record)
+        frame.image = None
+        frame.saved_at = time.time()
+        self.saved_count += 1
+
+        if self.manifest is not None:
+            self.manifest.append(
+                frame.index,
+                frame.saved_at,
+                width,
+                height,
+                frame.output_path,
+                source_mtime=frame.source_mtime,
+                hashcode=frame.hashcode,
+                digest=frame.digest,
+                offset=frame.store_offset,
+                store_index=frame.store_index,
+                capture_path=frame.capture_path,
+                ref=record["index"] if frame.is_reference else None
+            )
+
+        if frame.is_reference:
+            print(f"Snapshot! (same as frame {record['index']})")
+        else:
+            print(f"Snapshot! ({frame.capture_path})")
+        if self.on_saved:
+            self.on_saved(frame)
+        frame.renditions = None
+        return frame
+
+    def append_to_store(self, frame):
+        arr = np.asarray(frame.image)
+        if isinstance(self.frame_store, DeltaFrameWriter):
+            # crops the delta from the tiles dedupe already diffed
+            return self.frame_store.append_changed(
+                arr, frame.dirty_mask, frame.dirty_size,
+                self.tile_detector.tile_size, frame.dirty_base, frame.index
+            )
+        return self.frame_store.append(arr)
+
+    def write_renditions(self, frame):
+        for output in self.outputs:
+            if output.path_format is None or output.name not in frame.renditions:
+                continue
+            path = output.path_format.format(index=frame.index)
+            dirpath = os.path.dirname(path)
+            if dirpath and not os.path.isdir(dirpath):
+                os.makedirs(dirpath, exist_ok=True)
+            frame.renditions.pop(output.name).save(path)
+            self.metrics.count("bytes_written", os.path.getsize(path))
+
+    def stats(self):
+        return {
+            "saved": self.saved_count,
+            "references": self.reference_count,
+            "bytes_saved": self.bytes_saved,
+            "change_detection": self.change_detector.stats(),
+            "capture_paths": dict(self.capture_path_counts),
+            "scheduler": self.scheduler.metrics(),
+            "metrics": self.metrics.snapshot(),
+        }
@@ -0,0 +1,107 @@
+"""
+Adaptive polling interval for the capture loop.
+
+The interval backs off exponentially while the PSD stays untouched and drops
+back to the fast cadence as soon as a change shows up. On top of that the
+interval is stretched whenever decoding would use more than cpu_budget of one
+core over the measurement window.
+"""
+
+import time
+import threading
+from collections import deque
+
+
+# cpu time of the calling thread when the platform supports it
+_thread_clock = getattr(time, "thread_time", time.perf_counter)
+
+
+class AdaptiveScheduler(object):
+
+    min_interval = 1.50
+    max_interval = 20.0
+    backoff = 1.5
+    cpu_budget = 0.25
+    window = 60.0
+
+    current_interval = 1.50
+
+    def __init__(self, min_interval=1.50, max_interval=20.0, backoff=1.5,
+                 cpu_budget=0.25, window=60.0):
+        """
+        cpu_budget is the fraction of one core decoding may use, e.g. 0.25
+        """
+
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.backoff = backoff
+        self.cpu_budget = cpu_budget
+        self.window = window
+        self.current_interval = min_interval
+
+        self.lock = threading.Lock()
+        # (finished_at, cpu seconds)
+        self.decodes = deque()
+        self.last_decode_cost = 0.0
+
+    def on_idle(self):
+        with self.lock:
+            self.current_interval = min(self.current_interval * self.backoff, self.max_interval)
+
+    def on_change(self):
+        with self.lock:
+            self.current_interval = self.min_interval
+
+    def measure_decode(self):
+        return _DecodeTimer(self)
+
+    def record_decode(self, cpu_seconds):
+        with self.lock:
+            self.last_decode_cost = cpu_seconds
+            self.decodes.append((time.monotonic(), cpu_seconds))
+            self._trim()
+
+    def _trim(self):
+        limit = time.monotonic() - self.window
+        while self.decodes and self.decodes[0][0] < limit:
+            self.decodes.popleft()
+
+    @property
+    def duty_cycle(self):
+        with self.lock:
+            self._trim()
+            return sum(cost for _, cost in self.decodes) / self.window
+
+    def next_interval(self):
+        """
+        Interval to sleep before the next check, with the cpu budget applied
+        """
+
+        with self.lock:
+            interval = self.current_interval
+            if self.cpu_budget > 0 and self.last_decode_cost > 0:
+                # decode / (decode + sleep) <= budget
+                budget_interval = self.last_decode_cost * (1.0 - self.cpu_budget) / self.cpu_budget
+                interval = max(interval, budget_interval)
+        return interval
+
+    def metrics(self):
+        return {
+            "interval": self.next_interval(),
+            "decode_duty_cycle": self.duty_cycle,
+            "cpu_budget": self.cpu_budget,
+        }
+
+
+class _DecodeTimer(object):
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    def __enter__(self):
+        self.started = _thread_clock()
+        return self
+
+    def __exit__(self, *args):
+        self.scheduler.record_decode(_thread_clock() - self.started)
+        return False
@@ -0,0 +1,211 @@
+"""
+Delta-encoded frames on top of the frame store.
+
+Every keyframe_interval-th frame is stored whole; frames in between only
+store the tiles that changed since the previous frame. Reading frame i
+starts from the closest reconstructed frame at or after its keyframe (a
+small LRU cache keeps recent reconstructions around) and applies the tile
+deltas up to i.
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+from frame_store import KIND_FULL
+from frame_store import KIND_TILES
+from frame_store import available_codec
+from tile_diff import TileChangeDetector
+from tile_diff import DEFAULT_TILE_SIZE
+from tile_diff import rescale_mask
+
+
+DEFAULT_KEYFRAME_INTERVAL = 30
+
+# above this share of dirty tiles a keyframe is cheaper to read back
+MAX_DELTA_FRACTION = 0.5
+
+MAX_TILE_COUNT = 0xFFFF
+
+
+def _as_3d(arr):
+    return arr[:, :, None] if arr.ndim == 2 else arr
+
+
+def split_tiles(arr, tile_size):
+    """
+    (tiles_y, tiles_x, tile, tile, c) view of arr, padded when its size is
+    not a multiple of the tile size
+    """
+
+    arr = _as_3d(arr)
+    h, w, c = arr.shape
+    tiles_y = -(-h // tile_size)
+    tiles_x = -(-w // tile_size)
+    if h % tile_size or w % tile_size:
+        padded = np.zeros((tiles_y * tile_size, tiles_x * tile_size, c), dtype=np.uint8)
+        padded[:h, :w] = arr
+        arr = padded
+    return arr.reshape(tiles_y, tile_size, tiles_x, tile_size, c).swapaxes(1, 2)
+
+
+def apply_tiles(frame, coords, tiles):
+    """
+    Writes tiles into frame (h, w, c) in place, clipping at the edges
+    """
+
+    h, w = frame.shape[:2]
+    tile = tiles.shape[1]
+    for (ty, tx), pixels in zip(coords, tiles):
+        top = int(ty) * tile
+        left = int(tx) * tile
+        bottom = min(top + tile, h)
+        right = min(left + tile, w)
+        frame[top:bottom, left:right] = pixels[:bottom - top, :right - left]
+
+
+class DeltaFrameWriter(object):
+    """
+    Appends frames to a FrameStore as keyframes or tile deltas.
+    Exposes the same append/last_offset/last_length/path as FrameStore.
+    The capture pipeline hands in the dirty tiles it already computed
+    (append_changed); plain append checksums the frame itself.
+    """
+
+    store = None
+    keyframe_interval = DEFAULT_KEYFRAME_INTERVAL
+    tile_size = DEFAULT_TILE_SIZE
+
+    keyframes = 0
+    deltas = 0
+
+    def __init__(self, store, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL, tile_size=DEFAULT_TILE_SIZE,
+                 keyframe_codec="lz4"):
+        self.store = store
+        self.keyframe_codec = available_codec(keyframe_codec)
+        self.keyframe_interval = keyframe_interval
+        self.tile_size = tile_size
+        self.detector = TileChangeDetector(tile_size)
+        self.since_keyframe = 0
+        # caller key of the last append_changed frame
+        self.last_key = None
+
+    @property
+    def path(self):
+        return self.store.path
+
+    @property
+    def last_offset(self):
+        return self.store.last_offset
+
+    @property
+    def last_length(self):
+        return self.store.last_length
+
+    def __len__(self):
+        return len(self.store)
+
+    def append(self, arr):
+        arr = _as_3d(np.asarray(arr, dtype=np.uint8))
+        self.last_key = None
+        return self._append(arr, self.detector.update(arr))
+
+    def append_changed(self, arr, dirty_mask, dirty_size, dirty_tile_size, base, key):
+        """
+        Appends arr given the tiles that changed since the frame appended
+        with key base, computed on a dirty_size image; key names this frame
+        for the next call. Without a mask, or when base is not the last
+        frame appended, the frame becomes a keyframe.
+        """
+
+        arr = _as_3d(np.asarray(arr, dtype=np.uint8))
+        size = (arr.shape[1], arr.shape[0])
+        # a later plain append has nothing to diff against
+        self.detector.reset()
+        if dirty_mask is None or base is None or base != self.last_key:
+            mask = np.ones((-(-size[1] // self.tile_size), -(-size[0] // self.tile_size)), dtype=bool)
+        else:
+            mask = rescale_mask(dirty_mask, dirty_tile_size, dirty_size, size, self.tile_size)
+        self.last_key = None
+        index = self._append(arr, mask)
+        self.last_key = key
+        return index
+
+    def _append(self, arr, mask):
+        is_keyframe = (
+            self.since_keyframe == 0 or
+            self.since_keyframe >= self.keyframe_interval or
+            mask.all() or
+            mask.mean() > MAX_DELTA_FRACTION or
+            mask.sum() > MAX_TILE_COUNT
+        )
+        if is_keyframe:
+            index = self.store.append(arr, self.keyframe_codec)
+            self.since_keyframe = 1
+            self.keyframes += 1
+            return index
+
+        coords = np.argwhere(mask)
+        tiles = split_tiles(arr, self.tile_size)[mask]
+        index = self.store.append_tiles(
+            (arr.shape[1], arr.shape[0]), arr.shape[2], self.tile_size, coords, tiles
+        )
+        self.since_keyframe += 1
+        self.deltas += 1
+        return index
+
+
+class DeltaFrameReader(object):
+
+    store = None
+    cache_size = 8
+
+    def __init__(self, store, cache_size=8):
+        self.store = store
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def keyframe_of(self, i):
+        kinds = self.store.index["kind"][:i + 1]
+        keyframes = np.flatnonzero(kinds == KIND_FULL)
+        if len(keyframes) == 0:
+            raise ValueError(f"Frame {i} has no keyframe")
+        return int(keyframes[-1])
+
+    def __getitem__(self, i):
+        """
+        Frame i as a writable numpy array
+        """
+
+        self.store.refresh()
+        if i < 0:
+            i += len(self.store.index)
+
+        cached = self.cache.get(i)
+        if cached is not None:
+            self.cache.move_to_end(i)
+            return self._output(i, cached)
+
+        keyframe = self.keyframe_of(i)
+        start = max((j for j in self.cache if keyframe <= j < i), default=None)
+        if start is None:
+            frame = _as_3d(np.array(self.store.read_full(keyframe)))
+            start = keyframe
+        else:
+            frame = self.cache[start].copy()
+
+        for j in range(start + 1, i + 1):
+            if self.store.index[j]["kind"] == KIND_TILES:
+                apply_tiles(frame, *self.store.read_tiles(j))
+            else:
+                frame = _as_3d(np.array(self.store.read_full(j)))
+
+        self.cache[i] = frame
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return self._output(i, frame)
+
+    def _output(self, i, frame):
+        if self.store.index[i]["channels"] == 1:
+            return frame[:, :, 0].copy()
+        return frame.copy()
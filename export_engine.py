@@ -0,0 +1,152 @@
+"""
+Single-decode, multi-output export.
+
+ExportEngine pulls each normalized frame once and fans it out to every sink.
+Each sink encodes on its own thread behind a bounded queue, so GIF and MP4
+(and whatever comes later) encode at the same time and the slowest sink
+throttles decoding instead of letting frames pile up in memory.
+With a Metrics registry, per-frame decode and encode latencies are recorded
+as the "export.decode" and "export.<sink>" stages.
+"""
+
+import time
+import queue
+import threading
+
+
+_STOP = object()
+
+
+class ExportSink(threading.Thread):
+
+    # report key; Thread.name stays the thread's own
+    sink_name = None
+    open_writer = None
+
+    elapsed = 0.0
+    busy = 0.0
+    frame_count = 0
+    error = None
+    metrics = None
+    profiler = None
+
+    def __init__(self, sink_name, open_writer, queue_size=8):
+        """
+        open_writer returns an object with append_data(frame) and close(),
+        e.g. an imageio writer
+        """
+
+        super(ExportSink, self).__init__(name=f"export-{sink_name}")
+        self.daemon = True
+        self.sink_name = sink_name
+        self.open_writer = open_writer
+        self.frames = queue.Queue(queue_size)
+
+    def put(self, frame):
+        self.frames.put(frame)
+
+    def finish(self):
+        self.frames.put(_STOP)
+
+    def run(self):
+        if self.profiler is not None:
+            with self.profiler.thread(self.name):
+                self.encode()
+        else:
+            self.encode()
+
+    def encode(self):
+        started = time.perf_counter()
+        writer = None
+        try:
+            writer = self.open_writer()
+            while True:
+                frame = self.frames.get()
+                if frame is _STOP:
+                    break
+
+                append_started = time.perf_counter()
+                writer.append_data(frame)
+                append_elapsed = time.perf_counter() - append_started
+                self.busy += append_elapsed
+                self.frame_count += 1
+                if self.metrics is not None:
+                    self.metrics.observe(f"export.{self.sink_name}", append_elapsed)
+
+        except Exception as e:
+            print(f"[ERROR] {self.sink_name} export failed: {e}")
+            self.error = e
+            # keep draining so the producer never blocks on a dead sink
+            while self.frames.get() is not _STOP:
+                pass
+
+        finally:
+            if writer is not None:
+                try:
+                    writer.close()
+                except Exception as e:
+                    print(f"[ERROR] {self.sink_name} close failed: {e}")
+                    self.error = self.error or e
+            self.elapsed = time.perf_counter() - started
+
+    def report(self):
+        return {
+            "frames": self.frame_count,
+            "elapsed": self.elapsed,
+            "busy": self.busy,
+            "error": str(self.error) if self.error else None,
+        }
+
+
+class ExportEngine(object):
+
+    sinks = None
+    decode_elapsed = 0.0
+    elapsed = 0.0
+    metrics = None
+
+    def __init__(self, sinks, metrics=None, profiler=None):
+        self.sinks = list(sinks)
+        self.metrics = metrics
+        for sink in self.sinks:
+            sink.metrics = metrics
+            sink.profiler = profiler
+
+    def run(self, frames):
+        """
+        Feeds every frame to every sink, returns per-sink timings
+        """
+
+        started = time.perf_counter()
+        for sink in self.sinks:
+            sink.start()
+
+        try:
+            frames = iter(frames)
+            while True:
+                decode_started = time.perf_counter()
+                try:
+                    frame = next(frames)
+                except StopIteration:
+                    break
+                decode_elapsed = time.perf_counter() - decode_started
+                self.decode_elapsed += decode_elapsed
+                if self.metrics is not None:
+                    self.metrics.observe("export.decode", decode_elapsed)
+
+                for sink in self.sinks:
+                    sink.put(frame)
+        finally:
+            for sink in self.sinks:
+                sink.finish()
+            for sink in self.sinks:
+                sink.join()
+
+        self.elapsed = time.perf_counter() - started
+        return self.report()
+
+    def report(self):
+        report = {sink.sink_name: sink.report() for sink in self.sinks}
+        report["decode"] = {"elapsed": self.decode_elapsed}
+        report["total"] = {"elapsed": self.elapsed}
+        return report
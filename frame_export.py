@@ -0,0 +1,404 @@
+"""
+Streaming GIF/MP4 export of recorded snapshots.
+
+Frames are opened, normalized to the export size and handed to the encoders
+one at a time through imageio writers, so peak memory does not grow with the
+length of the session. The MP4 is encoded in cached segments by default,
+see mp4_segments.
+"""
+
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+import numpy as np
+import imageio
+from PIL import Image
+
+import gif_encoder
+import frame_store
+import mp4_segments
+from session_manifest import SessionManifest
+from export_engine import ExportSink
+from export_engine import ExportEngine
+
+
+# number of extra frames holding the final image at the end of the animation
+HOLD_LAST_FRAMES = 20
+
+BACKGROUND_COLOR = (255, 255, 255)
+
+
+def sort_key(path):
+    base = os.path.basename(path)
+    basename = os.path.splitext(base)[0]
+    numbering = basename.split('_')[-1]
+    if numbering.isdigit():
+        return int(numbering)
+    return -1
+
+
+def list_frame_files(target_dir, target_file_type):
+    target_files = [f"{target_dir}/{x}" for x in os.listdir(target_dir)]
+    target_files = [x for x in target_files if x.endswith(f".{target_file_type}")]
+    target_files.sort(key=sort_key)
+    return target_files
+
+
+def list_frame_sources(target_dir, target_file_type, start_time=None, end_time=None):
+    """
+    Frames of a session in order. The session manifest is used when there is
+    one, and can narrow the export down to a capture time range. Older
+    sessions fall back to the frame store or a directory scan.
+    """
+
+    if SessionManifest.exists(target_dir):
+        manifest = SessionManifest.for_session(target_dir)
+        sources = []
+        for entry in manifest.select(start_time, end_time):
+            path = manifest.abspath(entry)
+            if entry["store_index"] is not None:
+                sources.append(frame_store.StoreFrameRef(path, entry["store_index"]))
+            elif os.path.isfile(path):
+                sources.append(path)
+        return sources
+
+    store_path = f"{target_dir}/{frame_store.STORE_FILENAME}"
+    if frame_store.FrameStore.exists(store_path):
+        store = frame_store.FrameStore(store_path, readonly=True)
+        count = len(store)
+        store.close()
+        return [frame_store.StoreFrameRef(store_path, i) for i in range(count)]
+    return list_frame_files(target_dir, target_file_type)
+
+
+def backfill_manifest(manifest, target_dir, target_file_type):
+    """
+    Records the frames of a session captured before it had a manifest
+    """
+
+    for i, source in enumerate(list_frame_sources(target_dir, target_file_type)):
+        width, height = source_size(source)
+        if isinstance(source, frame_store.StoreFrameRef):
+            captured_at = os.path.getmtime(source.store_path)
+            manifest.append(i, captured_at, width, height, source.store_path, store_index=source.index)
+        else:
+            manifest.append(sort_key(source), os.path.getmtime(source), width, height, source)
+
+
+def open_session_manifest(target_dir, target_file_type):
+    """
+    Manifest of a session directory, created if needed; frames recorded
+    before the session had one are backfilled first
+    """
+
+    os.makedirs(target_dir, exist_ok=True)
+    manifest = SessionManifest.for_session(target_dir)
+    if not len(manifest):
+        backfill_manifest(manifest, target_dir, target_file_type)
+    return manifest
+
+
+def open_source(source):
+    if isinstance(source, frame_store.StoreFrameRef):
+        return Image.fromarray(frame_store.resolve(source))
+    return Image.open(source)
+
+
+def source_size(source):
+    if isinstance(source, frame_store.StoreFrameRef):
+        return frame_store.ref_size(source)
+    with Image.open(source) as img:
+        return img.size
+
+
+def fit_ratio(size, target_width, target_height):
+    if target_width == 0 and target_height == 0:
+        return 1.0
+    ratios = []
+    if target_width != 0:
+        ratios.append(target_width / size[0])
+    if target_height != 0:
+        ratios.append(target_height / size[1])
+    return min(ratios)
+
+
+def export_size(target_files, target_width, target_height):
+    """
+    Common frame size for the export, reading only the image headers
+    or the frame store index
+    """
+
+    max_width = 0
+    max_height = 0
+    for target_file in target_files:
+        width, height = source_size(target_file)
+        max_width = max(max_width, width)
+        max_height = max(max_height, height)
+    return fitted_size((max_width, max_height), target_width, target_height)
+
+
+def fitted_size(max_size, target_width, target_height):
+    """
+    Export size for frames at most max_size (w, h)
+    """
+
+    target_ratio = fit_ratio(max_size, target_width, target_height)
+    return (int(max_size[0] * target_ratio), int(max_size[1] * target_ratio))
+
+
+def normalize_frame(img, size):
+    """
+    Fits img into size keeping its aspect ratio, letterboxed on a white canvas
+    """
+
+    if img.mode in ("RGBA", "LA", "P"):
+        img = img.convert("RGBA")
+        baseimg = Image.new("RGB", img.size, BACKGROUND_COLOR)
+        baseimg.paste(img, (0, 0), img)
+        img = baseimg
+    elif img.mode != "RGB":
+        img = img.convert("RGB")
+
+    if img.size == size:
+        return img
+
+    ratio = fit_ratio(img.size, size[0], size[1])
+    resized_size = (max(1, int(img.size[0] * ratio)), max(1, int(img.size[1] * ratio)))
+    if resized_size != img.size:
+        img = img.resize(resized_size, Image.BICUBIC)
+
+    if img.size == size:
+        return img
+
+    baseimg = Image.new("RGB", size, BACKGROUND_COLOR)
+    left = (size[0] - img.size[0]) // 2
+    top = (size[1] - img.size[1]) // 2
+    baseimg.paste(img, (left, top))
+    return baseimg
+
+
+def load_normalized(target_file, size):
+    with open_source(target_file) as img:
+        return np.asarray(normalize_frame(img, size))
+
+
+# shared memory ring the pool workers write normalized frames into
+_worker_ring = None
+
+
+def _init_worker(shm_name, shape):
+    global _worker_ring
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_ring = (shm, np.ndarray(shape, dtype=np.uint8, buffer=shm.buf))
+
+
+def _normalize_into_slot(target_file, size, slot):
+    arr = load_normalized(target_file, size)
+    if _worker_ring is None:
+        # no shared memory on this python; hand back raw pixels
+        return arr.tobytes()
+    _worker_ring[1][slot] = arr
+    return None
+
+
+def _iter_normalized_parallel(target_files, size, workers):
+    """
+    Normalizes frames on a process pool, yielding them in order.
+    Results come back through a shared memory ring instead of being pickled.
+    """
+
+    slots = workers * 2
+    shape = (slots, size[1], size[0], 3)
+    shm = None
+    initializer = None
+    initargs = ()
+    if shared_memory is not None:
+        shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+        ring = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        initializer = _init_worker
+        initargs = (shm.name, shape)
+
+    try:
+        with ProcessPoolExecutor(workers, initializer=initializer, initargs=initargs) as pool:
+            pending = deque()
+            next_index = 0
+            while pending or next_index < len(target_files):
+                # a slot is only reused after its previous frame was handed out
+                while next_index < len(target_files) and len(pending) < slots:
+                    slot = next_index % slots
+                    future = pool.submit(_normalize_into_slot, target_files[next_index], size, slot)
+                    pending.append((future, slot))
+                    next_index += 1
+
+                future, slot = pending.popleft()
+                raw = future.result()
+                if raw is None:
+                    yield ring[slot].copy()
+                else:
+                    yield np.frombuffer(raw, dtype=np.uint8).reshape(shape[1:])
+    finally:
+        if shm is not None:
+            del ring
+            shm.close()
+            shm.unlink()
+
+
+def iter_frames(target_files, size, hold_last=HOLD_LAST_FRAMES, workers=1, on_progress=None):
+    """
+    Yields normalized frames as numpy arrays in file order.
+    With workers > 1 frames are normalized ahead on a process pool.
+    on_progress(done, count) replaces the per-frame progress print.
+    """
+
+    if workers > 1:
+        normalized = _iter_normalized_parallel(target_files, size, workers)
+    else:
+        normalized = (load_normalized(target_file, size) for target_file in target_files)
+
+    arr = None
+    count = len(target_files)
+    for i, arr in enumerate(normalized):
+        if on_progress:
+            on_progress(i + 1, count)
+        else:
+            print(f"Encoding: {i + 1} / {count}..")
+        yield arr
+
+    # hold the final image; the same array is yielded again, never copied
+    if arr is not None:
+        for _ in range(hold_last):
+            yield arr
+
+
+def open_gif_writer(path, framerate):
+    return imageio.get_writer(path, mode="I", fps=framerate, loop=0)
+
+
+def open_mp4_writer(path, framerate):
+    return imageio.get_writer(path, fps=framerate)
+
+
+def sample_palette(target_files, size, samples=16):
+    """
+    Global GIF palette from evenly spaced frames across the session
+    """
+
+    histogram = gif_encoder.ColorHistogram()
+    step = max(1, len(target_files) // samples)
+    sampled = target_files[::step]
+    if target_files[-1] not in sampled:
+        sampled.append(target_files[-1])
+    for target_file in sampled:
+        histogram.add(load_normalized(target_file, size))
+    return histogram.palette()
+
+
+def default_sinks(target_dir, framerate, palette=None, metrics=None, mp4=True):
+    """
+    GIF and MP4 sinks; with a palette the GIF uses the delta encoder.
+    mp4=False leaves the MP4 to the segmented export.
+    """
+
+    gif_path = f"{target_dir}/dst.gif"
+    if palette is not None:
+        open_gif = lambda: gif_encoder.DeltaGifWriter(gif_path, palette, framerate, metrics=metrics)
+    else:
+        open_gif = lambda: open_gif_writer(gif_path, framerate)
+
+    sinks = [ExportSink("gif", open_gif)]
+    if mp4:
+        sinks.append(ExportSink("mp4", lambda: open_mp4_writer(f"{target_dir}/dst.mp4", framerate)))
+    return sinks
+
+
+def export(target_files, size, sinks, workers=1, on_progress=None, metrics=None, profiler=None):
+    """
+    Decodes every frame once and encodes it to all sinks in parallel
+    """
+
+    frames = iter_frames(target_files, size, workers=workers, on_progress=on_progress)
+    report = ExportEngine(sinks, metrics, profiler).run(frames)
+    for name, timing in report.items():
+        print(f"{name}: {timing['elapsed']:.2f}s")
+    return report
+
+
+def export_session(target_dir, target_file_type, target_width, target_height, framerate,
+                   workers=1, gif_mode="delta", time_range=(None, None), on_progress=None,
+                   metrics=None, profiler=None, mp4_mode="segments"):
+    """
+    Exports dst.gif and dst.mp4 of a recorded session directory.
+    Returns the export report, None when there was nothing to export.
+    workers is the process budget of the whole export.
+    metrics and profiler are an optional Metrics and SessionProfiler.
+    mp4_mode "segments" encodes the MP4 in cached segments next to the GIF
+    (see mp4_segments), "stream" feeds it frame by frame like the GIF.
+    """
+
+    try:
+        print("Preparing images..")
+        target_files = list_frame_sources(target_dir, target_file_type, *time_range)
+        if not target_files:
+            print("Quit export: no target image found")
+            return None
+
+        size = export_size(target_files, target_width, target_height)
+
+        palette = None
+        if gif_mode == "delta":
+            print("Building gif palette..")
+            started = time.perf_counter()
+            palette = sample_palette(target_files, size)
+            if metrics is not None:
+                metrics.observe("export.gif_palette", time.perf_counter() - started)
+
+        print("starting gif/mp4 save..")
+        segmented = None
+        frame_workers = workers
+        if mp4_mode == "segments":
+            segmented = mp4_segments.SegmentedMp4Export(
+                target_files, size, framerate, f"{target_dir}/dst.mp4",
+                f"{target_dir}/{mp4_segments.CACHE_DIRNAME}",
+                hold_last=HOLD_LAST_FRAMES,
+                metrics=metrics,
+                prune=time_range == (None, None)
+            )
+            # both pools run at once and share the one worker budget; segment
+            # workers decode their frames again, so they only get a share for
+            # segments that are not cached
+            missing = segmented.plan()
+            if missing:
+                segmented.workers = min(missing, max(1, workers // 2))
+                frame_workers = max(1, workers - segmented.workers)
+            segmented.start()
+
+        sinks = default_sinks(target_dir, framerate, palette, metrics, mp4=segmented is None)
+        try:
+            report = export(target_files, size, sinks, workers=frame_workers, on_progress=on_progress,
+                            metrics=metrics, profiler=profiler)
+        finally:
+            if segmented is not None:
+                segmented.join()
+        if segmented is not None:
+            report["mp4"] = segmented.report()
+            print(f"mp4: {report['mp4']['elapsed']:.2f}s ({report['mp4']['cached']} of "
+                  f"{report['mp4']['segments']} segments cached)")
+
+        if metrics is not None:
+            metrics.count("frames_exported", len(target_files))
+            metrics.count("bytes_read", sum(os.path.getsize(path) for path in target_files if isinstance(path, str)))
+            for name in ("dst.gif", "dst.mp4"):
+                path = f"{target_dir}/{name}"
+                if os.path.isfile(path):
+                    metrics.count("bytes_written", os.path.getsize(path))
+        return report
+    finally:
+        # the GUI runs many exports; don't keep session files open in between
+        frame_store.close_open_stores(target_dir)
@@ -0,0 +1,67 @@
+"""
+Several renditions of one decoded snapshot.
+
+Renditions are produced largest first: the image is halved with a box filter
+while it stays at least twice the next target, then resampled once to the
+exact size. Every smaller rendition continues from the halved image of the
+one before, so the full canvas is only read once.
+"""
+
+from PIL import Image
+
+from psd_capture import fit_size
+
+
+class FrameOutput(object):
+    """
+    One rendition of every frame. size (0, 0) keeps the captured size;
+    without a path_format the rendition is only kept in memory.
+    """
+
+    name = None
+    size = (0, 0)
+    path_format = None
+
+    def __init__(self, name, size=(0, 0), path_format=None):
+        self.name = name
+        self.size = size
+        self.path_format = path_format
+
+    @property
+    def is_full_size(self):
+        return self.size[0] == 0 or self.size[1] == 0
+
+    def __repr__(self):
+        return f"FrameOutput({self.name!r}, {self.size}, {self.path_format!r})"
+
+
+def bounding_size(sizes):
+    """
+    Smallest decode size every one of sizes can be fitted from
+    """
+
+    sizes = list(sizes)
+    if not sizes or any(size[0] == 0 or size[1] == 0 for size in sizes):
+        return (0, 0)
+    return (max(size[0] for size in sizes), max(size[1] for size in sizes))
+
+
+def halve_towards(image, size):
+    while image.width >= size[0] * 2 and image.height >= size[1] * 2:
+        image = image.resize((image.width // 2, image.height // 2), Image.BOX)
+    return image
+
+
+def render(image, sizes, resample=Image.BILINEAR):
+    """
+    {size: image} for every requested size, fitted into it keeping the
+    aspect ratio; (0, 0) gives back the image itself
+    """
+
+    targets = {size: fit_size(image.size, size) for size in sizes}
+    result = {}
+    current = image
+    for size, target_size in sorted(targets.items(), key=lambda item: -item[1][0] * item[1][1]):
+        current = halve_towards(current, target_size)
+        result[size] = current if current.size == target_size else current.resize(target_size, resample)
+    return result
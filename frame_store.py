@@ -0,0 +1,397 @@
+"""
+Append-only binary frame store for a recording session.
+
+Two files side by side:
+
+    frames.bin  fixed 64 byte header, then frame payloads back to back
+    frames.idx  fixed 64 byte header, then one 32 byte entry per frame
+
+Capturing a frame is a single append of raw (or lightly compressed) pixels,
+and readers map both files so raw frames come back as zero-copy numpy views.
+An index entry is only written after its payload is on disk, so a crash
+never leaves an entry pointing at a partial frame.
+
+lz4 and zstandard are optional; zlib is always available.
+"""
+
+import os
+import mmap
+import zlib
+import struct
+import threading
+
+import numpy as np
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+STORE_FILENAME = "frames.bin"
+INDEX_SUFFIX = ".idx"
+
+DATA_MAGIC = b"PSDFRMS1"
+INDEX_MAGIC = b"PSDFIDX1"
+FORMAT_VERSION = 1
+HEADER_SIZE = 64
+
+CODEC_RAW = 0
+CODEC_ZLIB = 1
+CODEC_LZ4 = 2
+CODEC_ZSTD = 3
+
+CODEC_NAMES = {
+    "raw": CODEC_RAW,
+    "zlib": CODEC_ZLIB,
+    "lz4": CODEC_LZ4,
+    "zstd": CODEC_ZSTD,
+}
+
+KIND_FULL = 0
+KIND_TILES = 1
+
+# width/height/channels always describe the full frame; tile entries hold
+# (ty, tx) uint16 coordinates followed by the tile pixels, see delta_store
+INDEX_DTYPE = np.dtype([
+    ("offset", "<u8"),
+    ("length", "<u8"),
+    ("width", "<u4"),
+    ("height", "<u4"),
+    ("channels", "u1"),
+    ("codec", "u1"),
+    ("kind", "u1"),
+    ("reserved", "u1"),
+    ("tile_size", "<u2"),
+    ("tile_count", "<u2"),
+])
+
+
+class FrameStoreError(Exception):
+    pass
+
+
+def _compress(codec, data):
+    if codec == CODEC_RAW:
+        return data
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, 1)
+    if codec == CODEC_LZ4:
+        return lz4_frame.compress(data)
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=1).compress(data)
+    raise FrameStoreError(f"Unknown codec: {codec}")
+
+
+def _decompress(codec, data):
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    if codec == CODEC_LZ4:
+        return lz4_frame.decompress(data)
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise FrameStoreError(f"Unknown codec: {codec}")
+
+
+def available_codec(name):
+    """
+    Requested codec when its module is installed, zlib otherwise
+    """
+
+    codec = CODEC_NAMES[name]
+    if codec == CODEC_LZ4 and lz4_frame is None:
+        return CODEC_ZLIB
+    if codec == CODEC_ZSTD and zstandard is None:
+        return CODEC_ZLIB
+    return codec
+
+
+def _header(magic):
+    return magic + struct.pack("<H", FORMAT_VERSION) + bytes(HEADER_SIZE - len(magic) - 2)
+
+
+def _check_header(fp, magic, path):
+    header = fp.read(HEADER_SIZE)
+    if len(header) != HEADER_SIZE or header[:len(magic)] != magic:
+        raise FrameStoreError(f"Not a frame store: {path}")
+    version, = struct.unpack_from("<H", header, len(magic))
+    if version != FORMAT_VERSION:
+        raise FrameStoreError(f"Unsupported frame store version {version}: {path}")
+
+
+class FrameStore(object):
+
+    path = None
+    codec = CODEC_RAW
+
+    # byte offset and payload length of the most recent append
+    last_offset = None
+    last_length = None
+
+    def __init__(self, path, codec="raw", readonly=False):
+        """
+        Opens or creates the store at path; codec applies to new appends.
+        Readers of a store that is still being recorded must pass readonly.
+        """
+
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        self.codec = available_codec(codec)
+        self.readonly = readonly
+        self.lock = threading.Lock()
+
+        for file_path, magic in ((self.path, DATA_MAGIC), (self.index_path, INDEX_MAGIC)):
+            if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
+                if readonly:
+                    raise FrameStoreError(f"No frame store at {file_path}")
+                with open(file_path, "wb") as fp:
+                    fp.write(_header(magic))
+            else:
+                with open(file_path, "rb") as fp:
+                    _check_header(fp, magic, file_path)
+
+        file_mode = "rb" if readonly else "r+b"
+        self.data_fp = open(self.path, file_mode)
+        self.index_fp = open(self.index_path, file_mode)
+        if not readonly:
+            self._drop_partial_tail()
+
+        self.data_map = None
+        self.index_map = None
+        self.index = np.zeros(0, dtype=INDEX_DTYPE)
+        self._delta_reader = None
+
+    def _drop_partial_tail(self):
+        # entries past a torn write, and payload bytes nothing points at
+        index_size = os.path.getsize(self.index_path) - HEADER_SIZE
+        count = index_size // INDEX_DTYPE.itemsize
+        self.index_fp.truncate(HEADER_SIZE + count * INDEX_DTYPE.itemsize)
+
+        data_end = HEADER_SIZE
+        if count:
+            self.index_fp.seek(HEADER_SIZE + (count - 1) * INDEX_DTYPE.itemsize)
+            last = np.frombuffer(self.index_fp.read(INDEX_DTYPE.itemsize), dtype=INDEX_DTYPE)[0]
+            data_end = int(last["offset"] + last["length"])
+        self.data_fp.truncate(data_end)
+
+    @classmethod
+    def exists(cls, path):
+        return os.path.isfile(path) and os.path.isfile(path + INDEX_SUFFIX)
+
+    def append(self, arr, codec=None):
+        """
+        Appends an (h, w) or (h, w, c) uint8 frame, returns its index.
+        codec overrides the store codec for this frame.
+        """
+
+        codec = self.codec if codec is None else codec
+        arr = np.ascontiguousarray(arr, dtype=np.uint8)
+        height, width = arr.shape[:2]
+        channels = arr.shape[2] if arr.ndim == 3 else 1
+        payload = _compress(codec, arr.data if codec == CODEC_RAW else arr.tobytes())
+        return self._append_entry(payload, width, height, channels, codec, KIND_FULL)
+
+    def append_tiles(self, size, channels, tile_size, coords, tiles):
+        """
+        Appends the changed tiles of a (w, h) frame: coords is (n, 2) tile
+        (row, column), tiles is (n, tile_size, tile_size, channels)
+        """
+
+        codec = CODEC_ZLIB if self.codec == CODEC_RAW else self.codec
+        data = np.ascontiguousarray(coords, dtype="<u2").tobytes() + np.ascontiguousarray(tiles, dtype=np.uint8).tobytes()
+        return self._append_entry(
+            _compress(codec, data), size[0], size[1], channels, codec, KIND_TILES,
+            tile_size=tile_size, tile_count=len(coords)
+        )
+
+    def _append_entry(self, payload, width, height, channels, codec, kind, tile_size=0, tile_count=0):
+        if self.readonly:
+            raise FrameStoreError("Frame store opened read-only")
+
+        with self.lock:
+            self.data_fp.seek(0, os.SEEK_END)
+            offset = self.data_fp.tell()
+            self.data_fp.write(payload)
+            self.data_fp.flush()
+
+            entry = np.zeros(1, dtype=INDEX_DTYPE)
+            entry["offset"] = offset
+            entry["length"] = memoryview(payload).nbytes
+            entry["width"] = width
+            entry["height"] = height
+            entry["channels"] = channels
+            entry["codec"] = codec
+            entry["kind"] = kind
+            entry["tile_size"] = tile_size
+            entry["tile_count"] = tile_count
+
+            self.index_fp.seek(0, os.SEEK_END)
+            position = (self.index_fp.tell() - HEADER_SIZE) // INDEX_DTYPE.itemsize
+            self.index_fp.write(entry.tobytes())
+            self.index_fp.flush()
+            self.last_offset = offset
+            self.last_length = int(entry["length"][0])
+            return position
+
+    def refresh(self):
+        """
+        Re-maps both files to pick up frames appended since the last read
+        """
+
+        with self.lock:
+            self._remap()
+
+    def _remap(self):
+        index_size = os.path.getsize(self.index_path)
+        count = (index_size - HEADER_SIZE) // INDEX_DTYPE.itemsize
+        if count == len(self.index) and self.data_map is not None:
+            return
+
+        self._unmap()
+        if count == 0:
+            self.index = np.zeros(0, dtype=INDEX_DTYPE)
+            return
+
+        self.index_map = mmap.mmap(self.index_fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index = np.frombuffer(self.index_map, dtype=INDEX_DTYPE, count=count, offset=HEADER_SIZE)
+        self.data_map = mmap.mmap(self.data_fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _unmap(self):
+        # numpy views keep the maps alive until they are collected
+        self.index = np.zeros(0, dtype=INDEX_DTYPE)
+        self.index_map = None
+        self.data_map = None
+
+    def __len__(self):
+        self.refresh()
+        return len(self.index)
+
+    def entry(self, i):
+        self.refresh()
+        return self.index[i]
+
+    def sizes(self):
+        self.refresh()
+        return [(int(e["width"]), int(e["height"])) for e in self.index]
+
+    def __getitem__(self, i):
+        """
+        Frame i as a numpy array; raw frames are read-only views into the map,
+        tile deltas are rebuilt from their keyframe
+        """
+
+        if self.entry(i)["kind"] == KIND_TILES:
+            if self._delta_reader is None:
+                from delta_store import DeltaFrameReader
+                self._delta_reader = DeltaFrameReader(self)
+            return self._delta_reader[i]
+        return self.read_full(i)
+
+    def read_payload(self, i):
+        entry = self.entry(i)
+        offset = int(entry["offset"])
+        length = int(entry["length"])
+        if entry["codec"] == CODEC_RAW:
+            return memoryview(self.data_map)[offset:offset + length]
+        return _decompress(int(entry["codec"]), self.data_map[offset:offset + length])
+
+    def read_full(self, i):
+        entry = self.entry(i)
+        shape = (int(entry["height"]), int(entry["width"]))
+        if entry["channels"] > 1:
+            shape += (int(entry["channels"]),)
+        return np.frombuffer(self.read_payload(i), dtype=np.uint8).reshape(shape)
+
+    def read_tiles(self, i):
+        """
+        (coords, tiles) of a tile delta entry
+        """
+
+        entry = self.entry(i)
+        count = int(entry["tile_count"])
+        tile = int(entry["tile_size"])
+        payload = self.read_payload(i)
+        coords = np.frombuffer(payload, dtype="<u2", count=count * 2).reshape(count, 2)
+        tiles = np.frombuffer(payload, dtype=np.uint8, offset=count * 4)
+        return coords, tiles.reshape(count, tile, tile, int(entry["channels"]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def image(self, i):
+        from PIL import Image
+        return Image.fromarray(np.array(self[i]))
+
+    def export_png(self, i, path):
+        self.image(i).save(path)
+        return path
+
+    def export_pngs(self, target_dir, name_format="cached_{index}.png"):
+        paths = []
+        for i in range(len(self)):
+            paths.append(self.export_png(i, os.path.join(target_dir, name_format.format(index=i))))
+        return paths
+
+    def close(self):
+        with self.lock:
+            self._unmap()
+            self.data_fp.close()
+            self.index_fp.close()
+
+
+class StoreFrameRef(object):
+    """
+    Picklable reference to one frame, resolved lazily in worker processes
+    """
+
+    def __init__(self, store_path, index):
+        self.store_path = store_path
+        self.index = index
+
+    def __repr__(self):
+        return f"StoreFrameRef({self.store_path!r}, {self.index})"
+
+
+# read handles of resolve() and ref_size(), one per store path
+_open_stores = {}
+_open_stores_lock = threading.Lock()
+
+
+def _open_store(store_path):
+    with _open_stores_lock:
+        store = _open_stores.get(store_path)
+        if store is None:
+            store = FrameStore(store_path, readonly=True)
+            _open_stores[store_path] = store
+        return store
+
+
+def close_open_stores(directory=None):
+    """
+    Closes the read handles kept by resolve() and ref_size(), all of them
+    or the ones of stores in directory; later lookups open them again
+    """
+
+    with _open_stores_lock:
+        for store_path in list(_open_stores):
+            if directory is None or os.path.dirname(os.path.abspath(store_path)) == os.path.abspath(directory):
+                _open_stores.pop(store_path).close()
+
+
+def resolve(ref):
+    return _open_store(ref.store_path)[ref.index]
+
+
+def ref_size(ref):
+    """
+    (width, height) of a referenced frame, from the index alone
+    """
+
+    entry = _open_store(ref.store_path).entry(ref.index)
+    return (int(entry["width"]), int(entry["height"]))
@@ -0,0 +1,264 @@
+"""
+GIF encoder for slowly changing canvases.
+
+ - one global palette, median cut over a vectorized colour histogram sampled
+   across the whole session
+ - every frame after the first only stores the bounding rectangle of the
+   pixels that changed, with unchanged pixels inside it left transparent
+ - frames that do not change at all extend the previous frame's duration,
+   so the held last frame is a single long frame
+
+LZW compression of each rectangle is delegated to Pillow.
+"""
+
+import io
+import struct
+
+import numpy as np
+from PIL import Image
+
+
+PALETTE_SIZE = 256
+TRANSPARENT_INDEX = 255
+MAX_DELAY = 0xFFFF
+
+# colours are binned to 5 bits per channel for the histogram and lookup
+_BITS = 5
+_BINS = 1 << (_BITS * 3)
+
+
+def color_keys(arr):
+    arr = arr.reshape(-1, 3) >> (8 - _BITS)
+    return (
+        (arr[:, 0].astype(np.int32) << (_BITS * 2)) |
+        (arr[:, 1].astype(np.int32) << _BITS) |
+        arr[:, 2].astype(np.int32)
+    )
+
+
+class ColorHistogram(object):
+
+    def __init__(self):
+        self.counts = np.zeros(_BINS, dtype=np.int64)
+        self.sums = np.zeros((_BINS, 3), dtype=np.float64)
+
+    def add(self, arr, step=4):
+        """
+        Adds every step-th pixel of an (h, w, 3) frame
+        """
+
+        pixels = arr[::step, ::step].reshape(-1, 3)
+        keys = color_keys(pixels)
+        self.counts += np.bincount(keys, minlength=_BINS)
+        for channel in range(3):
+            self.sums[:, channel] += np.bincount(keys, weights=pixels[:, channel], minlength=_BINS)
+
+    def palette(self, colors=PALETTE_SIZE - 1):
+        used = np.nonzero(self.counts)[0]
+        if len(used) == 0:
+            return np.zeros((1, 3), dtype=np.uint8)
+
+        weights = self.counts[used].astype(np.float64)
+        bin_colors = self.sums[used] / weights[:, None]
+        return median_cut(bin_colors, weights, colors)
+
+
+def median_cut(colors, weights, count):
+    boxes = [np.arange(len(colors))]
+    while len(boxes) < count:
+        best = None
+        best_score = 0.0
+        for i, box in enumerate(boxes):
+            if len(box) < 2:
+                continue
+            box_colors = colors[box]
+            score = (box_colors.max(axis=0) - box_colors.min(axis=0)).max() * weights[box].sum()
+            if score > best_score:
+                best = i
+                best_score = score
+
+        if best is None:
+            break
+
+        box = boxes.pop(best)
+        box_colors = colors[box]
+        axis = int(np.argmax(box_colors.max(axis=0) - box_colors.min(axis=0)))
+        ordered = box[np.argsort(box_colors[:, axis], kind="stable")]
+        cumulative = np.cumsum(weights[ordered])
+        split = int(np.searchsorted(cumulative, cumulative[-1] / 2.0))
+        split = min(max(split, 1), len(ordered) - 1)
+        boxes.append(ordered[:split])
+        boxes.append(ordered[split:])
+
+    palette = [np.average(colors[box], axis=0, weights=weights[box]) for box in boxes]
+    return np.clip(np.rint(palette), 0, 255).astype(np.uint8)
+
+
+def build_lookup(palette):
+    """
+    Nearest palette index for every 5-bit colour bin
+    """
+
+    keys = np.arange(_BINS)
+    shift = 8 - _BITS
+    centers = np.stack([
+        (keys >> (_BITS * 2)) & 0x1F,
+        (keys >> _BITS) & 0x1F,
+        keys & 0x1F,
+    ], axis=1).astype(np.float32)
+    centers = (centers * (1 << shift)) + (1 << (shift - 1))
+
+    palette = palette.astype(np.float32)
+    lookup = np.empty(_BINS, dtype=np.uint8)
+    chunk = 4096
+    for start in range(0, _BINS, chunk):
+        distances = ((centers[start:start + chunk, None, :] - palette[None, :, :]) ** 2).sum(axis=2)
+        lookup[start:start + chunk] = np.argmin(distances, axis=1)
+    return lookup
+
+
+def _lzw_image_data(indices, palette_bytes):
+    """
+    LZW compressed image data block (min code size + sub-blocks) from Pillow
+    """
+
+    img = Image.fromarray(indices, "P")
+    img.putpalette(palette_bytes)
+    buffer = io.BytesIO()
+    # Pillow interlaces frames from 16px up; the descriptors written here don't
+    img.save(buffer, format="GIF", optimize=False, interlace=False)
+    data = buffer.getvalue()
+
+    flags = data[10]
+    pos = 13
+    if flags & 0x80:
+        pos += 3 * (2 << (flags & 0x07))
+
+    while data[pos] == 0x21:
+        pos += 2
+        while data[pos] != 0:
+            pos += data[pos] + 1
+        pos += 1
+
+    if data[pos] != 0x2C:
+        raise ValueError("Unexpected GIF block from Pillow")
+    local_flags = data[pos + 9]
+    if local_flags & 0x40:
+        raise ValueError("Unexpected interlaced GIF data from Pillow")
+    pos += 10
+    if local_flags & 0x80:
+        pos += 3 * (2 << (local_flags & 0x07))
+
+    end = pos + 1
+    while data[end] != 0:
+        end += data[end] + 1
+    return data[pos:end + 1]
+
+
+class DeltaGifWriter(object):
+    """
+    imageio-style writer: append_data(frame) and close()
+    """
+
+    metrics = None
+
+    def __init__(self, path, palette, framerate, loop=0, metrics=None):
+        """
+        With a Metrics registry, quantization is timed as "export.gif_quantize"
+        """
+
+        self.metrics = metrics
+        self.fp = open(path, "wb")
+        self.delay = max(2, int(round(100.0 / framerate)))
+        self.loop = loop
+
+        palette = palette[:PALETTE_SIZE - 1]
+        table = np.zeros((PALETTE_SIZE, 3), dtype=np.uint8)
+        table[:len(palette)] = palette
+        self.palette_bytes = table.tobytes()
+        self.lookup = build_lookup(palette)
+
+        self.size = None
+        self.previous = None
+        # (left, top, indices, transparent), written once its delay is known
+        self.pending = None
+        self.pending_delay = 0
+
+    def quantize(self, frame):
+        h, w = frame.shape[:2]
+        return self.lookup[color_keys(frame)].reshape(h, w)
+
+    def write_header(self):
+        w, h = self.size
+        self.fp.write(b"GIF89a")
+        self.fp.write(struct.pack("<HHBBB", w, h, 0xF7, 0, 0))
+        self.fp.write(self.palette_bytes)
+        # NETSCAPE2.0 looping extension
+        self.fp.write(b"\x21\xFF\x0BNETSCAPE2.0\x03\x01" + struct.pack("<H", self.loop) + b"\x00")
+
+    def append_data(self, frame):
+        frame = np.asarray(frame)[:, :, :3]
+        if self.metrics is not None:
+            with self.metrics.timer("export.gif_quantize"):
+                indices = self.quantize(frame)
+        else:
+            indices = self.quantize(frame)
+
+        if self.previous is None:
+            self.size = (indices.shape[1], indices.shape[0])
+            self.write_header()
+            self.queue_frame(0, 0, indices, False)
+            self.previous = indices
+            return
+
+        changed = indices != self.previous
+        rows = np.flatnonzero(changed.any(axis=1))
+        if len(rows) == 0:
+            self.pending_delay += self.delay
+            return
+
+        cols = np.flatnonzero(changed.any(axis=0))
+        top, bottom = rows[0], rows[-1] + 1
+        left, right = cols[0], cols[-1] + 1
+
+        rect = indices[top:bottom, left:right].copy()
+        rect[~changed[top:bottom, left:right]] = TRANSPARENT_INDEX
+        self.queue_frame(left, top, rect, True)
+        self.previous = indices
+
+    def queue_frame(self, left, top, indices, transparent):
+        self.flush_frame()
+        self.pending = (left, top, indices, transparent)
+        self.pending_delay = self.delay
+
+    def flush_frame(self):
+        if self.pending is None:
+            return
+
+        left, top, indices, transparent = self.pending
+        self.pending = None
+
+        delay = self.pending_delay
+        while delay > 0:
+            chunk = min(delay, MAX_DELAY)
+            delay -= chunk
+            self.write_frame(left, top, indices, transparent, chunk)
+
+            # delay beyond the gif limit continues on a 1px transparent frame
+            left, top, transparent = 0, 0, True
+            indices = np.full((1, 1), TRANSPARENT_INDEX, dtype=np.uint8)
+
+    def write_frame(self, left, top, indices, transparent, delay):
+        # graphic control extension, disposal 1: leave the frame in place
+        flags = (1 << 2) | (1 if transparent else 0)
+        self.fp.write(struct.pack("<BBBBHBB", 0x21, 0xF9, 4, flags, delay, TRANSPARENT_INDEX, 0))
+
+        h, w = indices.shape
+        self.fp.write(struct.pack("<BHHHHB", 0x2C, left, top, w, h, 0))
+        self.fp.write(_lzw_image_data(np.ascontiguousarray(indices), self.palette_bytes))
+
+    def close(self):
+        self.flush_frame()
+        if self.size is not None:
+            self.fp.write(b"\x3B")
+        self.fp.close()
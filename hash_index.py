@@ -0,0 +1,83 @@
+"""
+Session-wide perceptual hash index.
+
+A BK-tree over image hashes with Hamming distance as the metric, so looking
+up "any earlier frame within N bits of this one" only visits a small part of
+the session instead of every stored hash. A close hash only makes a frame a
+candidate; callers confirm it against the frame's pixels.
+"""
+
+
+def hash_to_int(hashcode):
+    """
+    imagehash.ImageHash (or its hex string) as a plain integer
+    """
+
+    return int(str(hashcode), 16)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class BKTree(object):
+
+    # node: [key, [values], {distance: child}]; frames can share a hash
+    root = None
+    size = 0
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, key, value):
+        self.size += 1
+        if self.root is None:
+            self.root = [key, [value], {}]
+            return
+
+        node = self.root
+        while True:
+            distance = hamming(key, node[0])
+            if distance == 0:
+                node[1].append(value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, [value], {}]
+                return
+            node = child
+
+    def within(self, key, max_distance):
+        """
+        (distance, value) of every value within max_distance, closest and
+        earliest first
+        """
+
+        if self.root is None:
+            return []
+
+        found = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming(key, node[0])
+            if distance <= max_distance:
+                found.extend((distance, order, value) for order, value in enumerate(node[1]))
+
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        found.sort(key=lambda item: item[:2])
+        return [(distance, value) for distance, _, value in found]
+
+    def nearest(self, key, max_distance):
+        """
+        (distance, value) of the closest key within max_distance, or None
+        """
+
+        found = self.within(key, max_distance)
+        return found[0] if found else None
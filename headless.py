@@ -0,0 +1,357 @@
+"""
+Headless recorder and exporter, no Qt or COM needed.
+
+usage:
+    python headless.py export SESSIONS_ROOT [--jobs 4] [--type png] [--width 1024] [--height 720]
+                              [--since 2017-10-21T14:00] [--until 2017-10-21T18:30]
+    python headless.py watch PSD [PSD ...] [--decode-workers 2] [--type png] [--frame-store] [--live-export]
+
+export finds every recorded session below SESSIONS_ROOT (directories with a
+manifest, a frame store or cached_N files) and exports them in parallel, one
+session per worker process. --since/--until only export the frames
+captured in that time range (ISO date/time or unix seconds), taken from
+the session manifest. watch records any number of PSDs at once, every
+file on its own capture pipeline, all sharing one decode process pool.
+With --live-export, dst.gif and dst.mp4 are encoded while watching and
+finalized on Ctrl+C.
+
+--metrics writes metrics.json and metrics.prom into every session directory,
+--profile cprofile|pyinstrument additionally profiles its worker threads.
+"""
+
+import io
+import os
+import sys
+import time
+import queue
+import signal
+import argparse
+import datetime
+import threading
+import traceback
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+
+import frame_export
+from metrics import Metrics
+from metrics import SessionProfiler
+from metrics import save_session_metrics
+from frame_store import STORE_FILENAME
+from session_manifest import MANIFEST_FILENAME
+from session_manifest import session_dir_for
+
+
+# seconds between progress lines of one export job
+PROGRESS_INTERVAL = 1.0
+
+
+def is_session_dir(dirpath, target_file_type):
+    filenames = os.listdir(dirpath)
+    if MANIFEST_FILENAME in filenames or STORE_FILENAME in filenames:
+        return True
+    return any(name.startswith("cached_") and name.endswith(f".{target_file_type}") for name in filenames)
+
+
+def find_sessions(root, target_file_type):
+    """
+    Session directories below root, sorted; sessions are not searched further
+    """
+
+    sessions = []
+    for dirpath, dirnames, _ in os.walk(root):
+        if is_session_dir(dirpath, target_file_type):
+            sessions.append(dirpath.replace("\\", "/"))
+            dirnames[:] = []
+        else:
+            dirnames.sort()
+    return sorted(sessions)
+
+
+def _export_job(session_dir, options, progress_queue):
+    # runs in a worker process; the session's own log is returned, not printed
+    last_report = [0.0]
+    result = {"session": session_dir, "frames": 0, "error": None}
+
+    def on_progress(done, count):
+        result["frames"] = done
+        now = time.time()
+        if done == count or now - last_report[0] >= PROGRESS_INTERVAL:
+            last_report[0] = now
+            progress_queue.put((session_dir, done, count))
+
+    session_metrics = Metrics() if options["metrics"] else None
+    profiler = SessionProfiler(options["profile"]) if options["profile"] else None
+
+    log = io.StringIO()
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(log):
+        try:
+            report = frame_export.export_session(
+                session_dir,
+                options["type"],
+                options["width"],
+                options["height"],
+                options["framerate"],
+                workers=options["frame_workers"],
+                gif_mode=options["gif_mode"],
+                mp4_mode=options["mp4_mode"],
+                time_range=options["time_range"],
+                on_progress=on_progress,
+                metrics=session_metrics,
+                profiler=profiler
+            )
+            if report is None:
+                result["error"] = "no frames"
+            else:
+                failed = [name for name, sink in report.items() if sink.get("error")]
+                if failed:
+                    result["error"] = ", ".join(
+                        f"{name}: {str(report[name]['error']).splitlines()[0]}" for name in failed
+                    )
+            save_session_metrics(session_dir, session_metrics, profiler)
+        except Exception:
+            result["error"] = traceback.format_exc().strip().splitlines()[-1]
+    result["elapsed"] = time.perf_counter() - started
+    result["log"] = log.getvalue()
+    return result
+
+
+def _print_progress(progress_queue, stop_event):
+    while not stop_event.is_set() or not progress_queue.empty():
+        try:
+            session_dir, done, count = progress_queue.get(timeout=0.2)
+        except queue.Empty:
+            continue
+        print(f"  {session_dir}: {done} / {count}")
+
+
+def export_sessions(sessions, options, jobs):
+    """
+    Exports sessions on a process pool, returns the job results in session order
+    """
+
+    manager = multiprocessing.Manager()
+    progress_queue = manager.Queue()
+    stop_event = threading.Event()
+    printer = threading.Thread(target=_print_progress, args=(progress_queue, stop_event), daemon=True)
+    printer.start()
+
+    results = {}
+    try:
+        with ProcessPoolExecutor(jobs) as pool:
+            futures = {
+                pool.submit(_export_job, session_dir, options, progress_queue): session_dir
+                for session_dir in sessions
+            }
+            for future in as_completed(futures):
+                session_dir = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # worker process died
+                    result = {"session": session_dir, "frames": 0, "error": repr(e), "elapsed": 0.0, "log": ""}
+                results[session_dir] = result
+                status = "done" if result["error"] is None else f"FAILED ({result['error']})"
+                print(f"[{len(results)}/{len(sessions)}] {session_dir}: {status} in {result['elapsed']:.1f}s")
+    finally:
+        stop_event.set()
+        printer.join()
+        manager.shutdown()
+    return [results[session_dir] for session_dir in sessions]
+
+
+def print_summary(results):
+    failed = [result for result in results if result["error"] is not None]
+    print("")
+    print(f"{'session':<60} {'frames':>7} {'elapsed':>9}  status")
+    for result in results:
+        status = "ok" if result["error"] is None else result["error"]
+        print(f"{result['session']:<60} {result['frames']:>7} {result['elapsed']:>8.1f}s  {status}")
+    print(f"{len(results) - len(failed)} exported, {len(failed)} failed")
+
+    for result in failed:
+        if result["log"]:
+            print(f"\n--- {result['session']} ---\n{result['log'].rstrip()}")
+
+
+def run_export(args):
+    sessions = find_sessions(args.root, args.type)
+    if not sessions:
+        print(f"No recorded sessions below {args.root}")
+        return 1
+
+    options = {
+        "type": args.type,
+        "width": args.width,
+        "height": args.height,
+        "framerate": args.framerate,
+        "frame_workers": args.frame_workers,
+        "gif_mode": args.gif_mode,
+        "mp4_mode": args.mp4_mode,
+        "time_range": (args.since, args.until),
+        "metrics": args.metrics,
+        "profile": args.profile,
+    }
+    jobs = args.jobs or min(len(sessions), os.cpu_count() or 1)
+    print(f"Exporting {len(sessions)} sessions on {jobs} workers..")
+    results = export_sessions(sessions, options, jobs)
+    print_summary(results)
+    return 0 if all(result["error"] is None for result in results) else 1
+
+
+def capture_time(value):
+    """
+    argparse type: unix seconds or an ISO date/time in local time
+    """
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a date/time or unix time: {value}")
+
+
+def _ignore_interrupt():
+    # Ctrl+C reaches the whole process group; only the parent handles it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def run_watch(args):
+    from capture_pipeline import CapturePipeline
+    from frame_store import FrameStore
+    from delta_store import DeltaFrameWriter
+    from live_export import LiveExport
+
+    pipelines = []
+    stores = []
+    sessions = []
+    with ProcessPoolExecutor(args.decode_workers, initializer=_ignore_interrupt) as decode_pool:
+        for psd_path in args.psd_paths:
+            if not os.path.isfile(psd_path):
+                print(f"[WARNING] Skipping missing file {psd_path}")
+                continue
+
+            session_dir = session_dir_for(psd_path)
+            manifest = frame_export.open_session_manifest(session_dir, args.type)
+
+            store_writer = None
+            if args.frame_store:
+                store = FrameStore(f"{session_dir}/{STORE_FILENAME}")
+                stores.append(store)
+                store_writer = DeltaFrameWriter(store, args.keyframe_interval) if args.keyframe_interval else store
+
+            session_metrics = Metrics()
+            profiler = SessionProfiler(args.profile) if args.profile else None
+            live_export = None
+            if args.live_export:
+                live_export = LiveExport(session_dir, args.type, args.width, args.height, args.framerate,
+                                         metrics=session_metrics)
+            sessions.append((session_dir, session_metrics, profiler, live_export))
+
+            def on_saved(frame, name=os.path.basename(psd_path), live_export=live_export):
+                print(f"[{name}] frame {frame.index}")
+                if live_export is not None:
+                    live_export.add_frame(frame)
+
+            pipelines.append(CapturePipeline(
+                psd_path,
+                f"{session_dir}/cached_{{index}}.{args.type}",
+                (args.width, args.height),
+                start_index=manifest.next_index,
+                on_saved=on_saved,
+                frame_store=store_writer,
+                manifest=manifest,
+                decode_pool=decode_pool,
+                metrics=session_metrics,
+                profiler=profiler
+            ))
+
+        if not pipelines:
+            print("Nothing to watch")
+            return 1
+
+        print(f"Watching {len(pipelines)} files on {args.decode_workers} decode workers, Ctrl+C to stop..")
+        for pipeline, (_, _, _, live_export) in zip(pipelines, sessions):
+            if live_export is not None:
+                live_export.start()
+            pipeline.start()
+        try:
+            while any(worker.is_alive() for pipeline in pipelines for worker in pipeline.workers):
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            print("Stopping..")
+        finally:
+            for pipeline in pipelines:
+                pipeline.cancel()
+            for pipeline in pipelines:
+                pipeline.join()
+            for store in stores:
+                store.close()
+
+    for pipeline, (session_dir, session_metrics, profiler, live_export) in zip(pipelines, sessions):
+        stats = pipeline.stats()
+        print(f"{pipeline.psd_path}: {stats['saved']} saved, {stats['references']} repeated "
+              f"({stats['bytes_saved'] / 1024 ** 2:.1f} MiB not stored again)")
+        if live_export is not None:
+            if live_export.finish() is None:
+                frame_export.export_session(session_dir, args.type, args.width, args.height, args.framerate,
+                                            metrics=session_metrics)
+        if args.metrics:
+            print(session_metrics.format_table())
+        save_session_metrics(session_dir, session_metrics if args.metrics else None, profiler)
+    return 0
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument("--metrics", action="store_true", help="write metrics.json and metrics.prom per session")
+    parser.add_argument("--profile", choices=("cprofile", "pyinstrument"), help="profile every session")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command")
+
+    export_parser = subparsers.add_parser("export", help="export every recorded session below a directory")
+    export_parser.add_argument("root")
+    export_parser.add_argument("--jobs", type=int, default=0, help="sessions exported at once, default cpu count")
+    export_parser.add_argument("--frame-workers", type=int, default=1, help="frame decode and mp4 segment processes per session")
+    export_parser.add_argument("--type", default="png")
+    export_parser.add_argument("--width", type=int, default=1024)
+    export_parser.add_argument("--height", type=int, default=720)
+    export_parser.add_argument("--framerate", type=int, default=12)
+    export_parser.add_argument("--gif-mode", default="delta", choices=("delta", "imageio"))
+    export_parser.add_argument("--mp4-mode", default="segments", choices=("segments", "stream"),
+                               help="segments re-encodes only what changed since the last export")
+    export_parser.add_argument("--since", type=capture_time, help="only frames captured at or after this time")
+    export_parser.add_argument("--until", type=capture_time, help="only frames captured at or before this time")
+    add_metrics_arguments(export_parser)
+    export_parser.set_defaults(func=run_export)
+
+    watch_parser = subparsers.add_parser("watch", help="record several PSD files at once")
+    watch_parser.add_argument("psd_paths", nargs="+")
+    watch_parser.add_argument("--decode-workers", type=int, default=2)
+    watch_parser.add_argument("--type", default="png")
+    watch_parser.add_argument("--width", type=int, default=1024)
+    watch_parser.add_argument("--height", type=int, default=720)
+    watch_parser.add_argument("--frame-store", action="store_true", help="append frames to frames.bin")
+    watch_parser.add_argument("--keyframe-interval", type=int, default=30, help="0 stores every frame whole")
+    watch_parser.add_argument("--live-export", action="store_true", help="encode dst.gif/dst.mp4 while watching")
+    watch_parser.add_argument("--framerate", type=int, default=12)
+    add_metrics_arguments(watch_parser)
+    watch_parser.set_defaults(func=run_watch)
+
+    args = parser.parse_args()
+    if not getattr(args, "func", None):
+        parser.print_help()
+        return 1
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
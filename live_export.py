@@ -0,0 +1,333 @@
+"""
+Export while recording.
+
+LiveExport is fed every saved snapshot and, on a low priority thread held
+to a CPU budget, normalizes it once and appends it to a running delta GIF
+and to the MP4 segment being recorded into the mp4_segments cache. When
+recording stops, finish() only drains what is left, closes the GIF, seals
+the last segment and concatenates the cached segments.
+
+The live GIF cannot sample its palette across the whole session, so it
+uses the first frame's colors plus a coarse color cube. The export size is
+kept up to date from the size of every frame handed in; when the canvas
+grows past what is being encoded, or frames are missing, the live encoder
+gives up and finish() returns None so the regular export runs.
+"""
+
+import os
+import time
+import queue
+import threading
+
+import numpy as np
+
+import gif_encoder
+import frame_store
+import mp4_segments
+import frame_export
+
+
+_STOP = object()
+
+# colors of the live GIF palette taken from the first frame, the rest is a cube
+FIRST_FRAME_COLORS = 130
+CUBE_STEPS = 5
+
+
+def lower_thread_priority():
+    """
+    Best effort: below normal priority for the calling thread and the
+    encoder processes it starts
+    """
+
+    try:
+        if hasattr(os, "setpriority") and hasattr(threading, "get_native_id"):
+            # linux schedules threads as tasks; children inherit the nice value
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 10)
+        elif os.name == "nt":
+            import ctypes
+            kernel32 = ctypes.windll.kernel32
+            kernel32.SetThreadPriority(kernel32.GetCurrentThread(), -2)  # THREAD_PRIORITY_LOWEST
+    except Exception as e:
+        print(f"[WARNING] Can't lower live export priority: {e}")
+
+
+def live_palette(frame):
+    """
+    GIF palette for a session only the first frame of is known yet
+    """
+
+    histogram = gif_encoder.ColorHistogram()
+    histogram.add(frame)
+    levels = np.linspace(0, 255, CUBE_STEPS).round().astype(np.uint8)
+    cube = np.stack(np.meshgrid(levels, levels, levels, indexing="ij"), axis=-1).reshape(-1, 3)
+    palette = np.concatenate([histogram.palette(FIRST_FRAME_COLORS), cube])
+    return palette[:gif_encoder.PALETTE_SIZE - 1]
+
+
+def frame_source(frame):
+    """
+    The export source of a saved CaptureFrame, as list_frame_sources gives it
+    """
+
+    if frame.store_index is not None:
+        return frame_store.StoreFrameRef(frame.output_path, frame.store_index)
+    return frame.output_path
+
+
+class LiveExport(threading.Thread):
+
+    target_dir = None
+    size = None
+    # largest (w, h) of every frame handed in so far
+    max_size = (0, 0)
+    cpu_budget = 0.25
+    frame_count = 0
+    gif_busy = 0.0
+    error = None
+
+    def __init__(self, target_dir, target_file_type, target_width, target_height, framerate,
+                 cpu_budget=0.25, segment_frames=mp4_segments.SEGMENT_FRAMES, metrics=None):
+        """
+        cpu_budget is the fraction of one core the live encoder may use.
+        Frames recorded into target_dir before are queued first.
+        """
+
+        super(LiveExport, self).__init__(name="live-export")
+        self.daemon = True
+        self.target_dir = target_dir
+        self.target_file_type = target_file_type
+        self.target_width = target_width
+        self.target_height = target_height
+        self.framerate = framerate
+        self.cpu_budget = cpu_budget
+        self.segment_frames = segment_frames
+        self.metrics = metrics
+
+        self.gif_path = f"{target_dir}/dst.gif"
+        self.live_gif_path = f"{target_dir}/live.part.gif"
+        self.cache_dir = f"{target_dir}/{mp4_segments.CACHE_DIRNAME}"
+        self.live_mp4_path = os.path.join(self.cache_dir, "live.part.mp4")
+
+        self.finishing = threading.Event()
+        self.inbox = queue.Queue()
+        self.size_lock = threading.Lock()
+        self.sources = []
+        self.tokens = []
+        self.stores = {}
+
+        self.gif_writer = None
+        self.last_frame = None
+        # the open segment: (start, imageio writer), or (start, None) when
+        # it is already in the cache from an earlier export
+        self.segment = None
+        self.segments_cached = 0
+        self.segments_encoded = 0
+
+        for source in frame_export.list_frame_sources(target_dir, target_file_type):
+            self.add(source)
+
+    def add(self, source):
+        self.grow(frame_export.source_size(source))
+        self.inbox.put(source)
+
+    def add_frame(self, frame):
+        """
+        CapturePipeline on_saved hook; only queues, never blocks capture
+        """
+
+        self.grow((frame.record["width"], frame.record["height"]))
+        self.inbox.put(frame_source(frame))
+
+    def grow(self, size):
+        with self.size_lock:
+            self.max_size = (max(self.max_size[0], size[0]), max(self.max_size[1], size[1]))
+
+    def export_size(self):
+        """
+        Size the regular export would use for the frames handed in so far
+        """
+
+        with self.size_lock:
+            max_size = self.max_size
+        return frame_export.fitted_size(max_size, self.target_width, self.target_height)
+
+    def run(self):
+        lower_thread_priority()
+        while True:
+            source = self.inbox.get()
+            if source is _STOP:
+                break
+            if self.error is not None:
+                continue
+            if self.size is not None and self.export_size() != self.size:
+                print("[WARNING] Canvas resized, live export stops and the regular export will run on stop")
+                self.error = ValueError(f"export size changed from {self.size} to {self.export_size()}")
+                continue
+
+            started = time.perf_counter()
+            try:
+                self.encode(source)
+            except Exception as e:
+                print(f"[ERROR] live export failed, the regular export will run on stop: {e}")
+                self.error = e
+                continue
+
+            if not self.finishing.is_set():
+                elapsed = time.perf_counter() - started
+                self.finishing.wait(elapsed * (1.0 - self.cpu_budget) / self.cpu_budget)
+
+    def timer(self, stage):
+        if self.metrics is None:
+            return _NoTimer()
+        return self.metrics.timer(stage)
+
+    def encode(self, source):
+        if self.size is None:
+            self.size = self.export_size()
+
+        with self.timer("live.normalize"):
+            frame = frame_export.load_normalized(source, self.size)
+        self.sources.append(source)
+        self.tokens.append(mp4_segments.frame_token(source, self.stores))
+
+        gif_started = time.perf_counter()
+        with self.timer("live.gif"):
+            if self.gif_writer is None:
+                self.gif_writer = gif_encoder.DeltaGifWriter(self.live_gif_path, live_palette(frame), self.framerate)
+            self.gif_writer.append_data(frame)
+        self.gif_busy += time.perf_counter() - gif_started
+
+        with self.timer("live.mp4"):
+            self.append_mp4(frame)
+        self.last_frame = frame
+        self.frame_count += 1
+
+    def append_mp4(self, frame):
+        import imageio
+
+        index = len(self.sources) - 1
+        if self.segment is None:
+            writer = None
+            if not self.is_segment_cached(index):
+                os.makedirs(self.cache_dir, exist_ok=True)
+                writer = imageio.get_writer(self.live_mp4_path, fps=self.framerate)
+            self.segment = (index, writer)
+
+        start, writer = self.segment
+        if writer is not None:
+            writer.append_data(frame)
+        if index + 1 - start == self.segment_frames:
+            self.seal_segment()
+
+    def segment_path(self, start, tokens):
+        segment = mp4_segments.Segment(start, [None] * len(tokens))
+        key = mp4_segments.segment_key(segment, tokens, self.size, self.framerate)
+        return os.path.join(self.cache_dir, f"{key}.mp4")
+
+    def is_segment_cached(self, start):
+        """
+        Whether the segment starting at the latest frame is complete in the
+        queue already (frames of earlier recordings) and in the cache
+        """
+
+        with self.inbox.mutex:
+            queued = list(self.inbox.queue)[:self.segment_frames - 1]
+        if len(queued) < self.segment_frames - 1 or any(source is _STOP for source in queued):
+            return False
+        tokens = self.tokens[start:] + [mp4_segments.frame_token(source, self.stores) for source in queued]
+        return os.path.isfile(self.segment_path(start, tokens))
+
+    def seal_segment(self):
+        start, writer = self.segment
+        self.segment = None
+        if writer is None:
+            self.segments_cached += 1
+            return
+        writer.close()
+        os.replace(self.live_mp4_path, self.segment_path(start, self.tokens[start:]))
+        self.segments_encoded += 1
+
+    def finish(self, hold_last=frame_export.HOLD_LAST_FRAMES):
+        """
+        Drains the queue and finalizes dst.gif and dst.mp4. Returns the
+        export report, or None when the regular export has to run instead.
+        """
+
+        started = time.perf_counter()
+        self.finishing.set()
+        self.inbox.put(_STOP)
+        self.join()
+
+        try:
+            if self.error is not None or not self.sources:
+                return None
+
+            if self.segment is not None:
+                self.seal_segment()
+            for _ in range(hold_last):
+                self.gif_writer.append_data(self.last_frame)
+            self.gif_writer.close()
+            self.gif_writer = None
+
+            # the session as the regular export would see it
+            sources = frame_export.list_frame_sources(self.target_dir, self.target_file_type)
+            size = self.export_size()
+            tokens = [mp4_segments.frame_token(source, self.stores) for source in sources]
+            if size != self.size or tokens != self.tokens:
+                print("Live export does not match the session anymore, exporting again..")
+                return None
+            os.replace(self.live_gif_path, self.gif_path)
+
+            mp4 = mp4_segments.SegmentedMp4Export(
+                sources, size, self.framerate, f"{self.target_dir}/dst.mp4", self.cache_dir,
+                hold_last=hold_last, segment_frames=self.segment_frames, metrics=self.metrics
+            )
+            mp4.run()
+            report = {
+                "gif": {"frames": self.frame_count + hold_last, "elapsed": self.gif_busy, "busy": self.gif_busy,
+                        "error": None},
+                "mp4": mp4.report(),
+                "total": {"elapsed": time.perf_counter() - started},
+            }
+            if mp4.error is not None:
+                return None
+            print(f"live export finished in {report['total']['elapsed']:.2f}s "
+                  f"({self.segments_encoded} segments encoded live, {report['mp4']['cached']} cached)")
+            return report
+        finally:
+            self.close()
+
+    def discard(self):
+        """
+        Stops the live encoder without producing any output
+        """
+
+        self.finishing.set()
+        self.inbox.put(_STOP)
+        self.join()
+        self.close()
+
+    def close(self):
+        if self.gif_writer is not None:
+            self.gif_writer.close()
+            self.gif_writer = None
+        if self.segment is not None and self.segment[1] is not None:
+            self.segment[1].close()
+            self.segment = None
+        for path in (self.live_gif_path, self.live_mp4_path):
+            if os.path.exists(path):
+                os.remove(path)
+        for store in self.stores.values():
+            store.close()
+        self.stores = {}
+        frame_store.close_open_stores(self.target_dir)
+
+
+class _NoTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
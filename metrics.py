@@ -0,0 +1,287 @@
+"""
+Session metrics: stage latency histograms, byte and frame counters, gauges
+and peak RSS.
+
+A Metrics object is handed to the capture pipeline and the exporter of one
+session. Every stage reports its latency into a histogram, so a slow session
+can be pinned on PSD parsing, hashing, PNG writing, GIF quantization or MP4
+encoding. Snapshots export as JSON or Prometheus text exposition format.
+
+SessionProfiler optionally profiles the worker threads of a session with
+cProfile or pyinstrument.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+
+# seconds; Prometheus style cumulative "le" buckets
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+)
+
+PREFIX = "psd_recorder"
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-quantile
+        """
+
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "max": self.max,
+            "buckets": dict(zip([str(bound) for bound in self.buckets] + ["+Inf"], self.counts)),
+        }
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in bytes, None when unknown
+    """
+
+    try:
+        import resource
+    except ImportError:
+        resource = None
+
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    try:
+        import psutil
+    except ImportError:
+        return None
+    info = psutil.Process().memory_info()
+    return getattr(info, "peak_wset", info.rss)
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.started_at = time.time()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - started)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        """
+        Sets a value that goes up and down, e.g. the current poll interval
+        """
+
+        with self.lock:
+            self.gauges[name] = value
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "uptime": time.time() - self.started_at,
+                "peak_rss": peak_rss(),
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "stages": {stage: histogram.snapshot() for stage, histogram in self.histograms.items()},
+            }
+
+    def to_json(self, indent=2):
+        return json.dumps(self.snapshot(), indent=indent, sort_keys=True)
+
+    def to_prometheus(self):
+        with self.lock:
+            lines = [
+                f"# TYPE {PREFIX}_stage_seconds histogram",
+            ]
+            for stage, histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{PREFIX}_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+                lines.append(f"{PREFIX}_{name}_total {value}")
+
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f"# TYPE {PREFIX}_{name} gauge")
+                lines.append(f"{PREFIX}_{name} {value}")
+
+        rss = peak_rss()
+        if rss is not None:
+            lines.append(f"# TYPE {PREFIX}_peak_rss_bytes gauge")
+            lines.append(f"{PREFIX}_peak_rss_bytes {rss}")
+        return "\n".join(lines) + "\n"
+
+    def format_table(self):
+        """
+        Plain text overview for the stats panel and the console
+        """
+
+        snapshot = self.snapshot()
+        lines = [f"{'stage':<20}{'count':>7}{'mean ms':>10}{'p95 ms':>10}{'max ms':>10}"]
+        for stage, stats in sorted(snapshot["stages"].items()):
+            lines.append(
+                f"{stage:<20}{stats['count']:>7}{stats['mean'] * 1000:>10.1f}"
+                f"{stats['p95'] * 1000:>10.1f}{stats['max'] * 1000:>10.1f}"
+            )
+        lines.append("")
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append(f"{name:<32}{value:>12}")
+        for name, value in sorted(snapshot["gauges"].items()):
+            lines.append(f"{name:<32}{value:>12.3f}")
+        if snapshot["peak_rss"] is not None:
+            lines.append(f"{'peak rss MiB':<32}{snapshot['peak_rss'] / 1024 ** 2:>12.1f}")
+        return "\n".join(lines)
+
+    def save(self, dirpath, basename="metrics"):
+        """
+        Writes <basename>.json and <basename>.prom into dirpath
+        """
+
+        with open(os.path.join(dirpath, f"{basename}.json"), "w") as fp:
+            fp.write(self.to_json())
+        with open(os.path.join(dirpath, f"{basename}.prom"), "w") as fp:
+            fp.write(self.to_prometheus())
+
+
+def save_session_metrics(dirpath, session_metrics=None, profiler=None):
+    """
+    Writes a session's metrics and profile next to its frames; either may
+    be None. Failures are reported, never raised.
+    """
+
+    try:
+        if session_metrics is not None:
+            session_metrics.save(dirpath)
+        if profiler is not None:
+            path = profiler.dump(dirpath)
+            if path:
+                print(f"Profile written to {path}")
+    except Exception as e:
+        print(f"[WARNING] Can't write session metrics: {e}")
+
+
+class SessionProfiler(object):
+    """
+    Profiles every thread that runs inside thread(); kind is "cprofile"
+    or "pyinstrument". dump() writes the merged result next to the session.
+    """
+
+    def __init__(self, kind="cprofile"):
+        if kind not in ("cprofile", "pyinstrument"):
+            raise ValueError(f"Unknown profiler: {kind}")
+        self.kind = kind
+        self.lock = threading.Lock()
+        self.results = []
+
+    @contextmanager
+    def thread(self, name=None):
+        name = name or threading.current_thread().name
+        if self.kind == "cprofile":
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+        try:
+            yield
+        finally:
+            if self.kind == "cprofile":
+                profiler.disable()
+            else:
+                profiler.stop()
+            with self.lock:
+                self.results.append((name, profiler))
+
+    def dump(self, dirpath, basename="profile"):
+        """
+        cProfile: merged <basename>.pstats plus a text summary;
+        pyinstrument: one text report per thread in <basename>.txt
+        """
+
+        with self.lock:
+            results = list(self.results)
+        if not results:
+            return None
+
+        text_path = os.path.join(dirpath, f"{basename}.txt")
+        if self.kind == "cprofile":
+            import pstats
+            summary = io.StringIO()
+            stats = None
+            for _, profiler in results:
+                if stats is None:
+                    stats = pstats.Stats(profiler, stream=summary)
+                else:
+                    stats.add(profiler)
+            stats.dump_stats(os.path.join(dirpath, f"{basename}.pstats"))
+            stats.sort_stats("cumulative").print_stats(40)
+            with open(text_path, "w") as fp:
+                fp.write(summary.getvalue())
+        else:
+            with open(text_path, "w") as fp:
+                for name, profiler in results:
+                    fp.write(f"=== {name} ===\n")
+                    fp.write(profiler.output_text(unicode=False, color=False))
+                    fp.write("\n")
+        return text_path
@@ -0,0 +1,264 @@
+"""
+Segmented, cached MP4 export.
+
+The timeline is cut into fixed runs of SEGMENT_FRAMES frames (the held last
+frame gets a segment of its own). Segments are encoded in parallel, one
+ffmpeg per worker process, and joined with a stream-copy concat. Every
+segment is kept in the session's segment cache under its frame range and
+a hash of its frames and encoder settings, so exporting again after more
+recording only encodes the segments that changed: the new tail.
+
+Segment workers load and normalize their frames themselves, so frames of
+uncached segments are decoded twice per export, once for the GIF and once
+here. That buys independent, parallel segment encodes; cached segments
+cost no decode at all, and export_session shares one process budget
+between both pools.
+"""
+
+import os
+import time
+import hashlib
+import shutil
+import threading
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+
+import frame_store
+
+
+SEGMENT_FRAMES = 120
+
+CACHE_DIRNAME = "mp4_segments"
+
+# part of every segment hash; bump when the encoder settings change
+ENCODER_VERSION = 1
+
+
+def ffmpeg_exe():
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except ImportError:
+        return shutil.which("ffmpeg") or "ffmpeg"
+
+
+def frame_token(source, stores):
+    """
+    Identity of one frame source; frame files and store entries are
+    written once and never change in place. stores caches open frame stores.
+    """
+
+    if isinstance(source, frame_store.StoreFrameRef):
+        store = stores.get(source.store_path)
+        if store is None:
+            store = stores[source.store_path] = frame_store.FrameStore(source.store_path, readonly=True)
+        return f"{os.path.basename(source.store_path)}:{source.index}:{store.entry(source.index).tobytes().hex()}"
+    stat = os.stat(source)
+    return f"{os.path.basename(source)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+class Segment(object):
+
+    start = 0
+    sources = None
+    key = None
+    path = None
+
+    def __init__(self, start, sources):
+        self.start = start
+        self.sources = sources
+
+    @property
+    def end(self):
+        return self.start + len(self.sources)
+
+
+def plan_segments(sources, hold_last, segment_frames=SEGMENT_FRAMES):
+    segments = [
+        Segment(start, sources[start:start + segment_frames])
+        for start in range(0, len(sources), segment_frames)
+    ]
+    if sources and hold_last:
+        segments.append(Segment(len(sources), [sources[-1]] * hold_last))
+    return segments
+
+
+def segment_key(segment, tokens, size, framerate):
+    digest = hashlib.sha1(f"{ENCODER_VERSION}:{size[0]}x{size[1]}@{framerate}".encode("utf-8"))
+    for token in tokens:
+        digest.update(token.encode("utf-8"))
+        digest.update(b"\0")
+    return f"{segment.start:06d}-{segment.end:06d}-{digest.hexdigest()[:16]}"
+
+
+def _encode_segment(path, sources, size, framerate):
+    # runs in a worker process; returns the encode time
+    import imageio
+    from frame_export import load_normalized
+
+    started = time.perf_counter()
+    temp_path = path[:-len(".mp4")] + ".part.mp4"
+    writer = imageio.get_writer(temp_path, fps=framerate)
+    try:
+        previous = (None, None)
+        for source in sources:
+            if source is not previous[0]:
+                previous = (source, load_normalized(source, size))
+            writer.append_data(previous[1])
+    finally:
+        writer.close()
+    os.replace(temp_path, path)
+    return time.perf_counter() - started
+
+
+def concat(paths, output_path):
+    """
+    Joins encoded segments without re-encoding them
+    """
+
+    list_path = f"{output_path}.segments.txt"
+    with open(list_path, "w", encoding="utf-8") as fp:
+        for path in paths:
+            escaped = os.path.abspath(path).replace("\\", "/").replace("'", "'\\''")
+            fp.write(f"file '{escaped}'\n")
+
+    temp_path = f"{output_path}.part"
+    try:
+        subprocess.run(
+            [ffmpeg_exe(), "-y", "-loglevel", "error", "-f", "concat", "-safe", "0",
+             "-i", list_path, "-c", "copy", "-f", "mp4", temp_path],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        os.replace(temp_path, output_path)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"ffmpeg concat failed: {e.stderr.decode(errors='replace').strip()}")
+    finally:
+        os.remove(list_path)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+class SegmentedMp4Export(threading.Thread):
+    """
+    Exports one session's MP4 next to the GIF encoder; report() matches
+    ExportSink.report() plus segment counts
+    """
+
+    sink_name = "mp4"
+    elapsed = 0.0
+    busy = 0.0
+    frame_count = 0
+    encoded_count = 0
+    cached_count = 0
+    error = None
+    segments = None
+    missing = None
+
+    def __init__(self, sources, size, framerate, output_path, cache_dir, hold_last=0, workers=1,
+                 segment_frames=SEGMENT_FRAMES, metrics=None, prune=True):
+        """
+        prune drops cached segments the timeline no longer uses; turn it off
+        when exporting only part of a session
+        """
+
+        super(SegmentedMp4Export, self).__init__(name="export-mp4")
+        self.daemon = True
+        self.sources = list(sources)
+        self.size = size
+        self.framerate = framerate
+        self.output_path = output_path
+        self.cache_dir = cache_dir
+        self.hold_last = hold_last
+        self.workers = max(1, workers)
+        self.segment_frames = segment_frames
+        self.metrics = metrics
+        self.prune_cache = prune
+
+    def run(self):
+        started = time.perf_counter()
+        try:
+            self.export()
+        except Exception as e:
+            print(f"[ERROR] mp4 export failed: {e}")
+            self.error = e
+        finally:
+            self.elapsed = time.perf_counter() - started
+
+    def plan(self):
+        """
+        Keys every segment and finds the ones not in the cache yet;
+        returns how many have to be encoded
+        """
+
+        if self.segments is not None:
+            return len(self.missing)
+
+        segments = plan_segments(self.sources, self.hold_last, self.segment_frames)
+        tokens = {}
+        stores = {}
+        try:
+            for segment in segments:
+                for source in segment.sources:
+                    if id(source) not in tokens:
+                        tokens[id(source)] = frame_token(source, stores)
+        finally:
+            for store in stores.values():
+                store.close()
+
+        for segment in segments:
+            segment.key = segment_key(segment, [tokens[id(source)] for source in segment.sources],
+                                      self.size, self.framerate)
+            segment.path = os.path.join(self.cache_dir, f"{segment.key}.mp4")
+            self.frame_count += len(segment.sources)
+
+        self.segments = segments
+        self.missing = [segment for segment in segments if not os.path.isfile(segment.path)]
+        self.cached_count = len(segments) - len(self.missing)
+        return len(self.missing)
+
+    def export(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.plan()
+        segments = self.segments
+        missing = self.missing
+        print(f"mp4: {len(segments)} segments, {self.cached_count} cached, encoding {len(missing)}..")
+
+        if missing:
+            with ProcessPoolExecutor(min(self.workers, len(missing))) as pool:
+                futures = [
+                    pool.submit(_encode_segment, segment.path, segment.sources, self.size, self.framerate)
+                    for segment in missing
+                ]
+                for future in as_completed(futures):
+                    elapsed = future.result()
+                    self.busy += elapsed
+                    self.encoded_count += 1
+                    if self.metrics is not None:
+                        self.metrics.observe("export.mp4_segment", elapsed)
+
+        concat_started = time.perf_counter()
+        concat([segment.path for segment in segments], self.output_path)
+        if self.metrics is not None:
+            self.metrics.observe("export.mp4_concat", time.perf_counter() - concat_started)
+            self.metrics.count("mp4_segments_encoded", self.encoded_count)
+            self.metrics.count("mp4_segments_cached", self.cached_count)
+
+        if self.prune_cache:
+            self.prune({os.path.basename(segment.path) for segment in segments})
+
+    def prune(self, keep):
+        # segments of earlier, different timelines
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".mp4") and name not in keep:
+                os.remove(os.path.join(self.cache_dir, name))
+
+    def report(self):
+        return {
+            "frames": self.frame_count,
+            "elapsed": self.elapsed,
+            "busy": self.busy,
+            "segments": self.encoded_count + self.cached_count,
+            "cached": self.cached_count,
+            "error": str(self.error) if self.error else None,
+        }
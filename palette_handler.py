@@ -1,12 +1,90 @@
 
-import random
-import math
-
-from win32com import client
+import time
+import json
+from collections import deque
 
 from PySide import QtGui
 from PySide import QtCore
-from PySide.QtCore import Qt
+
+import photoshop
+from palette_raster import PaletteRaster
+from palette_raster import StageSampler
+
+
+# how often the cached Photoshop foreground color is re-read
+FOREGROUND_REFRESH_MS = 1000
+
+
+class EventTimings(object):
+    """
+    Handling time of the last few hundred events per event name
+    """
+
+    def __init__(self, size=512):
+        self.size = size
+        self.durations = {}
+
+    def record(self, name, seconds):
+        if name not in self.durations:
+            self.durations[name] = deque(maxlen=self.size)
+        self.durations[name].append(seconds)
+
+    def summary(self):
+        result = {}
+        for name, durations in self.durations.items():
+            ordered = sorted(durations)
+            result[name] = {
+                "count": len(ordered),
+                "mean_ms": 1000.0 * sum(ordered) / len(ordered),
+                "p95_ms": 1000.0 * ordered[int(len(ordered) * 0.95)],
+                "max_ms": 1000.0 * ordered[-1],
+            }
+        return result
+
+
+class RasterItem(QtGui.QGraphicsItem):
+    """
+    Shows a PaletteRaster; update(rect) repaints only that part of it
+    """
+
+    raster = None
+    image = None
+
+    def __init__(self, raster):
+        super(RasterItem, self).__init__()
+        self.setFlag(QtGui.QGraphicsItem.ItemUsesExtendedStyleOption)
+        self.set_raster(raster)
+
+    def set_raster(self, raster):
+        # the QImage shares the numpy buffer, rebuilt when the buffer changes
+        self.prepareGeometryChange()
+        self.raster = raster
+        width, height = raster.size
+        self.image = QtGui.QImage(raster.pixels.data, width, height, width * 3, QtGui.QImage.Format_RGB888)
+
+    def boundingRect(self):
+        return QtCore.QRectF(0.0, 0.0, self.image.width(), self.image.height())
+
+    def paint(self, painter, option, widget=None):
+        rect = option.exposedRect.toAlignedRect().intersected(self.image.rect())
+        painter.drawImage(rect, self.image, rect)
+
+    def update_rect(self, rect):
+        if rect:
+            left, top, right, bottom = rect
+            self.update(QtCore.QRectF(left, top, right - left, bottom - top))
+
+
+def timed_event(name):
+    def decorate(handler):
+        def wrapper(self, e=None):
+            started = time.perf_counter()
+            try:
+                return handler(self, e)
+            finally:
+                self.event_timings.record(name, time.perf_counter() - started)
+        return wrapper
+    return decorate
 
 
 class PaletteHandler(object):
@@ -14,21 +92,42 @@ class PaletteHandler(object):
     BRUSH_RADIUS = 10.0
     BRUSH_DECAY = 0.88
 
+    # strokes kept for save_strokes, oldest dropped first
+    RECORDED_STROKES = 200
+
     pressed_mouse_buttons = []
 
     stage = None
     target_view = None
+    raster = None
+    raster_item = None
 
-    # reset every mouse release
-    painting_items = []
-    paint_intense = 0.0
+    # pen pressure, 1.0 for the mouse
+    paint_intense = 1.0
     last_pos = (0, 0)
 
+    # [(x, y, pressure), ...] of the stroke being painted
+    current_stroke = None
+
     def __init__(self, target_view):
         self.palette_view = target_view
+        self.event_timings = EventTimings()
+        self.connection = photoshop.shared_connection()
+        self.foreground = photoshop.ForegroundColorSync(self.connection)
+        self.foreground.refresh()
+
+        # colors picked in Photoshop show up without a click
+        self.refresh_timer = QtCore.QTimer()
+        self.refresh_timer.timeout.connect(self.refresh_foreground_color)
+        self.refresh_timer.start(FOREGROUND_REFRESH_MS)
 
         self.stage = QtGui.QGraphicsScene()
         self.palette_view.setScene(self.stage)
+        self.raster = PaletteRaster(self.palette_view.width(), self.palette_view.height())
+        self.raster_item = RasterItem(self.raster)
+        self.sampler = StageSampler(self.raster)
+        self.stage.addItem(self.raster_item)
+        self.recorded_strokes = deque(maxlen=self.RECORDED_STROKES)
         self.palette_view.mousePressEvent = self.mouse_press
         self.palette_view.mouseMoveEvent = self.mouse_move
         self.palette_view.mouseReleaseEvent = self.mouse_release
@@ -36,115 +135,77 @@ class PaletteHandler(object):
         self.palette_view.setMouseTracking(True)
 
     def paint_color(self, pos, color=None):
-        radius = self.BRUSH_RADIUS
-        color = self.get_ps_foreground_color()
-        color.setAlpha(self.paint_intense * 255)
-        brush = QtGui.QBrush(color)
-
-        lx = self.last_pos.x()
-        ly = self.last_pos.y()
-        cx = pos.x()
-        cy = pos.y()
-        dx = cx - lx
-        dy = cy - ly
-        count = 2 + int((abs(dx) + abs(dy)) * 0.1)
-
-        for i in range(count):
-            prog = float(i) / count
-
-            tx = lx + dx * prog
-            ty = ly + dy * prog
-
-            rect = QtCore.QRectF(
-                tx - radius,
-                ty - radius,
-                radius * 2.0,
-                radius * 2.0
-            )
-            self.painting_items.append(
-                self.stage.addEllipse(
-                    rect,
-                    pen=QtGui.QPen(brush, 0.0),
-                    brush=brush
-                )
-            )
+        pressure = self.paint_intense
+        radius = self.BRUSH_RADIUS * (0.5 + 0.5 * pressure)
+        color = color or self.foreground.color
+
+        start = (self.last_pos.x(), self.last_pos.y())
+        end = (pos.x(), pos.y())
+        self.raster_item.update_rect(self.raster.stroke(start, end, color, radius, pressure))
+        if self.current_stroke is not None:
+            self.current_stroke.append((end[0], end[1], pressure))
 
     def static_stage(self):
-        self.stage.setSceneRect(
-            0.0, 0.0,
-            self.palette_view.width(),
-            self.palette_view.height()
-        )
+        width = self.palette_view.width()
+        height = self.palette_view.height()
+        self.stage.setSceneRect(0.0, 0.0, width, height)
+        if self.raster.size != (width, height):
+            self.raster.resize(width, height)
+            self.raster_item.set_raster(self.raster)
+
+    def save_strokes(self, path):
+        """
+        Recorded strokes as JSON, replayable with benchmark.py brush --paths
+        """
+
+        with open(path, "w") as fp:
+            json.dump({"size": self.raster.size, "strokes": list(self.recorded_strokes)}, fp)
 
     def get_ps_foreground_color(self) -> QtGui.QColor:
-        try:
-            psapp = client.Dispatch("Photoshop.Application").Application
-            r = psapp.foregroundColor.rgb.red
-            g = psapp.foregroundColor.rgb.green
-            b = psapp.foregroundColor.rgb.blue
-            return QtGui.QColor(r, g, b)
-        except:
-            return QtGui.QColor(0, 0, 0)
+        # cached; refreshed on press and by the refresh timer
+        r, g, b = self.foreground.color
+        return QtGui.QColor(r, g, b)
 
     def set_ps_foreground_color(self, color):
+        # coalesced and throttled, never blocks the event
+        self.foreground.push((color.red(), color.green(), color.blue()))
+
+    def refresh_foreground_color(self, wait=False):
         try:
-            new_color = client.Dispatch("Photoshop.SolidColor")
-            new_color.rgb.red = color.red()
-            new_color.rgb.green = color.green()
-            new_color.rgb.blue = color.blue()
-            psapp = client.Dispatch("Photoshop.Application").Application
-            psapp.foregroundColor = new_color
+            self.foreground.refresh(wait, timeout=0.5)
         except Exception as e:
-            print(e)
+            print(f"[WARNING] Can't read foreground color: {e}")
 
-    def get_stage_color(self, pos, radius=1) -> QtGui.QColor:
-        stage_image = self.palette_view.grab()
-
-        r_sum = 128
-        g_sum = 128
-        b_sum = 128
-        MONTE_CARLO_COUNT = 25
-        for _ in range(MONTE_CARLO_COUNT):
-            angle = random.random() * math.pi * 2.0
-            dist = random.random() * radius
-
-            offset_applied_pos = QtCore.QPoint(
-                pos.x() + math.cos(angle) * dist,
-                pos.y() + math.cos(angle) * dist
-            )
-
-            stage_img = stage_image.toImage()
-            if not stage_img.valid(offset_applied_pos):
-                continue
-
-            pixel_color = stage_img.pixelColor(offset_applied_pos)
-            r_sum += pixel_color.red()
-            g_sum += pixel_color.green()
-            b_sum += pixel_color.blue()
-
-        r = r_sum / MONTE_CARLO_COUNT
-        g = g_sum / MONTE_CARLO_COUNT
-        b = b_sum / MONTE_CARLO_COUNT
-
-        r = min(max(r, 0), 255)
-        g = min(max(g, 0), 255)
-        b = min(max(b, 0), 255)
+    def metrics(self):
+        return {
+            "com_calls_per_second": self.connection.calls_per_second(),
+            "foreground": self.foreground.stats(),
+            "events": self.event_timings.summary(),
+        }
 
-        return QtGui.QColor(r, g, b)
+    def get_stage_color(self, pos, radius=1) -> QtGui.QColor:
+        rgb = self.sampler.sample(pos.x(), pos.y(), radius)
+        if rgb is None:
+            # outside the palette, keep the current color
+            rgb = self.foreground.color
+        return QtGui.QColor(*rgb)
 
+    @timed_event("press")
     def mouse_press(self, e=None):
         self.pressed_mouse_buttons.append(e.button())
-        self.painting_items = []
 
         if QtCore.Qt.LeftButton in self.pressed_mouse_buttons:
+            self.refresh_foreground_color(wait=True)
+            self.static_stage()
             pos = e.pos()
             self.last_pos = pos
+            self.current_stroke = []
             self.paint_color(pos)
-            self.static_stage()
 
         if QtCore.Qt.RightButton in self.pressed_mouse_buttons:
             self.set_ps_foreground_color(self.get_stage_color(e.pos()))
 
+    @timed_event("release")
     def mouse_release(self, e=None):
         if QtCore.Qt.RightButton in self.pressed_mouse_buttons:
             self.set_ps_foreground_color(self.get_stage_color(e.pos()))
@@ -152,23 +213,15 @@ class PaletteHandler(object):
         if e.button() in self.pressed_mouse_buttons:
             self.pressed_mouse_buttons.remove(e.button())
 
-        # flatten view as bitmap
-        pixmap = QtGui.QPixmap()
-        w = pixmap.width()
-        h = pixmap.height()
-        self.palette_view.render(
-            QtGui.QPainter(pixmap), QtCore.QRectF(-1, -1, w, h), pixmap.rect(), Qt.KeepAspectRatio
-        )
-        for item in self.painting_items:
-            self.stage.removeItem(item)
-        flattened_img = self.stage.addPixmap(pixmap)
-        flattened_img.setPos(-1, -1)
+        if e.button() == QtCore.Qt.LeftButton and self.current_stroke:
+            self.recorded_strokes.append(self.current_stroke)
+            self.current_stroke = None
 
+    @timed_event("move")
     def mouse_move(self, e=None):
         pos = e.pos()
         if QtCore.Qt.LeftButton in self.pressed_mouse_buttons:
             self.paint_color(pos)
-            self.static_stage()
             self.last_pos = pos
 
         if QtCore.Qt.RightButton in self.pressed_mouse_buttons:
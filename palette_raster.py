@@ -0,0 +1,214 @@
+"""
+Raster backing store of the color palette.
+
+The palette is one RGB numpy buffer. A brush dab is a precomputed soft disc
+mask, scaled by pen pressure and blended into the buffer over its bounding
+box only; every call returns the dirty rectangle so the view repaints just
+that part. Painting cost no longer depends on how much was painted before.
+"""
+
+import numpy as np
+
+
+BACKGROUND_COLOR = (255, 255, 255)
+
+# masks are cached per radius, rounded to this step
+RADIUS_STEP = 0.25
+
+
+def soft_disc(radius, hardness=0.6):
+    """
+    (2r+1, 2r+1) float32 coverage of a disc, solid up to hardness * radius
+    and fading out linearly to the edge
+    """
+
+    size = int(np.ceil(radius)) * 2 + 1
+    center = size // 2
+    y, x = np.mgrid[:size, :size]
+    distance = np.hypot(x - center, y - center)
+    inner = radius * hardness
+    mask = np.clip((radius - distance) / max(radius - inner, 1e-6), 0.0, 1.0)
+    return mask.astype(np.float32)
+
+
+class BrushMask(object):
+
+    hardness = 0.6
+
+    def __init__(self, hardness=0.6):
+        self.hardness = hardness
+        self.masks = {}
+
+    def __call__(self, radius):
+        key = max(RADIUS_STEP, round(radius / RADIUS_STEP) * RADIUS_STEP)
+        mask = self.masks.get(key)
+        if mask is None:
+            mask = soft_disc(key, self.hardness)
+            self.masks[key] = mask
+        return mask
+
+
+def union_rect(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+class PaletteRaster(object):
+    """
+    RGB pixels of the palette; rects are (left, top, right, bottom)
+    """
+
+    pixels = None
+
+    # bumped on every change, lets readers cache derived data
+    version = 0
+
+    def __init__(self, width, height, background=BACKGROUND_COLOR, brush=None):
+        self.background = background
+        self.brush = brush or BrushMask()
+        self.pixels = np.empty((max(1, height), max(1, width), 3), dtype=np.uint8)
+        self.pixels[:] = background
+        self.version = 0
+
+    @property
+    def size(self):
+        return (self.pixels.shape[1], self.pixels.shape[0])
+
+    def resize(self, width, height):
+        """
+        Grows or crops the canvas keeping the top left content
+        """
+
+        if (width, height) == self.size:
+            return
+        pixels = np.empty((max(1, height), max(1, width), 3), dtype=np.uint8)
+        pixels[:] = self.background
+        h = min(height, self.pixels.shape[0])
+        w = min(width, self.pixels.shape[1])
+        pixels[:h, :w] = self.pixels[:h, :w]
+        self.pixels = pixels
+        self.version += 1
+
+    def clear(self):
+        self.pixels[:] = self.background
+        self.version += 1
+        return (0, 0) + self.size
+
+    def stamp(self, x, y, color, radius, opacity=1.0):
+        """
+        Blends one dab centered at (x, y), returns the dirty rect or None
+        """
+
+        mask = self.brush(radius)
+        half = mask.shape[0] // 2
+        cx = int(round(x))
+        cy = int(round(y))
+        height, width = self.pixels.shape[:2]
+
+        left = max(cx - half, 0)
+        top = max(cy - half, 0)
+        right = min(cx + half + 1, width)
+        bottom = min(cy + half + 1, height)
+        if left >= right or top >= bottom or opacity <= 0:
+            return None
+
+        coverage = mask[top - cy + half:bottom - cy + half, left - cx + half:right - cx + half, None] * opacity
+        region = self.pixels[top:bottom, left:right]
+        blended = region + (np.asarray(color, dtype=np.float32) - region) * coverage
+        region[:] = blended + 0.5
+        self.version += 1
+        return (left, top, right, bottom)
+
+    def stroke(self, start, end, color, radius, opacity=1.0):
+        """
+        Dabs from start towards end (end itself is the next segment's start),
+        returns the dirty rect or None
+        """
+
+        (lx, ly), (cx, cy) = start, end
+        dx = cx - lx
+        dy = cy - ly
+        count = 2 + int((abs(dx) + abs(dy)) * 0.1)
+
+        dirty = None
+        for i in range(count):
+            progress = float(i) / count
+            dirty = union_rect(dirty, self.stamp(lx + dx * progress, ly + dy * progress, color, radius, opacity))
+        return dirty
+
+
+def disc_weights(radius):
+    """
+    Square float32 share of every pixel covered by a disc of radius around
+    the center pixel, anti-aliased over one pixel at the edge
+    """
+
+    size = int(np.ceil(radius + 0.5)) * 2 + 1
+    center = size // 2
+    y, x = np.mgrid[:size, :size]
+    distance = np.hypot(x - center, y - center)
+    return np.clip(radius + 0.5 - distance, 0.0, 1.0).astype(np.float32)
+
+
+class StageSampler(object):
+    """
+    Disc-weighted average color of a PaletteRaster around a point.
+    Deterministic: the same raster, point and radius give the same color,
+    so the last result is reused until the raster changes.
+    """
+
+    raster = None
+
+    def __init__(self, raster):
+        self.raster = raster
+        self.weights = {}
+        self.last = None
+
+    def disc(self, radius):
+        """
+        (weights, their sum) for radius
+        """
+
+        key = round(radius / RADIUS_STEP) * RADIUS_STEP
+        disc = self.weights.get(key)
+        if disc is None:
+            weights = disc_weights(key)
+            disc = (weights, float(weights.sum()))
+            self.weights[key] = disc
+        return disc
+
+    def sample(self, x, y, radius=1.0):
+        """
+        (r, g, b) around (x, y); the part of the disc outside the raster is
+        left out of the average. None when the disc misses the raster.
+        """
+
+        cx = int(round(x))
+        cy = int(round(y))
+        key = (self.raster.version, id(self.raster.pixels), cx, cy, radius)
+        if self.last is not None and self.last[0] == key:
+            return self.last[1]
+
+        weights, total = self.disc(radius)
+        half = weights.shape[0] // 2
+        pixels = self.raster.pixels
+        height, width = pixels.shape[:2]
+
+        left = max(cx - half, 0)
+        top = max(cy - half, 0)
+        right = min(cx + half + 1, width)
+        bottom = min(cy + half + 1, height)
+        result = None
+        if left < right and top < bottom:
+            window = weights[top - cy + half:bottom - cy + half, left - cx + half:right - cx + half]
+            if window.shape != weights.shape:
+                # clipped at the raster edge
+                total = float(window.sum())
+            if total > 0:
+                rgb = window.ravel() @ pixels[top:bottom, left:right].reshape(-1, 3) / total
+                result = tuple(int(value + 0.5) for value in rgb)
+        self.last = (key, result)
+        return result
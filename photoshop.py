@@ -0,0 +1,540 @@
+"""
+One shared connection to Photoshop.
+
+Every COM call is a cross-process round trip, and Dispatch is several of
+them. PhotoshopConnection keeps the application proxy (and briefly the
+active document) around, runs every call on one dedicated apartment thread,
+and reconnects when Photoshop was restarted under it. Scalar properties are
+read in one go through DoJavaScript where Photoshop supports it.
+
+The COM layer is a pluggable backend: ComBackend talks to the real
+Photoshop through win32com, FakeBackend simulates one in memory (with
+configurable latency and a call counter) so the manager runs on any OS.
+"""
+
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+
+APPLICATION_PROG_ID = "Photoshop.Application"
+SOLID_COLOR_PROG_ID = "Photoshop.SolidColor"
+
+# seconds the active document proxy is reused; the user may switch documents
+DOCUMENT_TTL = 1.0
+
+# minimum seconds between two foreground color writes
+COLOR_PUSH_INTERVAL = 0.05
+
+# seconds the blocking GUI facing calls wait for the COM thread
+GUI_CALL_TIMEOUT = 30.0
+
+_STOP = object()
+
+
+class ComBackend(object):
+
+    # HRESULTs of a server that went away (RPC_E_DISCONNECTED,
+    # RPC_S_SERVER_UNAVAILABLE, RPC_S_CALL_FAILED, CO_E_OBJNOTCONNECTED)
+    DISCONNECT_HRESULTS = (-2147417848, -2147023174, -2147023170, -2147220995)
+
+    def initialize_thread(self):
+        import pythoncom
+        pythoncom.CoInitialize()
+
+    def uninitialize_thread(self):
+        import pythoncom
+        pythoncom.CoUninitialize()
+
+    def dispatch(self, prog_id):
+        from win32com import client
+        return client.Dispatch(prog_id)
+
+    def is_disconnect_error(self, error):
+        hresult = getattr(error, "hresult", None)
+        if hresult is None and error.args and isinstance(error.args[0], int):
+            hresult = error.args[0]
+        return hresult in self.DISCONNECT_HRESULTS
+
+
+class FakeDisconnectedError(Exception):
+    pass
+
+
+class FakeRGBColor(object):
+
+    def __init__(self, red=0, green=0, blue=0):
+        self.red = red
+        self.green = green
+        self.blue = blue
+
+
+class FakeSolidColor(object):
+
+    def __init__(self, red=0, green=0, blue=0):
+        self.rgb = FakeRGBColor(red, green, blue)
+
+
+class FakeDocument(object):
+
+    def __init__(self, path="C:/art/", name="sketch.psd", width=1920.0, height=1080.0):
+        self.path = path
+        self.name = name
+        self.width = width
+        self.height = height
+        self.saved_count = 0
+
+    def save(self):
+        self.saved_count += 1
+
+    def ResizeImage(self, width, height):
+        self.width = float(width)
+        self.height = float(height)
+
+
+class FakePhotoshop(object):
+
+    def __init__(self):
+        self.foregroundColor = FakeSolidColor()
+        self.activeDocument = FakeDocument()
+
+    @property
+    def Application(self):
+        return self
+
+    @property
+    def ActiveDocument(self):
+        return self.activeDocument
+
+    def DoJavaScript(self, script):
+        # understands exactly the batches read_properties sends
+        expressions = script[script.index("[") + 1:script.rindex("]")].split(", ")
+        values = []
+        for expression in expressions:
+            value = self
+            for name in expression.split(".")[1:]:
+                value = getattr(value, name)
+            values.append(str(value))
+        return "\n".join(values)
+
+
+class _FakeProxy(object):
+    """
+    Counts and delays every attribute access and call like a COM proxy
+    """
+
+    def __init__(self, backend, target, generation):
+        object.__setattr__(self, "_backend", backend)
+        object.__setattr__(self, "_target", target)
+        object.__setattr__(self, "_generation", generation)
+
+    def _round_trip(self):
+        self._backend.round_trip(self._generation)
+
+    def __getattr__(self, name):
+        self._round_trip()
+        value = getattr(self._target, name)
+        if callable(value):
+            return _FakeMethod(self._backend, value, self._generation)
+        if isinstance(value, (int, float, str, bool)) or value is None:
+            return value
+        return _FakeProxy(self._backend, value, self._generation)
+
+    def __setattr__(self, name, value):
+        self._round_trip()
+        if isinstance(value, _FakeProxy):
+            value = value._target
+        setattr(self._target, name, value)
+
+
+class _FakeMethod(object):
+
+    def __init__(self, backend, method, generation):
+        self.backend = backend
+        self.method = method
+        self.generation = generation
+
+    def __call__(self, *args):
+        self.backend.round_trip(self.generation)
+        return self.method(*args)
+
+
+class FakeBackend(object):
+    """
+    In-memory Photoshop; com_calls counts round trips the real one would make
+    """
+
+    def __init__(self, call_latency=0.0, dispatch_latency=0.0, javascript=True):
+        self.call_latency = call_latency
+        self.dispatch_latency = dispatch_latency
+        self.app = FakePhotoshop()
+        if not javascript:
+            self.app.DoJavaScript = None
+        self.generation = 0
+        self.com_calls = 0
+        self.dispatches = 0
+        self.lock = threading.Lock()
+
+    def initialize_thread(self):
+        pass
+
+    def uninitialize_thread(self):
+        pass
+
+    def round_trip(self, generation):
+        with self.lock:
+            self.com_calls += 1
+        if self.call_latency:
+            time.sleep(self.call_latency)
+        if generation != self.generation:
+            raise FakeDisconnectedError("The object invoked has disconnected from its clients.")
+
+    def dispatch(self, prog_id):
+        with self.lock:
+            self.dispatches += 1
+            self.com_calls += 1
+        if self.dispatch_latency:
+            time.sleep(self.dispatch_latency)
+        if prog_id == SOLID_COLOR_PROG_ID:
+            return _FakeProxy(self, FakeSolidColor(), self.generation)
+        return _FakeProxy(self, self.app, self.generation)
+
+    def restart(self):
+        """
+        Simulates Photoshop restarting: every proxy handed out so far is dead
+        """
+
+        self.generation += 1
+
+    def is_disconnect_error(self, error):
+        return isinstance(error, FakeDisconnectedError)
+
+
+class PhotoshopConnection(object):
+
+    backend = None
+    calls = 0
+    reconnects = 0
+    supports_javascript = True
+    # why the COM thread could not start; every call fails with it
+    error = None
+
+    def __init__(self, backend=None):
+        self.backend = backend or ComBackend()
+        self.requests = queue.Queue()
+        self.calls = 0
+        self.reconnects = 0
+        self.busy = 0.0
+        self.call_times = deque(maxlen=4096)
+        self._app = None
+        self._document = None
+        self._document_at = 0.0
+        self.lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self._serve, name="photoshop-com")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _serve(self):
+        try:
+            self.backend.initialize_thread()
+        except Exception as e:
+            print(f"[ERROR] Can't start the Photoshop COM thread: {e}")
+            self._fail(e)
+            return
+
+        try:
+            while True:
+                request = self.requests.get()
+                if request is _STOP:
+                    break
+                future, func, args = request
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                started = time.perf_counter()
+                try:
+                    future.set_result(self._with_reconnect(func, args))
+                except Exception as e:
+                    future.set_exception(e)
+                self.busy += time.perf_counter() - started
+        finally:
+            self._app = None
+            self._document = None
+            self.backend.uninitialize_thread()
+
+    def _fail(self, error):
+        # fails what is queued; submit() fails everything after
+        with self.lock:
+            self.error = error
+        while True:
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            if request is not _STOP and request[0].set_running_or_notify_cancel():
+                request[0].set_exception(error)
+
+    def _with_reconnect(self, func, args):
+        try:
+            return func(self, *args)
+        except Exception as e:
+            if not self.backend.is_disconnect_error(e):
+                raise
+        # Photoshop was restarted; one retry on fresh proxies
+        self._app = None
+        self._document = None
+        self.reconnects += 1
+        return func(self, *args)
+
+    def submit(self, func, *args):
+        """
+        Runs func(connection, *args) on the COM thread, returns a Future
+        """
+
+        future = Future()
+        self.calls += 1
+        self.call_times.append(time.perf_counter())
+        with self.lock:
+            if self.error is None:
+                self.requests.put((future, func, args))
+                return future
+        future.set_exception(self.error)
+        return future
+
+    def call(self, func, *args, timeout=None):
+        return self.submit(func, *args).result(timeout)
+
+    def close(self):
+        self.requests.put(_STOP)
+        self.thread.join()
+        self._fail(RuntimeError("Photoshop connection closed"))
+
+    # only from the COM thread
+
+    def application(self):
+        if self._app is None:
+            self._app = self.backend.dispatch(APPLICATION_PROG_ID).Application
+        return self._app
+
+    def document(self, fresh=False):
+        """
+        Active document proxy; fresh looks it up again, for calls that
+        must act on the document the user has open right now
+        """
+
+        now = time.time()
+        if fresh or self._document is None or now - self._document_at > DOCUMENT_TTL:
+            self._document = self.application().ActiveDocument
+            self._document_at = now
+        return self._document
+
+    def read_properties(self, paths):
+        """
+        Values of dotted application property paths, e.g.
+        "foregroundColor.rgb.red", in one round trip when possible
+        """
+
+        app = self.application()
+        if self.supports_javascript:
+            script = "[" + ", ".join("app." + path for path in paths) + "].join('\\n')"
+            try:
+                return [_parse_value(value) for value in str(app.DoJavaScript(script)).split("\n")]
+            except Exception as e:
+                if self.backend.is_disconnect_error(e):
+                    raise
+                self.supports_javascript = False
+
+        values = []
+        for path in paths:
+            value = app
+            for name in path.split("."):
+                value = getattr(value, name)
+            values.append(value)
+        return values
+
+    # GUI facing calls, blocking for at most timeout seconds
+
+    def active_document_path(self, timeout=GUI_CALL_TIMEOUT):
+        def lookup(connection):
+            # never cached, the user may have switched documents
+            doc = connection.document(fresh=True)
+            return f"{doc.path}{doc.name}"
+        return self.call(lookup, timeout=timeout)
+
+    def foreground_color(self, timeout=GUI_CALL_TIMEOUT):
+        """
+        (r, g, b) of the foreground color
+        """
+
+        return self.call(read_foreground_color, timeout=timeout)
+
+    def set_foreground_color(self, rgb, timeout=GUI_CALL_TIMEOUT):
+        return self.call(write_foreground_color, tuple(rgb), timeout=timeout)
+
+    def save_active_document(self, timeout=GUI_CALL_TIMEOUT):
+        return self.call(lambda connection: connection.document(fresh=True).save(), timeout=timeout)
+
+    def resize_active_document(self, multiple=16, timeout=GUI_CALL_TIMEOUT):
+        """
+        Crops the canvas size down to a multiple of multiple pixels
+        """
+
+        def resize(connection):
+            doc = connection.document(fresh=True)
+            width = doc.width
+            height = doc.height
+            doc.ResizeImage(int(width - (width % multiple)), int(height - (height % multiple)))
+        return self.call(resize, timeout=timeout)
+
+    def calls_per_second(self, window=1.0):
+        since = time.perf_counter() - window
+        return sum(1 for called_at in list(self.call_times) if called_at >= since) / window
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "calls_per_second": self.calls_per_second(),
+            "reconnects": self.reconnects,
+            "busy": self.busy,
+        }
+
+
+def read_foreground_color(connection):
+    values = connection.read_properties(
+        ["foregroundColor.rgb.red", "foregroundColor.rgb.green", "foregroundColor.rgb.blue"]
+    )
+    return tuple(int(round(float(value))) for value in values)
+
+
+def write_foreground_color(connection, rgb):
+    color = connection.backend.dispatch(SOLID_COLOR_PROG_ID)
+    color_rgb = color.rgb
+    color_rgb.red, color_rgb.green, color_rgb.blue = rgb
+    connection.application().foregroundColor = color
+
+
+class ForegroundColorSync(object):
+    """
+    Cached copy of the Photoshop foreground color.
+
+    Reads only happen on refresh(); push() updates the cache right away and
+    writes to Photoshop in the background, at most one write in flight and
+    at most one per min_interval. Pushes made meanwhile are coalesced, the
+    newest one is written next.
+    """
+
+    connection = None
+    color = (0, 0, 0)
+    min_interval = COLOR_PUSH_INTERVAL
+
+    pushes = 0
+    writes = 0
+    refreshes = 0
+
+    def __init__(self, connection, min_interval=COLOR_PUSH_INTERVAL):
+        self.connection = connection
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.pending = None
+        self.in_flight = False
+        self.last_write_at = 0.0
+
+    def refresh(self, wait=False, timeout=None):
+        """
+        Reads the color from Photoshop; with wait the call blocks until the
+        cache is updated. A refresh never overwrites a pending push.
+        """
+
+        future = self.connection.submit(read_foreground_color)
+        future.add_done_callback(self._on_read)
+        if wait:
+            future.result(timeout)
+        return future
+
+    def _on_read(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        with self.lock:
+            self.refreshes += 1
+            if self.pending is None and not self.in_flight:
+                self.color = future.result()
+
+    def push(self, rgb):
+        rgb = tuple(int(value) for value in rgb)
+        with self.lock:
+            self.pushes += 1
+            self.color = rgb
+            self.pending = rgb
+            if self.in_flight:
+                return
+            self.in_flight = True
+        self._write_when_due()
+
+    def _write_when_due(self):
+        delay = self.last_write_at + self.min_interval - time.perf_counter()
+        if delay > 0:
+            timer = threading.Timer(delay, self._write)
+            timer.daemon = True
+            timer.start()
+        else:
+            self._write()
+
+    def _write(self):
+        with self.lock:
+            rgb, self.pending = self.pending, None
+            self.last_write_at = time.perf_counter()
+            self.writes += 1
+        # the callback may run right here, so never under the lock
+        self.connection.submit(write_foreground_color, rgb).add_done_callback(self._on_written)
+
+    def _on_written(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            print(f"[WARNING] Can't set foreground color: {future.exception()}")
+        with self.lock:
+            if self.pending is None:
+                self.in_flight = False
+                return
+        self._write_when_due()
+
+    def flush(self, timeout=None):
+        """
+        Blocks until every pushed color has been written
+        """
+
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            with self.lock:
+                if not self.in_flight and self.pending is None:
+                    return True
+            if deadline is not None and time.perf_counter() > deadline:
+                return False
+            time.sleep(0.005)
+
+    def stats(self):
+        return {"pushes": self.pushes, "writes": self.writes, "refreshes": self.refreshes}
+
+
+def _parse_value(value):
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+_shared_connection = None
+_shared_lock = threading.Lock()
+
+
+def shared_connection(backend=None):
+    """
+    The process wide connection, created on first use
+    """
+
+    global _shared_connection
+    with _shared_lock:
+        if _shared_connection is None:
+            _shared_connection = PhotoshopConnection(backend)
+        return _shared_connection
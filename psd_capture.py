@@ -0,0 +1,435 @@
+"""
+Fast snapshot capture from a PSD file.
+
+psd_tools parses and decodes every layer before it can hand out an image. For
+snapshots we only need the flattened result, which Photoshop already stores
+when "maximize compatibility" is on, together with a small JPEG thumbnail in
+the image resources. This module walks the PSD sections directly and decodes
+only what it needs:
+
+ - thumbnail: embedded thumbnail resource, used when the output is small
+ - strips: the flattened image data, decoded a few rows at a time and
+   box-filtered straight into the output size, so memory follows the
+   output rather than the canvas
+ - merged: the flattened image data section at full size
+ - composite: full layer compositing through psd_tools (slow path)
+
+File format reference: Adobe Photoshop File Formats Specification.
+"""
+
+import io
+import zlib
+import struct
+
+import numpy as np
+from PIL import Image
+
+
+CAPTURE_THUMBNAIL = "thumbnail"
+CAPTURE_STRIPS = "strips"
+CAPTURE_MERGED = "merged"
+CAPTURE_COMPOSITE = "composite"
+
+CAPTURE_PATHS = (CAPTURE_THUMBNAIL, CAPTURE_STRIPS, CAPTURE_MERGED, CAPTURE_COMPOSITE)
+
+RESOURCE_THUMBNAIL_PS4 = 1033
+RESOURCE_THUMBNAIL = 1036
+RESOURCE_VERSION_INFO = 1057
+
+COLOR_MODE_GRAYSCALE = 1
+COLOR_MODE_RGB = 3
+
+COMPRESSION_RAW = 0
+COMPRESSION_RLE = 1
+COMPRESSION_ZIP = 2
+COMPRESSION_ZIP_PREDICTION = 3
+
+# decoded bytes per strip of one channel
+STRIP_BYTES = 1024 * 1024
+
+
+class PSDFormatError(Exception):
+    pass
+
+
+class PSDLayout(object):
+    """
+    Byte offsets of the PSD sections, read without decoding anything
+    """
+
+    version = 1
+    channels = 0
+    height = 0
+    width = 0
+    depth = 0
+    color_mode = 0
+
+    # resource id -> (offset, length)
+    resources = None
+    image_data_offset = 0
+
+    @property
+    def is_psb(self):
+        return self.version == 2
+
+    @property
+    def size(self):
+        return (self.width, self.height)
+
+    @property
+    def has_real_merged_data(self):
+        # absent version info means an old writer, which always stored merged data
+        return getattr(self, "_has_real_merged_data", True)
+
+
+def read_layout(fp):
+    layout = PSDLayout()
+
+    header = fp.read(26)
+    if len(header) != 26:
+        raise PSDFormatError("Truncated header")
+
+    (signature, layout.version, _, layout.channels, layout.height, layout.width,
+     layout.depth, layout.color_mode) = struct.unpack(">4sH6sHIIHH", header)
+    if signature != b"8BPS" or layout.version not in (1, 2):
+        raise PSDFormatError("Not a PSD file")
+
+    # color mode data
+    length, = struct.unpack(">I", fp.read(4))
+    fp.seek(length, io.SEEK_CUR)
+
+    # image resources
+    length, = struct.unpack(">I", fp.read(4))
+    end = fp.tell() + length
+    layout.resources = {}
+    while fp.tell() + 12 <= end:
+        signature, resource_id, name_length = struct.unpack(">4sHB", fp.read(7))
+        if signature not in (b"8BIM", b"MeSa", b"AgHg", b"PHUT", b"DCSR"):
+            raise PSDFormatError("Broken image resource block")
+        # pascal string, padded to even including the length byte
+        fp.seek(name_length + ((name_length + 1) % 2), io.SEEK_CUR)
+        data_length, = struct.unpack(">I", fp.read(4))
+        layout.resources[resource_id] = (fp.tell(), data_length)
+        fp.seek(data_length + (data_length % 2), io.SEEK_CUR)
+    fp.seek(end)
+
+    # layer and mask information, skipped entirely
+    if layout.is_psb:
+        length, = struct.unpack(">Q", fp.read(8))
+    else:
+        length, = struct.unpack(">I", fp.read(4))
+    fp.seek(length, io.SEEK_CUR)
+
+    layout.image_data_offset = fp.tell()
+
+    version_info = layout.resources.get(RESOURCE_VERSION_INFO)
+    if version_info:
+        fp.seek(version_info[0] + 4)
+        layout._has_real_merged_data = fp.read(1) != b"\x00"
+
+    return layout
+
+
+def read_thumbnail(fp, layout):
+    for resource_id in (RESOURCE_THUMBNAIL, RESOURCE_THUMBNAIL_PS4):
+        if resource_id not in layout.resources:
+            continue
+
+        offset, length = layout.resources[resource_id]
+        fp.seek(offset)
+        thumbnail_format, = struct.unpack(">I", fp.read(4))
+        if thumbnail_format != 1:
+            # raw thumbnails are not written by any Photoshop we target
+            continue
+
+        fp.seek(offset + 28)
+        img = Image.open(io.BytesIO(fp.read(length - 28)))
+        img.load()
+        if resource_id == RESOURCE_THUMBNAIL_PS4:
+            # Photoshop 4 stored BGR
+            b, g, r = img.split()[:3]
+            img = Image.merge("RGB", (r, g, b))
+        return img.convert("RGB")
+    return None
+
+
+def unpack_bits(data, row_length):
+    """
+    PackBits decoder for one row
+    """
+
+    result = bytearray()
+    i = 0
+    n = len(data)
+    while i < n and len(result) < row_length:
+        header = data[i]
+        i += 1
+        if header < 128:
+            count = header + 1
+            result += data[i:i + count]
+            i += count
+        elif header > 128:
+            count = 257 - header
+            result += data[i:i + 1] * count
+            i += 1
+    if len(result) < row_length:
+        result += bytes(row_length - len(result))
+    return bytes(result[:row_length])
+
+
+def _merged_channel_count(layout):
+    if layout.color_mode == COLOR_MODE_RGB and layout.channels >= 3:
+        return min(layout.channels, 4)
+    if layout.color_mode == COLOR_MODE_GRAYSCALE and layout.channels >= 1:
+        return min(layout.channels, 2)
+    return 0
+
+
+def can_decode_merged(layout):
+    return (
+        layout.has_real_merged_data and
+        layout.depth in (8, 16) and
+        _merged_channel_count(layout) > 0
+    )
+
+
+def _undo_prediction(planes, depth):
+    if depth == 8:
+        return np.cumsum(planes, axis=-1, dtype=np.uint8)
+    return np.cumsum(planes, axis=-1, dtype=np.uint16)
+
+
+def read_merged_planes(fp, layout):
+    """
+    Decodes the merged image data section as (channels, height, width) array
+    """
+
+    bytes_per_sample = layout.depth // 8
+    row_length = layout.width * bytes_per_sample
+    channels = _merged_channel_count(layout)
+    dtype = np.dtype(">u2") if bytes_per_sample == 2 else np.dtype(np.uint8)
+
+    fp.seek(layout.image_data_offset)
+    compression, = struct.unpack(">H", fp.read(2))
+
+    if compression == COMPRESSION_RAW:
+        raw = fp.read(row_length * layout.height * channels)
+
+    elif compression == COMPRESSION_RLE:
+        count_dtype = np.dtype(">u4") if layout.is_psb else np.dtype(">u2")
+        row_count = layout.channels * layout.height
+        counts = np.frombuffer(fp.read(row_count * count_dtype.itemsize), dtype=count_dtype)
+        rows = []
+        for row_index in range(channels * layout.height):
+            rows.append(unpack_bits(fp.read(int(counts[row_index])), row_length))
+        raw = b"".join(rows)
+
+    elif compression in (COMPRESSION_ZIP, COMPRESSION_ZIP_PREDICTION):
+        decompressor = zlib.decompressobj()
+        raw = decompressor.decompress(fp.read(), row_length * layout.height * channels)
+
+    else:
+        raise PSDFormatError(f"Unknown compression: {compression}")
+
+    planes = np.frombuffer(raw, dtype=dtype, count=layout.width * layout.height * channels)
+    planes = planes.reshape((channels, layout.height, layout.width))
+    if compression == COMPRESSION_ZIP_PREDICTION:
+        planes = _undo_prediction(planes.astype(dtype.newbyteorder("=")), layout.depth)
+    return planes
+
+
+def _read_exactly(fp, decompressor, length, chunk_size=256 * 1024):
+    result = bytearray()
+    while len(result) < length:
+        data = decompressor.unconsumed_tail or fp.read(chunk_size)
+        if not data:
+            break
+        result += decompressor.decompress(data, length - len(result))
+    if len(result) < length:
+        result += bytes(length - len(result))
+    return bytes(result)
+
+
+def iter_channel_strips(fp, layout, strip_rows):
+    """
+    Yields (channel, top, rows) over the merged image data, rows being an
+    (n, width) array of at most strip_rows rows in native byte order
+    """
+
+    bytes_per_sample = layout.depth // 8
+    row_length = layout.width * bytes_per_sample
+    height = layout.height
+    channels = _merged_channel_count(layout)
+    dtype = np.dtype(">u2") if bytes_per_sample == 2 else np.dtype(np.uint8)
+
+    fp.seek(layout.image_data_offset)
+    compression, = struct.unpack(">H", fp.read(2))
+    data_offset = fp.tell()
+
+    if compression == COMPRESSION_RLE:
+        count_dtype = np.dtype(">u4") if layout.is_psb else np.dtype(">u2")
+        counts = np.frombuffer(fp.read(layout.channels * height * count_dtype.itemsize), dtype=count_dtype)
+        counts = counts.astype(np.int64)
+        row_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=row_offsets[1:])
+        row_offsets += fp.tell()
+    elif compression in (COMPRESSION_ZIP, COMPRESSION_ZIP_PREDICTION):
+        decompressor = zlib.decompressobj()
+    elif compression != COMPRESSION_RAW:
+        raise PSDFormatError(f"Unknown compression: {compression}")
+
+    for channel in range(channels):
+        for top in range(0, height, strip_rows):
+            n = min(strip_rows, height - top)
+            first = channel * height + top
+
+            if compression == COMPRESSION_RAW:
+                fp.seek(data_offset + first * row_length)
+                raw = fp.read(n * row_length)
+                raw += bytes(n * row_length - len(raw))
+
+            elif compression == COMPRESSION_RLE:
+                start = int(row_offsets[first])
+                fp.seek(start)
+                data = fp.read(int(row_offsets[first + n]) - start)
+                raw = b"".join(
+                    unpack_bits(data[int(row_offsets[i]) - start:int(row_offsets[i + 1]) - start], row_length)
+                    for i in range(first, first + n)
+                )
+
+            else:
+                raw = _read_exactly(fp, decompressor, n * row_length)
+
+            rows = np.frombuffer(raw, dtype=dtype).reshape((n, layout.width))
+            if bytes_per_sample == 2:
+                rows = rows.astype(dtype.newbyteorder("="))
+            if compression == COMPRESSION_ZIP_PREDICTION:
+                rows = _undo_prediction(rows, layout.depth)
+            yield channel, top, rows
+
+
+def _bin_starts(length, out_length):
+    return (np.arange(out_length, dtype=np.int64) * length) // out_length
+
+
+class StripDownsampler(object):
+    """
+    Box filter from (width, height) down to target_size, fed a strip of
+    rows at a time; holds one output-size accumulator
+    """
+
+    def __init__(self, size, target_size):
+        width, height = size
+        self.target_size = target_size
+        self.col_starts = _bin_starts(width, target_size[0])
+        self.row_starts = _bin_starts(height, target_size[1])
+        col_counts = np.diff(np.append(self.col_starts, width))
+        row_counts = np.diff(np.append(self.row_starts, height))
+        self.area = np.outer(row_counts, col_counts).astype(np.float32)
+        self.acc = np.zeros((target_size[1], target_size[0]), dtype=np.uint32)
+
+    def add(self, top, rows):
+        cols = np.add.reduceat(rows, self.col_starts, axis=1, dtype=np.uint32)
+        bins = np.searchsorted(self.row_starts, np.arange(top, top + len(rows)), side="right") - 1
+        firsts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+        self.acc[bins[firsts]] += np.add.reduceat(cols, firsts, axis=0, dtype=np.uint32)
+
+    def take(self):
+        """
+        Box averages as uint8, resetting the accumulator
+        """
+
+        result = np.rint(self.acc.astype(np.float32) / self.area).astype(np.uint8)
+        self.acc[:] = 0
+        return result
+
+
+def read_merged_scaled(fp, layout, target_size, strip_bytes=STRIP_BYTES):
+    """
+    Decodes the merged image data strip by strip into a target_size image;
+    target_size must not be larger than the canvas
+    """
+
+    channels = _merged_channel_count(layout)
+    row_length = layout.width * layout.depth // 8
+    strip_rows = max(1, strip_bytes // row_length)
+
+    out = np.empty((target_size[1], target_size[0], channels), dtype=np.uint8)
+    downsampler = StripDownsampler(layout.size, target_size)
+    channel = 0
+    for channel, top, rows in iter_channel_strips(fp, layout, strip_rows):
+        if layout.depth == 16:
+            rows = rows >> 8
+        downsampler.add(top, rows)
+        if top + len(rows) == layout.height:
+            out[:, :, channel] = downsampler.take()
+
+    mode = {1: "L", 2: "LA", 3: "RGB", 4: "RGBA"}[channels]
+    return Image.fromarray(out[:, :, 0] if channels == 1 else out, mode)
+
+
+def planes_to_image(planes, depth):
+    if depth == 16:
+        planes = (planes >> 8).astype(np.uint8)
+
+    channels = planes.shape[0]
+    mode = {1: "L", 2: "LA", 3: "RGB", 4: "RGBA"}[channels]
+    arr = np.ascontiguousarray(np.moveaxis(planes, 0, -1))
+    if channels == 1:
+        arr = arr[:, :, 0]
+    return Image.fromarray(arr, mode)
+
+
+def fit_size(org_size, override_size):
+    if override_size[0] == 0 or override_size[1] == 0:
+        return org_size
+
+    w_ratio = override_size[0] / org_size[0]
+    h_ratio = override_size[1] / org_size[1]
+    target_ratio = min(w_ratio, h_ratio)
+    return (int(org_size[0] * target_ratio), int(org_size[1] * target_ratio))
+
+
+def fits_in(size, bound):
+    return size[0] <= bound[0] and size[1] <= bound[1]
+
+
+def load_composite(psd_path):
+    from psd_tools import PSDImage
+
+    psd_img = PSDImage.load(psd_path)
+    if not psd_img:
+        return None
+    return psd_img.as_PIL()
+
+
+def capture(psd_path, target_size=(0, 0), allow_thumbnail=True, strip_decode=True):
+    """
+    Returns (PIL image, capture path) taking the cheapest path available.
+    target_size of (0, 0) means original size; the strips path returns the
+    image already fitted into target_size.
+    """
+
+    with open(psd_path, "rb") as fp:
+        try:
+            layout = read_layout(fp)
+        except (PSDFormatError, struct.error):
+            layout = None
+
+        if layout:
+            is_small_target = target_size[0] != 0 and target_size[1] != 0
+            if allow_thumbnail and is_small_target:
+                thumbnail = read_thumbnail(fp, layout)
+                if thumbnail and fits_in(target_size, thumbnail.size):
+                    return thumbnail, CAPTURE_THUMBNAIL
+
+            if can_decode_merged(layout):
+                scaled_size = fit_size(layout.size, target_size)
+                if strip_decode and is_small_target and scaled_size != layout.size and \
+                        fits_in(scaled_size, layout.size) and min(scaled_size) > 0:
+                    return read_merged_scaled(fp, layout, scaled_size), CAPTURE_STRIPS
+
+                planes = read_merged_planes(fp, layout)
+                return planes_to_image(planes, layout.depth), CAPTURE_MERGED
+
+    return load_composite(psd_path), CAPTURE_COMPOSITE
@@ -0,0 +1,218 @@
+"""
+Cheap change detection for the recorded PSD file.
+
+A full PSD decode is expensive, so the snapshot loop asks a PSDChangeDetector
+first and only decodes when the file fingerprint (mtime, size and an optional
+partial content hash) moved since the last decode.
+
+watchdog is optional; when it is not installed the detector falls back to
+plain polling.
+"""
+
+import os
+import hashlib
+import threading
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+
+class PSDFingerprint(object):
+
+    mtime_ns = 0
+    size = 0
+    content_hash = None
+
+    def __init__(self, mtime_ns, size, content_hash=None):
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.content_hash = content_hash
+
+    @classmethod
+    def from_path(cls, path, partial_hash_bytes=0):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        content_hash = None
+        if partial_hash_bytes > 0:
+            content_hash = cls.partial_hash(path, stat.st_size, partial_hash_bytes)
+        return cls(stat.st_mtime_ns, stat.st_size, content_hash)
+
+    @staticmethod
+    def partial_hash(path, size, chunk_size):
+        # head holds header + image resources (thumbnail), tail holds the merged image
+        md5 = hashlib.md5()
+        try:
+            with open(path, "rb") as fp:
+                md5.update(fp.read(chunk_size))
+                if size > chunk_size * 2:
+                    fp.seek(size - chunk_size)
+                    md5.update(fp.read(chunk_size))
+        except OSError:
+            return None
+        return md5.hexdigest()
+
+    def __eq__(self, other):
+        if not isinstance(other, PSDFingerprint):
+            return False
+        return (
+            self.mtime_ns == other.mtime_ns and
+            self.size == other.size and
+            self.content_hash == other.content_hash
+        )
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return f"PSDFingerprint(mtime_ns={self.mtime_ns}, size={self.size}, hash={self.content_hash})"
+
+
+class PollingBackend(object):
+
+    name = "polling"
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def wake(self):
+        pass
+
+    def wait(self, timeout, stop_event):
+        stop_event.wait(timeout)
+
+
+class _PSDEventHandler(FileSystemEventHandler):
+
+    def __init__(self, psd_path, on_change):
+        super(_PSDEventHandler, self).__init__()
+        self.psd_path = os.path.normcase(os.path.abspath(psd_path))
+        self.on_change = on_change
+
+    def on_any_event(self, event):
+        # Photoshop saves through a temp file and renames it over the target
+        paths = [getattr(event, "src_path", None), getattr(event, "dest_path", None)]
+        for path in paths:
+            if path and os.path.normcase(os.path.abspath(path)) == self.psd_path:
+                self.on_change()
+                return
+
+
+class WatchdogBackend(object):
+
+    name = "watchdog"
+
+    # wait for the writer to go quiet before reporting a change
+    SETTLE_SECONDS = 0.25
+
+    def __init__(self, psd_path):
+        self.psd_path = psd_path
+        self.changed_event = threading.Event()
+        self.observer = None
+
+    def start(self):
+        handler = _PSDEventHandler(self.psd_path, self.changed_event.set)
+        self.observer = Observer()
+        self.observer.schedule(handler, os.path.dirname(os.path.abspath(self.psd_path)), recursive=False)
+        self.observer.daemon = True
+        self.observer.start()
+
+    def stop(self):
+        if self.observer:
+            self.observer.stop()
+            self.observer.join(1.0)
+            self.observer = None
+
+    def wake(self):
+        self.changed_event.set()
+
+    def wait(self, timeout, stop_event):
+        if not self.changed_event.wait(timeout):
+            return
+
+        while self.changed_event.is_set():
+            if stop_event.is_set():
+                return
+            self.changed_event.clear()
+            stop_event.wait(self.SETTLE_SECONDS)
+
+
+class PSDChangeDetector(object):
+
+    psd_path = None
+    partial_hash_bytes = 0
+    backend = None
+    last_fingerprint = None
+
+    checks = 0
+    decodes = 0
+    skipped = 0
+
+    def __init__(self, psd_path, partial_hash_bytes=64 * 1024, use_watchdog=True, stop_event=None):
+        """
+        stop_event ends wait() early; set it through interrupt() so the
+        watchdog backend wakes up as well
+        """
+
+        self.psd_path = psd_path
+        self.partial_hash_bytes = partial_hash_bytes
+        self.lock = threading.Lock()
+        self.stop_event = stop_event or threading.Event()
+
+        if use_watchdog and Observer is not None:
+            self.backend = WatchdogBackend(psd_path)
+        else:
+            self.backend = PollingBackend()
+
+    def start(self):
+        try:
+            self.backend.start()
+        except Exception as e:
+            print(f"[WARNING] {self.backend.name} watcher unavailable, polling instead: {e}")
+            self.backend = PollingBackend()
+
+    def stop(self):
+        self.backend.stop()
+
+    def wait(self, timeout):
+        self.backend.wait(timeout, self.stop_event)
+
+    def interrupt(self):
+        # wakes a wait() in progress, and every later one returns at once
+        self.stop_event.set()
+        self.backend.wake()
+
+    def has_changed(self):
+        fingerprint = PSDFingerprint.from_path(self.psd_path, self.partial_hash_bytes)
+        with self.lock:
+            self.checks += 1
+            if fingerprint is None or fingerprint == self.last_fingerprint:
+                self.skipped += 1
+                return False
+
+            self.last_fingerprint = fingerprint
+            self.decodes += 1
+            return True
+
+    def invalidate(self):
+        # decode failed (file probably mid-write); retry on next check
+        with self.lock:
+            self.last_fingerprint = None
+
+    def stats(self):
+        with self.lock:
+            return {
+                "backend": self.backend.name,
+                "checks": self.checks,
+                "decodes": self.decodes,
+                "skipped": self.skipped,
+            }
@@ -10,107 +10,69 @@ dependency
 """
 
 import os
-import shutil
 import platform
-import time
-import datetime
 import subprocess
-import gc
-from threading import Thread
-from threading import Lock
-from threading import active_count
-
-import imagehash
-import numpy as np
-import imageio
-from psd_tools import PSDImage
-from PIL import Image
+import multiprocessing
 
 from PySide import QtGui
 from PySide.QtCore import QThread
+from PySide.QtCore import QTimer
 from PySide.QtCore import Signal
 from PySide.QtCore import Qt
 
-from win32com import client
-
 from ui.record import mainwindow
-from palette_handler import PaletteHandler
-from gen_mp4 import GenMp4
+from session_manifest import session_dir_for
+from metrics import Metrics
+from metrics import SessionProfiler
+from metrics import save_session_metrics
+import photoshop
+
+STATS_REFRESH_MS = 1000
+
+# numpy, imageio, PIL, imagehash, psd_tools and win32com are imported where
+# they are first used, so the window shows up without waiting for them
 
 
 class CONST(object):
     @property
     def DEFAULT_PATH(self):
         try:
-            psapp = client.Dispatch("Photoshop.Application").Application
-            doc = psapp.ActiveDocument
-            return f"{doc.path}{doc.name}"
-        except:
+            return photoshop.shared_connection().active_document_path()
+        except Exception:
             return None
 
 
-class PSDStoreThread(QThread):
-    psd_path = None
-    png_path = None
-    override_size = None
-    hashlock = None
-    last_hash = None
+def to_qimage(image):
+    """
+    QImage copy of a PIL image, alpha flattened onto the export background
+    """
 
-    save_success_signal = Signal(str)
+    from PIL import Image
+    import frame_export
 
-    def __init__(self, psd_path, png_path, override_size, hashlock, last_hash):
-        super(PSDStoreThread, self).__init__()
+    if image.mode in ("LA", "RGBA"):
+        background = Image.new("RGB", image.size, frame_export.BACKGROUND_COLOR)
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    else:
+        image = image.convert("RGB")
+    data = image.tobytes()
+    qimage = QtGui.QImage(data, image.width, image.height, image.width * 3, QtGui.QImage.Format_RGB888)
+    return qimage.copy()
 
-        self.psd_path = psd_path
-        self.png_path = png_path
-        self.override_size = override_size
-        self.hashlock = hashlock
-        self.last_hash = last_hash
 
-    def run(self):
-        self.hashlock.acquire()
-
-        # load first
-        psd_img = PSDImage.load(self.psd_path)
-        if not psd_img:
-            print("[ERROR] Can't load psd image")
-
-            # hard reset hash
-            self.last_hash = [None]
-            self.hashlock.release()
-            return
+class ActiveDocumentThread(QThread):
+    """
+    Looks up the active Photoshop document off the GUI thread;
+    Photoshop can take seconds to answer while it is busy
+    """
 
-        as_img = psd_img.as_PIL()
-        hashcode = imagehash.average_hash(as_img, hash_size=32)
-        if hashcode == self.last_hash[-1]:
-            self.hashlock.release()
-            return
-
-        self.last_hash.append(hashcode)
-        self.hashlock.release()
-
-        # save image file
-        org_size = as_img.size
-        if self.override_size[0] != 0 and self.override_size[1] != 0:
-            target_w = self.override_size[0]
-            target_h = self.override_size[1]
-
-            w_ratio = target_w / org_size[0]
-            h_ratio = target_h / org_size[1]
-
-            target_ratio = min(w_ratio, h_ratio)
-            target_w = int(org_size[0] * target_ratio)
-            target_h = int(org_size[1] * target_ratio)
-
-            target_size = (target_w, target_h)
-        else:
-            target_size = org_size
+    found_signal = Signal(str)
 
-        as_img = as_img.resize(target_size)
-        as_img.save(self.png_path)
-
-        print("Snapshot!")
-        self.save_success_signal.emit(self.png_path)
+    def run(self):
+        path = CONST().DEFAULT_PATH
+        if path:
+            self.found_signal.emit(path)
 
 
 class PSDStoreThreadHolder(QThread):
@@ -121,10 +83,12 @@ class PSDStoreThreadHolder(QThread):
     target_height = 0
 
     index = 0
+    pipeline = None
 
     cancellation_token = Signal()
     before_save_signal= Signal()
-    progress_signal = Signal(str)
+    # preview QImage of the latest snapshot
+    progress_signal = Signal(object)
     finish_signal = Signal()
 
     cancellation_token_flipped = False
@@ -132,160 +96,170 @@ class PSDStoreThreadHolder(QThread):
     def __init__(self,
                  target_dirpath, target_psd_path,
                  target_width, target_height,
-                 target_file_type):
+                 target_file_type, cpu_budget=0.25, use_frame_store=False,
+                 keyframe_interval=None, preview_size=(320, 240), archive=False,
+                 session_metrics=None, profiler=None, live_export=None):
+        """
+        keyframe_interval: frame store keyframe spacing, None for the
+        default and 0 to store every frame whole
+        preview_size: size of the in-memory preview sent with progress_signal
+        archive: also keep every frame at full canvas size in archive/
+        session_metrics: Metrics of the session, written to metrics.json/.prom
+        profiler: optional SessionProfiler of the capture stages
+        live_export: optional running LiveExport every saved frame is fed to
+        """
+
         super(PSDStoreThreadHolder, self).__init__()
         self.target_dirpath = target_dirpath
         self.target_psd_path = target_psd_path
         self.target_width = target_width
         self.target_height = target_height
         self.target_file_type = target_file_type
+        self.cpu_budget = cpu_budget
+        self.use_frame_store = use_frame_store
+        self.keyframe_interval = keyframe_interval
+        self.preview_size = preview_size
+        self.archive = archive
+        self.session_metrics = session_metrics or Metrics()
+        self.profiler = profiler
+        self.live_export = live_export
 
         self.cancellation_token.connect(self.cancel)
 
     def cancel(self, e=None):
         self.cancellation_token_flipped = True
+        if self.pipeline:
+            self.pipeline.cancel()
 
     def run(self):
-        hashlock = Lock()
-        last_hash = [None]
-        as_img = None
-
-        while True:
-            if self.cancellation_token_flipped:
-                break
-
-            self.before_save_signal.emit()
-
-            time.sleep(1.50)
-
-            last_hash = last_hash[-1:]
-            psd_thread = PSDStoreThread(
-                self.target_psd_path,
-                self.get_cachename(),
-                (self.target_width, self.target_height),
-                hashlock,
-                last_hash
-            )
-
-            psd_thread.save_success_signal.connect(self.on_save_file)
-            psd_thread.start()
-            psd_thread.wait()
-
-        # will never happen
+        import frame_export
+        from capture_pipeline import CapturePipeline
+        from capture_scheduler import AdaptiveScheduler
+        from frame_pyramid import FrameOutput
+        from frame_store import FrameStore
+        from frame_store import STORE_FILENAME
+        from delta_store import DeltaFrameWriter
+        from delta_store import DEFAULT_KEYFRAME_INTERVAL
+
+        # resume after the frames of earlier recordings of this document
+        manifest = frame_export.open_session_manifest(self.target_dirpath, self.target_file_type)
+        self.index = manifest.next_index
+
+        store = None
+        store_writer = None
+        if self.use_frame_store:
+            store = FrameStore(f"{self.target_dirpath}/{STORE_FILENAME}")
+            store_writer = store
+            keyframe_interval = self.keyframe_interval
+            if keyframe_interval is None:
+                keyframe_interval = DEFAULT_KEYFRAME_INTERVAL
+            if keyframe_interval:
+                store_writer = DeltaFrameWriter(store, keyframe_interval)
+
+        outputs = [FrameOutput("preview", self.preview_size)]
+        if self.archive:
+            outputs.append(FrameOutput("archive", (0, 0), f"{self.target_dirpath}/archive/cached_{{index}}.png"))
+
+        self.pipeline = CapturePipeline(
+            self.target_psd_path,
+            f"{self.target_dirpath}/cached_{{index}}.{self.target_file_type}",
+            (self.target_width, self.target_height),
+            scheduler=AdaptiveScheduler(cpu_budget=self.cpu_budget),
+            start_index=self.index,
+            on_tick=self.before_save_signal.emit,
+            on_saved=self.on_save_frame,
+            frame_store=store_writer,
+            manifest=manifest,
+            outputs=outputs,
+            metrics=self.session_metrics,
+            profiler=self.profiler
+        )
+        if self.cancellation_token_flipped:
+            self.pipeline.cancel()
+        self.pipeline.start()
+        self.pipeline.join()
+        if store:
+            store.close()
+
+        print(f"Capture stats:\n{self.session_metrics.format_table()}")
+        save_session_metrics(self.target_dirpath, self.session_metrics, self.profiler)
         self.finish_signal.emit()
 
-    def on_save_file(self, filepath):
-        self.progress_signal.emit(filepath)
+    def on_save_frame(self, frame):
+        preview = frame.renditions.get("preview")
+        if preview is not None:
+            self.progress_signal.emit(to_qimage(preview))
+        if self.live_export is not None:
+            self.live_export.add_frame(frame)
         self.index += 1
 
-    def get_cachename(self):
-        return f"{self.target_dirpath}/cached_{self.index}.{self.target_file_type}"
-
 
 class MimRecThread(QThread):
 
     finish_signal = Signal()
 
-    def __init__(self, target_dir, target_file_type, target_width, target_height, target_framerate):
+    def __init__(self, target_dir, target_file_type, target_width, target_height, target_framerate,
+                 export_workers=None, gif_mode="delta", time_range=(None, None),
+                 session_metrics=None, profiler=None, live_export=None):
+        """
+        gif_mode: "delta" for the global palette delta encoder,
+        "imageio" for full frames through imageio.
+        time_range: (start, end) capture timestamps to export, None for open ends
+        session_metrics, profiler: see PSDStoreThreadHolder
+        live_export: the session's LiveExport, only finalized when it
+        still matches the session
+        """
+
         super(MimRecThread, self).__init__()
         self.target_dir = target_dir
         self.target_file_type = target_file_type
         self.target_width = target_width
         self.target_height = target_height
         self.target_framerate = target_framerate
+        self.export_workers = export_workers or os.cpu_count() or 1
+        self.gif_mode = gif_mode
+        self.time_range = time_range
+        self.session_metrics = session_metrics or Metrics()
+        self.profiler = profiler
+        self.live_export = live_export
 
     def run(self):
-        def sort_key(path):
-            base = os.path.basename(path)
-            basename = os.path.splitext(base)[0]
-            numbering = basename.split('_')[-1]
-            if numbering.isdigit():
-                return int(numbering)
-            return -1
+        import frame_export
 
         if not self.target_dir:
             print("Invalid thread initialize: no target directory")
             return self.finish_signal.emit()
 
-        print("Preparing images..")
-        target_files = [f"{self.target_dir}/{x}" for x in os.listdir(self.target_dir)]
-        target_files = list(filter(lambda x: x.endswith(f".{self.target_file_type}"), target_files))
-        if not target_files:
-            print("Quit thread: no target image found")
-            return self.finish_signal.emit()
-
-        target_files.sort(key=sort_key)
-        raw_imgs = [Image.open(target_file) for target_file in target_files]
-        max_width = max([img.size[0] for img in raw_imgs])
-        max_height = max([img.size[1] for img in raw_imgs])
-
-        target_ratio = 1.0
-        if self.target_width != 0 or self.target_height != 0:
-            w_ratio = self.target_width / max_width
-            h_ratio = self.target_height / max_height
-            target_ratio = min(w_ratio, h_ratio)
-        target_width = int(max_width * target_ratio)
-        target_height = int(max_height * target_ratio)
-
-        print("Unifying image sizes..")
-        paging_dir = ".PAGING"
-        if os.path.isdir(paging_dir):
-            shutil.rmtree(paging_dir)
-            time.sleep(1)
-        os.makedirs(paging_dir)
-
-        count = len(raw_imgs)
-        for i, img in enumerate(raw_imgs):
-            print(f"Resizing: {i + 1} / {count}..")
-
-            # ignore if image already fits target size
-            if img.size[0] == target_width and img.size[1] == target_height:
-                img.save(f"{paging_dir}/unif_{i}.{self.target_file_type}")
-                continue
-
-            resized_img = img
-            if not target_ratio == 1.0:
-                resized_img = img.resize((target_width, target_height), Image.BICUBIC)
-
-            if resized_img.size[0] == target_width and resized_img.size[1] == target_height:
-                resized_img.save(f"{paging_dir}/unif_{i}.{self.target_file_type}")
-                continue
-
-            print("DIFFERENT SIZE!")
-            baseimg = Image.new("RGB", target_size, (255, 255, 255))
-            left = (baseimg.size[0] / 2) - (img.size[0] / 2)
-            top = (baseimg.size[1] / 2) - (img.size[1] / 2)
-            rect = (int(left), int(top))
-            baseimg.paste(img, rect)
-            baseimg.save(f"{paging_dir}/unif_{i}.{self.target_file_type}")
-
-            raw_imgs.remove(img)
-            del img
-            del baseimg
-
-        print("Serializing images..")
-        target_files = [f"{paging_dir}/{x}" for x in os.listdir(paging_dir)]
-        target_files = list(filter(lambda x: x.endswith(f".{self.target_file_type}"), target_files))
-        if not target_files:
-            print("no paging file found")
-            return self.finish_signal.emit()
-        target_files.sort(key=sort_key)
-
-        # append last frame
-        [target_files.append(target_files[-1]) for _ in range(20)]
-        unified_imgs = [Image.open(target_file) for target_file in target_files]
-        arrs = [np.array(img) for img in unified_imgs]
-        shutil.rmtree(paging_dir)
-
-        print("starting gif save..")
-        imageio.mimwrite(f"{self.target_dir}/dst.gif", arrs, fps=self.target_framerate, loop=0)
-        print("Gif Done!")
-
-        self.gen_mp4_thread = GenMp4(arrs, self.target_dir, self.target_framerate)
-        self.gen_mp4_thread.finish_signal.connect(self.on_gen_mp4_finish)
-        self.gen_mp4_thread.start()
+        if self.live_export is not None:
+            live_export = self.live_export
+            self.live_export = None
+            if self.time_range == (None, None) and (
+                    (live_export.target_width, live_export.target_height, live_export.framerate) ==
+                    (self.target_width, self.target_height, self.target_framerate)):
+                report = live_export.finish()
+                if report is not None:
+                    print("Export Done!")
+                    save_session_metrics(self.target_dir, self.session_metrics, self.profiler)
+                    return self.finish_signal.emit()
+            else:
+                # export settings changed since recording started
+                live_export.discard()
 
-    def on_gen_mp4_finish(self):
+        report = frame_export.export_session(
+            self.target_dir,
+            self.target_file_type,
+            self.target_width,
+            self.target_height,
+            self.target_framerate,
+            workers=self.export_workers,
+            gif_mode=self.gif_mode,
+            time_range=self.time_range,
+            metrics=self.session_metrics,
+            profiler=self.profiler
+        )
+        if report is not None:
+            print("Export Done!")
+            save_session_metrics(self.target_dir, self.session_metrics, self.profiler)
         self.finish_signal.emit()
 
 
@@ -293,6 +267,12 @@ class WindowHandler(QtGui.QMainWindow, mainwindow.Ui_MainWindow):
 
     const = CONST()
     workthread = None
+    document_thread = None
+    is_first_show = True
+    session_metrics = None
+    profiler = None
+    live_export = None
+    export_pending = False
 
     @property
     def target_file_type(self):
@@ -339,35 +319,63 @@ class WindowHandler(QtGui.QMainWindow, mainwindow.Ui_MainWindow):
         self.PreviewLabel.setPixmap(QtGui.QPixmap(""))
 
         self.setWindowFlags(Qt.WindowStaysOnTopHint)
-        self.refresh_psd_dirpath()
 
         self.AlwaysOnTopCheckbox.stateChanged.connect(self.always_on_top_state_changed)
 
+        self.setup_stats_tab()
+
+        self.LiveExportCheckbox = QtGui.QCheckBox("Encode while recording", self.centralWidget)
+        self.LiveExportCheckbox.setToolTip("GIF/MP4 are encoded in the background, Stop only finalizes them")
+        self.gridLayout.addWidget(self.LiveExportCheckbox, 11, 0, 1, 2)
+
+    def setup_stats_tab(self):
+        """
+        "Stats" tab next to the preview: live stage latencies and counters
+        of the current session, and the per-session profiling toggle
+        """
+
+        tab = QtGui.QWidget()
+        layout = QtGui.QVBoxLayout(tab)
+        self.StatsText = QtGui.QPlainTextEdit(tab)
+        self.StatsText.setReadOnly(True)
+        self.StatsText.setFont(QtGui.QFont("Courier"))
+        self.StatsText.setPlainText("No session yet")
+        layout.addWidget(self.StatsText)
+        self.ProfileCheckbox = QtGui.QCheckBox("Profile next session (cProfile)", tab)
+        layout.addWidget(self.ProfileCheckbox)
+        self.tabWidget.addTab(tab, "Stats")
+
+        self.stats_timer = QTimer(self)
+        self.stats_timer.setInterval(STATS_REFRESH_MS)
+        self.stats_timer.timeout.connect(self.refresh_stats)
+        self.stats_timer.start()
+
+    def refresh_stats(self):
+        if self.session_metrics is None or not self.StatsText.isVisible():
+            return
+        self.StatsText.setPlainText(self.session_metrics.format_table())
+
     def always_on_top_state_changed(self, state):
         self.setWindowFlags(self.windowFlags() ^ Qt.WindowStaysOnTopHint)
         self.show()
 
+    def showEvent(self, e=None):
+        super(WindowHandler, self).showEvent(e)
+        if self.is_first_show:
+            self.is_first_show = False
+            self.refresh_psd_dirpath()
+
     def refresh_psd_dirpath(self, e=None):
-        self.PSDPathLineInput.setText(self.const.DEFAULT_PATH)
+        if self.document_thread and self.document_thread.isRunning():
+            return
+
+        self.document_thread = ActiveDocumentThread()
+        self.document_thread.found_signal.connect(self.PSDPathLineInput.setText)
+        self.document_thread.start()
 
     def make_divisable_by_16(self, e):
         try:
-            psapp = client.Dispatch("Photoshop.Application").Application
-            if not psapp:
-                print("Photoshop is not running")
-                return
-
-            doc = psapp.ActiveDocument
-            if not doc:
-                print("No document is opened.")
-                return
-
-            width = doc.width
-            height = doc.height
-            target_width = int(width - (width % 16))
-            target_height = int(height - (height % 16))
-            doc.ResizeImage(target_width, target_height)
-
+            photoshop.shared_connection().resize_active_document(16)
         except Exception as e:
             print(f"Error resizing: {e}")
 
@@ -399,12 +407,30 @@ class WindowHandler(QtGui.QMainWindow, mainwindow.Ui_MainWindow):
 
         self.StartButton.setEnabled(False)
         self.FileTypeComboBox.setEnabled(False)
+        self.session_metrics = Metrics()
+        self.profiler = SessionProfiler() if self.ProfileCheckbox.isChecked() else None
+        self.live_export = None
+        if self.LiveExportCheckbox.isChecked():
+            from live_export import LiveExport
+            self.live_export = LiveExport(
+                self.target_dirpath,
+                self.target_file_type,
+                self.target_width,
+                self.target_height,
+                self.target_framerate,
+                metrics=self.session_metrics
+            )
+            self.live_export.start()
         self.workthread = PSDStoreThreadHolder(
             self.target_dirpath,
             self.PSDPathLineInput.text(),
             self.target_width,
             self.target_height,
-            self.target_file_type
+            self.target_file_type,
+            preview_size=(self.PreviewLabel.width(), self.PreviewLabel.height()),
+            session_metrics=self.session_metrics,
+            profiler=self.profiler,
+            live_export=self.live_export
         )
         self.workthread.before_save_signal.connect(self.on_before_start)
         self.workthread.progress_signal.connect(self.on_progress)
@@ -412,20 +438,34 @@ class WindowHandler(QtGui.QMainWindow, mainwindow.Ui_MainWindow):
         self.workthread.start()
 
     def stop(self, e=None):
-        # cancel running thread
+        self.setEnabled(False)
+        self.export_pending = True
         if self.workthread:
+            # in-flight snapshots finish writing before the export reads
+            # them; the window keeps painting meanwhile
+            self.workthread.finished.connect(self.start_export)
             self.workthread.cancellation_token.emit()
+            if self.workthread.isRunning():
+                return
+        self.start_export()
 
-        target_dir = self.build_target_path()
+    def start_export(self):
+        if not self.export_pending:
+            return
+        self.export_pending = False
 
-        self.setEnabled(False)
+        target_dir = self.build_target_path()
         self.mim_write_thread = MimRecThread(
             target_dir,
             self.target_file_type,
             self.target_width,
             self.target_height,
-            self.target_framerate
+            self.target_framerate,
+            session_metrics=self.session_metrics,
+            profiler=self.profiler,
+            live_export=self.live_export
         )
+        self.live_export = None
         self.mim_write_thread.finish_signal.connect(self.on_save_complete)
         self.mim_write_thread.start()
 
@@ -434,14 +474,14 @@ class WindowHandler(QtGui.QMainWindow, mainwindow.Ui_MainWindow):
         self.showdir()
         self.setEnabled(True)
 
-    def on_progress(self, snapshot_path):
+    def on_progress(self, preview):
         try:
             size = self.PreviewLabel.size()
-            pixmap = QtGui.QPixmap(snapshot_path)
+            pixmap = QtGui.QPixmap.fromImage(preview)
             self.PreviewLabel.setPixmap(
                 pixmap.scaled(size, Qt.KeepAspectRatio)
             )
-        except e as Exception:
+        except Exception as e:
             print(e)
 
     def on_complete(self, e=None):
@@ -455,29 +495,27 @@ class WindowHandler(QtGui.QMainWindow, mainwindow.Ui_MainWindow):
 
     def build_target_path(self):
         target_psd_path = self.PSDPathLineInput.text()
-        basename = os.path.basename(target_psd_path)
-        target_filename = os.path.splitext(basename)[0]
         if not os.path.isfile(target_psd_path):
             if not os.path.isfile(target_psd_path + ".psd"):
                 print("Critical error: invalid target path")
                 return None
             else:
                 target_psd_path = target_psd_path + ".psd"
-        result_path = f"{os.path.dirname(target_psd_path)}/{target_filename}/recorder".replace('\\', '/')
+        result_path = session_dir_for(target_psd_path)
         if not os.path.isdir(result_path):
             os.makedirs(result_path)
         return result_path
 
     def save_photoshop_doc(self):
         try:
-            psapp = client.Dispatch("Photoshop.Application").Application
-            doc = psapp.ActiveDocument
-            doc.save()
-        except:
+            photoshop.shared_connection().save_active_document()
+        except Exception:
             return
 
 
 if __name__ == "__main__":
+    # export and segment pools re-run this entry point in the frozen exe
+    multiprocessing.freeze_support()
     app = QtGui.QApplication([])
     mainwin = WindowHandler()
     mainwin.show()
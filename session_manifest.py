@@ -0,0 +1,136 @@
+"""
+Per-session frame manifest, one JSON object per line.
+
+    {"index": 3, "captured_at": 1508600000.5, "source_mtime": 1508600000.1,
+     "hash": "ffc3...", "digest": "9a0e...", "width": 1024, "height": 720,
+     "file": "cached_3.png", "offset": null, "store_index": null,
+     "capture_path": "merged", "ref": null}
+
+Frames stored in the binary frame store have "file" pointing at the store,
+with their byte offset and position in it. Paths are relative to the session
+directory so a session can be moved around. A frame that repeats an earlier
+canvas state has "ref" set to that frame's index and shares its file; "digest"
+is the tile checksum digest that confirms such a repeat pixel for pixel.
+
+The manifest is append-only; a torn last line from a crash is ignored.
+"""
+
+import os
+import json
+import bisect
+import threading
+
+
+MANIFEST_FILENAME = "manifest.jsonl"
+
+
+def session_dir_for(psd_path):
+    """
+    Recording directory of a PSD: <psd dir>/<psd name>/recorder
+    """
+
+    name = os.path.splitext(os.path.basename(psd_path))[0]
+    return f"{os.path.dirname(psd_path)}/{name}/recorder".replace("\\", "/")
+
+
+class SessionManifest(object):
+
+    path = None
+    session_dir = None
+    entries = None
+    # (entries sorted by capture time, their times), built on first select
+    time_index = None
+
+    def __init__(self, path):
+        self.path = path
+        self.session_dir = os.path.dirname(path)
+        self.lock = threading.Lock()
+        self.entries = []
+
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as fp:
+                for line in fp:
+                    try:
+                        self.entries.append(json.loads(line))
+                    except ValueError:
+                        print(f"[WARNING] Skipping broken manifest line in {path}")
+        self.entries.sort(key=lambda entry: entry["index"])
+
+    @classmethod
+    def for_session(cls, session_dir):
+        return cls(os.path.join(session_dir, MANIFEST_FILENAME))
+
+    @classmethod
+    def exists(cls, session_dir):
+        return os.path.isfile(os.path.join(session_dir, MANIFEST_FILENAME))
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def next_index(self):
+        """
+        First free frame index; sessions recorded before the manifest
+        existed are resumed after their last cached_N file
+        """
+
+        if self.entries:
+            return self.entries[-1]["index"] + 1
+
+        last = -1
+        if os.path.isdir(self.session_dir):
+            for filename in os.listdir(self.session_dir):
+                numbering = os.path.splitext(filename)[0].split("_")[-1]
+                if filename.startswith("cached_") and numbering.isdigit():
+                    last = max(last, int(numbering))
+        return last + 1
+
+    def append(self, index, captured_at, width, height, file,
+               source_mtime=None, hashcode=None, offset=None, store_index=None,
+               capture_path=None, ref=None, digest=None):
+        """
+        ref is the index of an earlier frame this one repeats; its file and
+        store position are recorded as well so readers need no lookup
+        """
+
+        entry = {
+            "index": index,
+            "captured_at": captured_at,
+            "source_mtime": source_mtime,
+            "hash": str(hashcode) if hashcode is not None else None,
+            "digest": digest,
+            "width": width,
+            "height": height,
+            "file": os.path.relpath(file, self.session_dir) if os.path.isabs(file) else file,
+            "offset": offset,
+            "store_index": store_index,
+            "capture_path": capture_path,
+            "ref": ref,
+        }
+
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as fp:
+                fp.write(json.dumps(entry) + "\n")
+            self.entries.append(entry)
+            self.time_index = None
+        return entry
+
+    def abspath(self, entry):
+        return os.path.join(self.session_dir, entry["file"]).replace("\\", "/")
+
+    def select(self, start_time=None, end_time=None):
+        """
+        Entries captured within [start_time, end_time], in frame order
+        """
+
+        if start_time is None and end_time is None:
+            return list(self.entries)
+
+        with self.lock:
+            if self.time_index is None:
+                by_time = sorted(self.entries, key=lambda entry: entry["captured_at"])
+                self.time_index = (by_time, [entry["captured_at"] for entry in by_time])
+            by_time, times = self.time_index
+        lo = 0 if start_time is None else bisect.bisect_left(times, start_time)
+        hi = len(times) if end_time is None else bisect.bisect_right(times, end_time)
+        return sorted(by_time[lo:hi], key=lambda entry: entry["index"])
@@ -0,0 +1,328 @@
+"""
+Synthetic PSD files for benchmarks.
+
+Writes a PSD of any size, bit depth and compression without holding the
+canvas in memory: pixel rows are generated and compressed a strip at a time.
+Optional opaque layers cover parts of the canvas; the merged image data is
+their composite, as Photoshop would store it.
+
+EditSession saves the same document over and over with a few rectangles
+painted in between, like someone working on it.
+"""
+
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from psd_capture import COMPRESSION_RAW
+from psd_capture import COMPRESSION_RLE
+from psd_capture import COMPRESSION_ZIP
+from psd_capture import COMPRESSION_ZIP_PREDICTION
+from psd_capture import COLOR_MODE_RGB
+
+
+COMPRESSIONS = {
+    "raw": COMPRESSION_RAW,
+    "rle": COMPRESSION_RLE,
+    "zip": COMPRESSION_ZIP,
+    "zip-prediction": COMPRESSION_ZIP_PREDICTION,
+}
+
+STRIP_ROWS = 256
+
+
+def pack_bits(row):
+    """
+    PackBits encoder for one row of bytes
+    """
+
+    row = np.asarray(row, dtype=np.uint8)
+    n = len(row)
+    run_starts = np.r_[0, np.flatnonzero(np.diff(row)) + 1]
+    run_ends = np.r_[run_starts[1:], n]
+
+    result = bytearray()
+    literal_start = 0
+
+    def flush_literal(end):
+        for start in range(literal_start, end, 128):
+            count = min(128, end - start)
+            result.append(count - 1)
+            result.extend(row[start:start + count].tobytes())
+
+    for start, end in zip(run_starts.tolist(), run_ends.tolist()):
+        if end - start < 3:
+            continue
+        flush_literal(start)
+        value = int(row[start])
+        for chunk in range(start, end, 128):
+            count = min(128, end - chunk)
+            if count < 2:
+                result += bytes((0, value))
+            else:
+                result += bytes((257 - count, value))
+        literal_start = end
+    flush_literal(n)
+    return bytes(result)
+
+
+def pattern_rows(channel, top, count, width, seed=0):
+    """
+    (count, width) uint8 rows of a blocky test canvas: flat 256px blocks
+    with a diagonal gradient, so RLE has runs to find
+    """
+
+    y = np.arange(top, top + count)[:, None]
+    x = np.arange(width)[None, :]
+    block = ((y // 256) * 7 + (x // 256) * 13 + channel * 31 + seed) % 256
+    stripe = ((x // 16 + y // 16) % 64 == 0) * 64
+    return ((block + stripe) % 256).astype(np.uint8)
+
+
+def _header(width, height, channels, depth, is_psb):
+    return struct.pack(
+        ">4sH6sHIIHH", b"8BPS", 2 if is_psb else 1, bytes(6),
+        channels, height, width, depth, COLOR_MODE_RGB
+    )
+
+
+def _to_depth(strip, depth):
+    """
+    Big endian sample bytes of uint8 rows at depth, as a (rows, bytes) array
+    """
+
+    if depth == 8:
+        return strip
+    wide = (strip.astype(">u2") * 257)
+    return wide.view(np.uint8).reshape(len(strip), -1)
+
+
+def _write_rows(fp, strips, row_count, compression, depth, is_psb):
+    """
+    Writes one block of image data (without the compression field):
+    strips yields uint8 rows, row_count is the total number of rows
+    """
+
+    if compression == COMPRESSION_RAW:
+        for strip in strips:
+            fp.write(_to_depth(strip, depth).tobytes())
+
+    elif compression == COMPRESSION_RLE:
+        count_format = ">I" if is_psb else ">H"
+        counts_offset = fp.tell()
+        fp.write(bytes(struct.calcsize(count_format) * row_count))
+        counts = []
+        previous = (None, None)
+        for strip in strips:
+            for row in _to_depth(strip, depth):
+                key = row.tobytes()
+                packed = previous[1] if key == previous[0] else pack_bits(row)
+                previous = (key, packed)
+                counts.append(len(packed))
+                fp.write(packed)
+        end = fp.tell()
+        fp.seek(counts_offset)
+        fp.write(struct.pack(f">{len(counts)}{count_format[1]}", *counts))
+        fp.seek(end)
+
+    else:
+        compressor = zlib.compressobj()
+        for strip in strips:
+            if compression == COMPRESSION_ZIP_PREDICTION:
+                samples = strip if depth == 8 else strip.astype(np.uint16) * 257
+                samples = np.diff(samples, axis=1, prepend=np.zeros((len(strip), 1), dtype=samples.dtype))
+                strip = samples.astype(np.uint8) if depth == 8 else samples.astype(">u2").view(np.uint8)
+            else:
+                strip = _to_depth(strip, depth)
+            fp.write(compressor.compress(np.ascontiguousarray(strip).tobytes()))
+        fp.write(compressor.flush())
+
+
+def layer_rects(size, count):
+    """
+    (left, top, right, bottom) of count layers, each a quarter of the
+    canvas, stepping diagonally from the top left corner
+    """
+
+    width, height = size
+    rects = []
+    for i in range(count):
+        left = (width // 2) * i // max(1, count - 1) if count > 1 else 0
+        top = (height // 2) * i // max(1, count - 1) if count > 1 else 0
+        rects.append((left, top, left + max(1, width // 2), top + max(1, height // 2)))
+    return rects
+
+
+def composite_rows(rows, rects):
+    """
+    rows() with the opaque layers at rects painted over it, top layer last;
+    layer i is rows() with seed + i + 1
+    """
+
+    def composited(channel, top, count, width, seed=0):
+        strip = rows(channel, top, count, width, seed)
+        for i, (left, layer_top, right, bottom) in enumerate(rects):
+            start = max(top, layer_top)
+            end = min(top + count, bottom)
+            if start < end:
+                layer = rows(channel, start, end - start, width, seed + i + 1)
+                strip[start - top:end - top, left:right] = layer[:, left:right]
+        return strip
+
+    return composited
+
+
+def _write_layers(fp, rects, rows, channels, depth, compression, seed, is_psb):
+    """
+    Layer and mask information section with one opaque RGB layer per rect
+    """
+
+    length_format = ">Q" if is_psb else ">I"
+    channel_ids = [-1] + list(range(channels))
+
+    section_offset = fp.tell()
+    fp.write(struct.pack(length_format, 0))
+    info_offset = fp.tell()
+    fp.write(struct.pack(length_format, 0))
+    fp.write(struct.pack(">h", len(rects)))
+
+    # records first, channel lengths patched once the data is written
+    length_offsets = []
+    for i, (left, top, right, bottom) in enumerate(rects):
+        fp.write(struct.pack(">iiiiH", top, left, bottom, right, len(channel_ids)))
+        offsets = []
+        for channel_id in channel_ids:
+            fp.write(struct.pack(">h", channel_id))
+            offsets.append(fp.tell())
+            fp.write(struct.pack(length_format, 0))
+        length_offsets.append(offsets)
+
+        name = f"Layer {i + 1}".encode("ascii")
+        name_block = bytes((len(name),)) + name
+        name_block += bytes(-len(name_block) % 4)
+        fp.write(b"8BIMnorm" + struct.pack(">BBBB", 255, 0, 0, 0))
+        extra = struct.pack(">II", 0, 0) + name_block
+        fp.write(struct.pack(">I", len(extra)) + extra)
+
+    for i, (left, top, right, bottom) in enumerate(rects):
+        layer_width = right - left
+        layer_height = bottom - top
+        for channel_id, length_offset in zip(channel_ids, length_offsets[i]):
+            start = fp.tell()
+            fp.write(struct.pack(">H", compression))
+
+            def strips():
+                for strip_top in range(top, bottom, STRIP_ROWS):
+                    count = min(STRIP_ROWS, bottom - strip_top)
+                    if channel_id == -1:
+                        yield np.full((count, layer_width), 255, dtype=np.uint8)
+                    else:
+                        yield rows(channel_id, strip_top, count, right, seed + i + 1)[:, left:]
+
+            _write_rows(fp, strips(), layer_height, compression, depth, is_psb)
+            end = fp.tell()
+            fp.seek(length_offset)
+            fp.write(struct.pack(length_format, end - start))
+            fp.seek(end)
+
+    if (fp.tell() - info_offset) % 2:
+        fp.write(b"\x00")
+    info_end = fp.tell()
+    fp.write(struct.pack(">I", 0))  # global layer mask info
+    end = fp.tell()
+
+    fp.seek(info_offset)
+    fp.write(struct.pack(length_format, info_end - info_offset - struct.calcsize(length_format)))
+    fp.seek(section_offset)
+    fp.write(struct.pack(length_format, end - info_offset))
+    fp.seek(end)
+
+
+def write_psd(path, size, compression="rle", channels=3, rows=pattern_rows, seed=0, depth=8, layers=0):
+    """
+    Writes an RGB PSD of size (width, height) at depth 8 or 16 whose channel
+    rows come from rows(channel, top, count, width, seed) as uint8.
+    layers adds that many opaque layers (see layer_rects), stored with the
+    same compression and composited into the merged image data.
+    """
+
+    width, height = size
+    compression = COMPRESSIONS[compression]
+    is_psb = width > 30000 or height > 30000
+    if depth not in (8, 16):
+        raise ValueError(f"Unsupported depth: {depth}")
+
+    rects = layer_rects(size, layers)
+    merged_rows = composite_rows(rows, rects) if rects else rows
+
+    with open(path, "wb") as fp:
+        fp.write(_header(width, height, channels, depth, is_psb))
+        fp.write(struct.pack(">I", 0))  # color mode data
+        fp.write(struct.pack(">I", 0))  # image resources
+        if rects:
+            _write_layers(fp, rects, rows, channels, depth, compression, seed, is_psb)
+        else:
+            fp.write(struct.pack(">Q" if is_psb else ">I", 0))  # layer and mask information
+        fp.write(struct.pack(">H", compression))
+
+        def strips():
+            for channel in range(channels):
+                for top in range(0, height, STRIP_ROWS):
+                    yield merged_rows(channel, top, min(STRIP_ROWS, height - top), width, seed)
+
+        _write_rows(fp, strips(), channels * height, compression, depth, is_psb)
+    return path
+
+
+class EditSession(object):
+    """
+    One document saved again and again. Every edit() paints a few random
+    rectangles over the canvas; save() rewrites the file the way an editor
+    would, replacing it in one step so readers never see half a file.
+    """
+
+    path = None
+    size = (0, 0)
+    saves = 0
+
+    def __init__(self, path, size, compression="rle", depth=8, layers=0, seed=0, channels=3):
+        self.path = path
+        self.size = size
+        self.compression = compression
+        self.depth = depth
+        self.layers = layers
+        self.seed = seed
+        self.channels = channels
+        self.rng = np.random.RandomState(seed)
+        # (left, top, right, bottom, rgb)
+        self.edits = []
+        self.saves = 0
+
+    def edit(self, strokes=3, stroke_size=None):
+        width, height = self.size
+        stroke_size = stroke_size or max(8, min(width, height) // 16)
+        for _ in range(strokes):
+            w = self.rng.randint(stroke_size // 2, stroke_size + 1)
+            h = self.rng.randint(stroke_size // 2, stroke_size + 1)
+            left = self.rng.randint(0, max(1, width - w))
+            top = self.rng.randint(0, max(1, height - h))
+            self.edits.append((left, top, left + w, top + h, tuple(self.rng.randint(0, 256, 3))))
+
+    def rows(self, channel, top, count, width, seed=0):
+        strip = pattern_rows(channel, top, count, width, seed)
+        for left, edit_top, right, bottom, rgb in self.edits:
+            start = max(top, edit_top)
+            end = min(top + count, bottom)
+            if start < end:
+                strip[start - top:end - top, left:right] = rgb[channel % 3]
+        return strip
+
+    def save(self):
+        temp_path = f"{self.path}.saving"
+        write_psd(temp_path, self.size, self.compression, self.channels, self.rows, self.seed,
+                  depth=self.depth, layers=self.layers)
+        os.replace(temp_path, self.path)
+        self.saves += 1
+        return self.path
@@ -0,0 +1,204 @@
+"""
+Tile-level change detection on full resolution canvases.
+
+The canvas is split into square tiles and every tile gets a position-weighted
+checksum, computed with numpy in one pass over the pixels (8 bytes at a time
+wherever the tile rows allow it). Comparing checksums with the previous
+snapshot gives a dirty-tile mask; unlike a 32x32 average hash it notices a
+single changed pixel on an 8K canvas.
+"""
+
+import hashlib
+
+import numpy as np
+
+
+DEFAULT_TILE_SIZE = 64
+WEIGHT_SEED = 0x5EED
+
+
+def _odd_weights(shape):
+    # odd multipliers keep every single-byte change visible modulo 2**64
+    rng = np.random.RandomState(WEIGHT_SEED + shape[1])
+    return rng.randint(0, 2 ** 62, size=shape, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+
+
+class TileChecksum(object):
+
+    tile_size = DEFAULT_TILE_SIZE
+
+    def __init__(self, tile_size=DEFAULT_TILE_SIZE):
+        self.tile_size = tile_size
+        self._weights = {}
+
+    def weights(self, row_items):
+        weights = self._weights.get(row_items)
+        if weights is None:
+            weights = _odd_weights((self.tile_size, row_items))
+            self._weights[row_items] = weights
+        return weights
+
+    def __call__(self, arr):
+        """
+        (tiles_y, tiles_x) uint64 checksums of an (h, w) or (h, w, c) uint8 array
+        """
+
+        if arr.ndim == 2:
+            arr = arr[:, :, None]
+        tile = self.tile_size
+        h, w, c = arr.shape
+        tiles_y = -(-h // tile)
+        tiles_x = -(-w // tile)
+        full_h = h - h % tile
+        full_w = w - w % tile
+
+        result = np.zeros((tiles_y, tiles_x), dtype=np.uint64)
+        if full_h and full_w:
+            result[:full_h // tile, :full_w // tile] = self._full_tiles(arr[:full_h, :full_w])
+        if full_w < w:
+            result[:, -1] = self._padded_tiles(arr[:, full_w:])[:, 0]
+        if full_h < h:
+            result[-1, :] = self._padded_tiles(arr[full_h:, :])[0, :]
+        return result
+
+    def _full_tiles(self, arr):
+        tile = self.tile_size
+        h, w, c = arr.shape
+        row_bytes = tile * c
+        if row_bytes % 8 != 0 or arr.strides[1] != c or arr.strides[2] != 1:
+            return self._padded_tiles(arr)
+
+        # (h, w * c) bytes seen as 8 byte words, no copy
+        rows = np.lib.stride_tricks.as_strided(arr, shape=(h, w * c), strides=(arr.strides[0], 1))
+        words = rows.view(np.uint64)
+        tiles_x = w // tile
+        weights = self.weights(row_bytes // 8)
+
+        result = np.empty((h // tile, tiles_x), dtype=np.uint64)
+        for ty in range(h // tile):
+            band = words[ty * tile:(ty + 1) * tile].reshape(tile, tiles_x, row_bytes // 8)
+            result[ty] = (band * weights[:, None, :]).sum(axis=(0, 2), dtype=np.uint64)
+        return result
+
+    def _padded_tiles(self, arr):
+        # small edge strips: pad to whole tiles and weigh byte by byte
+        tile = self.tile_size
+        h, w, c = arr.shape
+        tiles_y = -(-h // tile)
+        tiles_x = -(-w // tile)
+        padded = np.zeros((tiles_y * tile, tiles_x * tile, c), dtype=np.uint8)
+        padded[:h, :w] = arr
+
+        weights = self.weights(tile * c)
+        bands = padded.reshape(tiles_y, tile, tiles_x, tile * c).astype(np.uint64)
+        return (bands * weights[None, :, None, :]).sum(axis=(1, 3), dtype=np.uint64)
+
+
+class TileChangeDetector(object):
+
+    tile_size = DEFAULT_TILE_SIZE
+    previous = None
+
+    def __init__(self, tile_size=DEFAULT_TILE_SIZE):
+        self.tile_size = tile_size
+        self.checksum = TileChecksum(tile_size)
+        self.previous = None
+
+    def update(self, arr):
+        """
+        Dirty-tile mask of arr against the previous call; everything is
+        dirty on the first call or when the canvas size changed
+        """
+
+        checksums = self.checksum(arr)
+        if self.previous is None or self.previous.shape != checksums.shape:
+            mask = np.ones(checksums.shape, dtype=bool)
+        else:
+            mask = checksums != self.previous
+        self.previous = checksums
+        return mask
+
+    @property
+    def latest(self):
+        """
+        Checksums of the last update, None after a reset
+        """
+
+        return self.previous
+
+    def reset(self):
+        self.previous = None
+
+
+def checksum_digest(checksums):
+    """
+    Short hex digest of a checksum grid, shape included; equal digests
+    mean equal pixels at this tile checksum's strength
+    """
+
+    digest = hashlib.sha1(f"{checksums.shape[0]}x{checksums.shape[1]}:".encode("utf-8"))
+    digest.update(np.ascontiguousarray(checksums, dtype=np.uint64).tobytes())
+    return digest.hexdigest()
+
+
+def dirty_bbox(mask, tile_size, size=None):
+    """
+    Pixel rectangle (left, top, right, bottom) covering the dirty tiles,
+    clipped to size; None when nothing changed
+    """
+
+    rows = np.flatnonzero(mask.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(mask.any(axis=0))
+
+    left = int(cols[0]) * tile_size
+    top = int(rows[0]) * tile_size
+    right = (int(cols[-1]) + 1) * tile_size
+    bottom = (int(rows[-1]) + 1) * tile_size
+    if size is not None:
+        right = min(right, size[0])
+        bottom = min(bottom, size[1])
+    return (left, top, right, bottom)
+
+
+def dirty_fraction(mask):
+    return float(mask.mean()) if mask.size else 0.0
+
+
+def rescale_mask(mask, tile_size, size, target_size, target_tile_size, margin=None):
+    """
+    Dirty-tile mask of a (w, h) size image carried over to the image
+    resampled to target_size with target_tile_size tiles. A target tile is
+    dirty when the source pixels it was resampled from, grown by margin
+    source pixels for the filter reach, touch a dirty tile.
+    """
+
+    if tuple(size) == tuple(target_size) and tile_size == target_tile_size:
+        return mask.copy()
+
+    scale_x = size[0] / target_size[0]
+    scale_y = size[1] / target_size[1]
+    if margin is None:
+        # box halvings, then one bilinear step: about one scale of filter
+        # reach, plus the pixels an odd size drops at every halving
+        margin = 3 * max(scale_x, scale_y) + 2
+
+    # summed-area table: dirty tiles inside any tile rectangle in O(1)
+    table = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int64)
+    table[1:, 1:] = mask.cumsum(axis=0).cumsum(axis=1)
+
+    def source_tiles(length, source_length, scale, tiles):
+        start = np.arange(0, length, target_tile_size)
+        stop = np.minimum(start + target_tile_size, length)
+        first = np.clip(np.floor(start * scale - margin), 0, source_length - 1).astype(np.int64)
+        last = np.clip(np.ceil(stop * scale + margin), 1, source_length).astype(np.int64)
+        return np.minimum(first // tile_size, tiles - 1), np.minimum((last - 1) // tile_size + 1, tiles)
+
+    top, bottom = source_tiles(target_size[1], size[1], scale_y, mask.shape[0])
+    left, right = source_tiles(target_size[0], size[0], scale_x, mask.shape[1])
+    dirty = (
+        table[np.ix_(bottom, right)] - table[np.ix_(top, right)] -
+        table[np.ix_(bottom, left)] + table[np.ix_(top, left)]
+    )
+    return dirty > 0